@@ -0,0 +1,180 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.template import Template
+
+from fir_actions.utils import batches
+
+
+class CompiledTemplateCache(object):
+    """ Bounded LRU cache of the compiled subject and description of ActionTemplate objects
+
+    Entries are keyed by primary key and a hash of the template sources, so an edited template is never served
+    stale even before its invalidation reaches this process.
+    """
+
+    def __init__(self, max_size=None):
+        self._lock = threading.Lock()
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_size(self):
+        if self._max_size is not None:
+            return self._max_size
+        return getattr(settings, 'ACTIONS_TEMPLATE_CACHE_SIZE', 512)
+
+    @staticmethod
+    def key(action_template):
+        sources = u'{}\x00{}'.format(action_template.subject, action_template.description)
+        return action_template.pk, hashlib.sha1(sources.encode('utf-8')).hexdigest()
+
+    def get(self, action_template):
+        """ Get the compiled subject and description of an action template
+        :return: tuple (subject Template, description Template)
+        """
+        key = self.key(action_template)
+        with self._lock:
+            compiled = self._entries.pop(key, None)
+            if compiled is not None:
+                self._entries[key] = compiled
+                self.hits += 1
+                return compiled
+            self.misses += 1
+        compiled = (Template(action_template.subject), Template(action_template.description))
+        with self._lock:
+            self._entries[key] = compiled
+            while len(self._entries) > max(self.max_size, 0):
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return compiled
+
+    def evict(self, pk):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == pk]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+    def stats(self):
+        """ Cache statistics
+        :return: dict with size, max_size, hits, misses and evictions
+        """
+        return {'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class ActionTemplateIndex(object):
+    """ In-process index of the action template lists matching an incident
+
+    Entries are keyed by (category, detection, plan, business line) ids and hold the ActionList objects with their
+    prefetched ActionTemplate. Compiled subject and description templates are kept per ActionTemplate.
+    A version number stored in the Django cache lets every process drop its index when one of them invalidates it, as
+    long as the cache is shared by the processes: the index is dropped anyway every ACTIONS_LOCAL_CACHE_TIMEOUT seconds.
+    """
+    version_key = 'fir_actions:action_template_index'
+    max_entries = 1024
+
+    def __init__(self, model):
+        self.model = model
+        self._lock = threading.Lock()
+        self._version = None
+        self._entries = {}
+        self._cleared_at = time.time()
+        self.templates = CompiledTemplateCache()
+
+    def _clear(self):
+        self._entries = {}
+        self._cleared_at = time.time()
+
+    def _check_version(self):
+        """ :return: the current version, entries are only kept for it
+        """
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, 0)
+            version = cache.get(self.version_key, 0)
+        expired = time.time() - self._cleared_at >= getattr(settings, 'ACTIONS_LOCAL_CACHE_TIMEOUT', 300)
+        if version != self._version or expired:
+            with self._lock:
+                self._clear()
+                self._version = version
+        return version
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+            # Lists being fetched are not stored
+            self._version = None
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.add(self.version_key, 0)
+
+    def get_lists(self, category_id, detection_id, plan_id, business_line):
+        """ Get the action lists of a business line and its ancestors
+        The lists of the business line (and those of no business line) come first, then the lists of its parent and
+        so on up to the root.
+        :return: list of ActionList with prefetched actions
+        """
+        version = self._check_version()
+        key = (category_id, detection_id, plan_id, business_line.pk)
+        lists = self._entries.get(key)
+        if lists is None:
+            levels = [business_line.pk] + list(reversed(business_line.get_ancestors().values_list('pk', flat=True)))
+            q = Q(category_id=category_id) | Q(category__isnull=True)
+            q &= Q(detection_id=detection_id) | Q(detection__isnull=True)
+            q &= Q(plan_id=plan_id) | Q(plan__isnull=True)
+            q &= Q(business_lines__in=levels) | Q(business_lines__isnull=True)
+            found = list(self.model.objects.filter(q).distinct().order_by('pk').prefetch_related('actions'))
+            owners = self._business_lines([action_list.pk for action_list in found])
+            lists = []
+            for level in levels:
+                for action_list in found:
+                    if action_list not in lists and (not owners.get(action_list.pk) or level in owners[action_list.pk]):
+                        lists.append(action_list)
+            with self._lock:
+                if self._version == version:
+                    if len(self._entries) >= self.max_entries:
+                        self._entries = {}
+                    self._entries[key] = lists
+        return lists
+
+    def _business_lines(self, pks):
+        """ :return: dict action list id -> set of business line ids
+        """
+        field = self.model._meta.get_field('business_lines')
+        list_column = '{}_id'.format(field.m2m_field_name())
+        business_line_column = '{}_id'.format(field.m2m_reverse_field_name())
+        owners = {}
+        for batch in batches(pks):
+            for list_id, business_line_id in self.model.business_lines.through.objects.filter(
+                    **{list_column + '__in': batch}).values_list(list_column, business_line_column):
+                owners.setdefault(list_id, set()).add(business_line_id)
+        return owners
+
+    def compile(self, action_template):
+        """ Get the compiled subject and description of an action template
+        :return: tuple (subject Template, description Template)
+        """
+        return self.templates.get(action_template)
+
+    def warm(self, queryset):
+        """ Compile the action templates of a queryset, up to the template cache size
+        :return: number of compiled templates
+        """
+        compiled = 0
+        for action_template in queryset.order_by('pk')[:self.templates.max_size]:
+            self.templates.get(action_template)
+            compiled += 1
+        return compiled
@@ -1,4 +1,6 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db import DatabaseError
 
 
 class ActionsConfig(AppConfig):
@@ -8,3 +10,10 @@ class ActionsConfig(AppConfig):
     def ready(self):
         from fir_plugins.links import registry
         registry.register_reverse_link("(?:^|\s)B\#(\d+)", 'actions:blocks_details', model='fir_actions.Block', reverse="B#{}")
+        if getattr(settings, 'ACTIONS_TEMPLATE_CACHE_WARM', True):
+            from fir_actions.models import action_template_index, ActionTemplate
+            try:
+                action_template_index.warm(ActionTemplate.objects.all())
+            except DatabaseError:
+                # Tables not migrated yet
+                pass
@@ -0,0 +1,176 @@
+import threading
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+
+from incidents.models import BusinessLine
+from fir_actions.instrumentation import instrumented
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    MiddlewareMixin = object
+
+VERSION_KEY = 'fir_actions:business_lines:version'
+
+_scopes = threading.local()
+
+
+def cache_enabled():
+    return getattr(settings, 'ACTIONS_AUTHORIZATION_CACHE', True)
+
+
+def _version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, 0)
+        version = cache.get(VERSION_KEY, 0)
+    return version
+
+
+def invalidate():
+    """ Drop the cached business lines of every user, in every process
+    :return: None
+    """
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 0)
+    for scope in getattr(_scopes, 'stack', []):
+        scope.clear()
+
+
+@instrumented('operation', 'business_lines_for_user')
+def _fetch_business_line_ids(user, permission):
+    if not cache_enabled():
+        return list(BusinessLine.authorization.for_user(user, permission).values_list('pk', flat=True).distinct())
+    key = 'fir_actions:business_lines:{}:{}:{}'.format(_version(), user.pk, permission)
+    ids = cache.get(key)
+    if ids is None:
+        ids = list(BusinessLine.authorization.for_user(user, permission).values_list('pk', flat=True).distinct())
+        cache.set(key, ids, getattr(settings, 'ACTIONS_AUTHORIZATION_CACHE_TIMEOUT', 300))
+    return ids
+
+
+def _business_line_id(obj):
+    """ Id of the business line an object is authorized through: the object itself or its business_line foreign key
+    :return: business line id or None
+    """
+    if obj is None:
+        return None
+    if isinstance(obj, BusinessLine):
+        return obj.pk
+    try:
+        field = obj._meta.get_field('business_line')
+    except FieldDoesNotExist:
+        return None
+    if field.many_to_one and field.related_model is BusinessLine:
+        return obj.business_line_id
+    return None
+
+
+class AuthorizationScope(object):
+    """ Memoize the authorization checks of a user for the duration of a block (typically a request)
+
+    The business lines on which the user holds a permission are resolved once per permission, later checks on
+    business lines or objects bound to one (block locations) are answered from memory. Checks on other objects are
+    memoized per object.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.clear()
+
+    def clear(self):
+        self._business_lines = {}
+        self._checks = {}
+
+    def __enter__(self):
+        if not hasattr(_scopes, 'stack'):
+            _scopes.stack = []
+        _scopes.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _scopes.stack.remove(self)
+
+    def business_line_ids(self, permission):
+        ids = self._business_lines.get(permission)
+        if ids is None:
+            ids = self._business_lines[permission] = set(_fetch_business_line_ids(self.user, permission))
+        return ids
+
+    def has_perm(self, permission, obj=None):
+        business_line_id = _business_line_id(obj)
+        if business_line_id is not None:
+            return business_line_id in self.business_line_ids(permission)
+        key = (permission, obj._meta.label_lower, obj.pk) if obj is not None else (permission, None, None)
+        if key not in self._checks:
+            self._checks[key] = self.user.has_perm(permission, obj=obj)
+        return self._checks[key]
+
+
+def current_scope(user):
+    """ Get the innermost authorization scope of a user
+    :return: AuthorizationScope or None
+    """
+    if not cache_enabled() or user is None:
+        return None
+    for scope in reversed(getattr(_scopes, 'stack', [])):
+        if scope.user.pk == user.pk:
+            return scope
+    return None
+
+
+def has_perm(user, permission, obj=None):
+    """ user.has_perm(permission, obj), answered from the current authorization scope of the user if any
+    :return: bool
+    """
+    scope = current_scope(user)
+    if scope is None:
+        return user.has_perm(permission, obj=obj)
+    return scope.has_perm(permission, obj)
+
+
+def get_business_line_ids(user, permission):
+    """ Get the ids of the business lines on which a user holds a permission
+    The result is memoized in the current authorization scope, and cached per user for
+    ACTIONS_AUTHORIZATION_CACHE_TIMEOUT seconds (default: 300)
+    :return: list of business line ids
+    """
+    scope = current_scope(user)
+    if scope is not None:
+        return list(scope.business_line_ids(permission))
+    return _fetch_business_line_ids(user, permission)
+
+
+def authorization_scope(view):
+    """ View decorator memoizing the authorization checks of the request user
+    """
+    def wrapped(request, *args, **kwargs):
+        if not cache_enabled():
+            return view(request, *args, **kwargs)
+        with AuthorizationScope(request.user):
+            return view(request, *args, **kwargs)
+
+    return wraps(view)(wrapped)
+
+
+class AuthorizationScopeMiddleware(MiddlewareMixin):
+    """ Memoize the authorization checks of the request user for the whole request
+    """
+
+    def process_request(self, request):
+        # Scopes left over by a request which did not reach process_response
+        _scopes.stack = []
+        if cache_enabled():
+            request._fir_actions_authorization = AuthorizationScope(request.user).__enter__()
+
+    def process_response(self, request, response):
+        scope = getattr(request, '_fir_actions_authorization', None)
+        if scope is not None:
+            scope.__exit__(None, None, None)
+            del request._fir_actions_authorization
+        return response
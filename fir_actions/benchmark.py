@@ -0,0 +1,288 @@
+""" Benchmarks of the plugin hot paths, run by the actions_benchmark command
+
+Synthetic fixtures (business line tree, action templates and lists, incidents, actions, block locations and blocks)
+are bulk inserted in a transaction which is rolled back at the end of the run. Each scenario runs in a savepoint
+rolled back after every run, so that all runs start from the same data.
+
+A scenario is run `repeat` times to measure its wall time (the median is reported), then once with the executed
+queries captured and once with the allocated memory traced (Python 3 only).
+"""
+import datetime
+import gc
+import json
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from incidents.models import BusinessLine, Incident, IncidentCategory, Label, LabelGroup
+from fir_actions import services, views
+from fir_actions.indicators import index_fields, normalize
+from fir_actions.models import ACTION_TYPES, Action, ActionList, ActionTemplate, Block, BlockLocation, BlockType
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+FIXTURE_BATCH_SIZE = 5000
+
+BLOCK_STATES = ('enforced', ) * 6 + ('proposed', 'approved', 'refused', 'deleted')
+ACTION_STATES = ('created', 'assigned', 'assigned', 'blocked', 'closed', 'closed')
+
+
+def _chunks(count):
+    for start in range(0, count, FIXTURE_BATCH_SIZE):
+        yield range(start, min(start + FIXTURE_BATCH_SIZE, count))
+
+
+class Fixtures(object):
+    """ Synthetic data set, sized by the options of the actions_benchmark command
+    """
+
+    def __init__(self, business_lines=50, templates=200, lists=20, incidents=200, actions=10000, locations=5,
+                 blocks=100000, incident_blocks=500, seed=0):
+        self.sizes = {'business_lines': business_lines, 'templates': templates, 'lists': lists,
+                      'incidents': incidents, 'actions': actions, 'locations': locations, 'blocks': blocks,
+                      'incident_blocks': incident_blocks}
+        self.random = random.Random(seed)
+
+    def create(self):
+        sizes = self.sizes
+        self.user = User.objects.create_superuser('fir_actions_benchmark_{}'.format(int(time.time())),
+                                                  'benchmark@localhost', None)
+        self.business_lines = self._business_lines(sizes['business_lines'])
+        self.leaves = [bl for bl in self.business_lines if bl.is_leaf()] or self.business_lines
+        self.category = IncidentCategory.objects.create(name='Benchmark')
+        group, created = LabelGroup.objects.get_or_create(name='detection')
+        self.detection = Label.objects.create(name='Benchmark', group=group)
+
+        templates = ActionTemplate.objects.bulk_create([
+            ActionTemplate(type=ACTION_TYPES[i % len(ACTION_TYPES)][0], subject='Check {{ instance.subject }} #%d' % i,
+                           description='Incident {{ instance.pk }}: step %d' % i,
+                           business_line=self.random.choice(self.leaves) if i % 2 else None)
+            for i in range(sizes['templates'])])
+        templates = list(ActionTemplate.objects.order_by('-pk')[:len(templates)])
+        for i in range(sizes['lists']):
+            action_list = ActionList.objects.create(name='Benchmark %d' % i, category=self.category)
+            action_list.business_lines.add(*self.random.sample(self.leaves, min(3, len(self.leaves))))
+            action_list.actions.add(*self.random.sample(templates, min(10, len(templates))))
+
+        Incident.objects.bulk_create([self._incident('Benchmark incident %d' % i) for i in range(sizes['incidents'])])
+        self.incidents = list(Incident.objects.filter(category=self.category).order_by('pk'))
+        self.incident = self.incidents[0]
+        field = Incident._meta.get_field('concerned_business_lines')
+        incident_column = '{}_id'.format(field.m2m_field_name())
+        business_line_column = '{}_id'.format(field.m2m_reverse_field_name())
+        through = Incident.concerned_business_lines.through
+        through.objects.bulk_create([through(**{incident_column: incident.pk, business_line_column: bl.pk})
+                                     for incident in self.incidents
+                                     for bl in self.random.sample(self.leaves, min(3, len(self.leaves)))])
+        self.incident_business_lines = list(self.incident.concerned_business_lines.all())
+
+        self._actions(sizes['actions'])
+
+        self.block_types = [BlockType.objects.create(name='Benchmark IP'),
+                            BlockType.objects.create(name='Benchmark domain')]
+        self.locations = []
+        for i in range(sizes['locations']):
+            location = BlockLocation.objects.create(name='Benchmark %d' % i,
+                                                    business_line=self.leaves[i % len(self.leaves)])
+            location.types.add(*self.block_types)
+            self.locations.append(location)
+        self._blocks(sizes['blocks'])
+        block_ids = list(Block.objects.filter(where__in=self.locations).order_by('pk')
+                         .values_list('pk', flat=True)[:sizes['incident_blocks']])
+        through = Block.incidents.through
+        through.objects.bulk_create([through(block_id=pk, incident_id=self.incident.pk) for pk in block_ids],
+                                    batch_size=FIXTURE_BATCH_SIZE)
+
+    def _incident(self, subject):
+        return Incident(subject=subject, description=subject, category=self.category, detection=self.detection,
+                        severity=1, opened_by=self.user, confidentiality=1)
+
+    def _business_lines(self, count):
+        root = BusinessLine.add_root(name='Benchmark')
+        created = [root]
+        parents = [root]
+        while len(created) < count:
+            children = []
+            for parent in parents:
+                for i in range(5):
+                    if len(created) >= count:
+                        break
+                    child = BusinessLine.objects.get(pk=parent.pk).add_child(name='{} {}'.format(parent.name, i))
+                    created.append(child)
+                    children.append(child)
+            parents = children
+        return created
+
+    def _actions(self, count):
+        opened_on = datetime.datetime.now()
+        incidents = [self.incident] * (count // 20) + self.incidents
+        for batch in _chunks(count):
+            Action.objects.bulk_create([
+                Action(subject='Benchmark action %d' % i, description='Benchmark action %d' % i,
+                       type=ACTION_TYPES[i % len(ACTION_TYPES)][0], state=ACTION_STATES[i % len(ACTION_STATES)], incident=incidents[i % len(incidents)],
+                       business_line=self.random.choice(self.leaves), opened_by=self.user,
+                       opened_on=opened_on - datetime.timedelta(minutes=i))
+                for i in batch])
+
+    def _blocks(self, count):
+        for batch in _chunks(count):
+            blocks = []
+            for i in batch:
+                location = self.locations[i % len(self.locations)]
+                n = i // len(self.locations)
+                if n % 4:
+                    how, what = self.block_types[0], '10.{}.{}.{}'.format((n >> 16) & 255, (n >> 8) & 255, n & 255)
+                else:
+                    how, what = self.block_types[1], 'host{}.benchmark{}.example'.format(n, n % 1000)
+                blocks.append(Block(where=location, how=how, what=what, normalized_what=normalize(what),
+                                    state=BLOCK_STATES[n % len(BLOCK_STATES)], **index_fields(what)))
+            Block.objects.bulk_create(blocks)
+
+
+class Scenarios(object):
+    """ The benchmarked operations, on top of the fixtures
+    """
+
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+        self.factory = RequestFactory()
+
+    def all(self):
+        """ :return: list of (name, callable)
+        """
+        scenarios = [('new_event', self.new_event)]
+        for lines in (10, 1000, 10000):
+            scenarios.append(('blocks_addblock_{}'.format(lines), lambda lines=lines: self.blocks_addblock(lines)))
+        scenarios.extend([
+            ('block_approve_enforce_cascade', self.block_cascade),
+            ('action_list', lambda: self.render(views.ActionList, event_id=self.fixtures.incident.pk)),
+            ('action_list_followup', lambda: self.render(views.ActionList, {'followup': 1},
+                                                         event_id=self.fixtures.incident.pk)),
+            ('action_dashboard', lambda: self.render(views.ActionList, {'status': 'active'})),
+            ('block_list', lambda: self.render(views.BlockList, event_id=self.fixtures.incident.pk)),
+            ('block_list_followup', lambda: self.render(views.BlockList, {'followup': 1},
+                                                        event_id=self.fixtures.incident.pk)),
+            ('action_list_cached', lambda: self.render(views.ActionList, event_id=self.fixtures.incident.pk,
+                                                       cached=True)),
+            ('block_list_cached', lambda: self.render(views.BlockList, event_id=self.fixtures.incident.pk,
+                                                      cached=True)),
+            ('refresh_artifacts', self.refresh_artifacts),
+        ])
+        return scenarios
+
+    def request(self, method='get', data=None):
+        request = getattr(self.factory, method)('/', data or {})
+        request.user = self.fixtures.user
+        return request
+
+    def new_event(self):
+        incident = self.fixtures._incident('Benchmark new event')
+        incident.save()
+        incident.concerned_business_lines.add(*self.fixtures.incident_business_lines)
+        incident.done_creating()
+
+    def blocks_addblock(self, lines):
+        # Benchmarking addresses (RFC 2544), disjoint from the fixture blocks
+        values = ['198.{}.{}.{}'.format(18 + (i >> 16), (i >> 8) & 255, i & 255) for i in range(lines)]
+        location = self.fixtures.locations[0]
+        response = views.blocks_addblock(self.request('post', {
+            'where': location.pk, 'how': self.fixtures.block_types[0].pk, 'what': '\n'.join(values),
+            'comment': 'Benchmark'}), event_id=str(self.fixtures.incident.pk))
+        if json.loads(response.content.decode('utf-8')).get('status') != 'success':
+            raise RuntimeError('blocks_addblock failed')
+
+    def block_cascade(self):
+        blocks = list(Block.objects.filter(incidents=self.fixtures.incident, state='proposed')
+                      .values_list('pk', flat=True)[:100])
+        services.bulk_transition(Block, blocks, 'approve', self.fixtures.user)
+        services.bulk_transition(Block, blocks, 'enforce', self.fixtures.user)
+
+    def render(self, view, data=None, cached=False, **kwargs):
+        # The fragment cache is only used by the *_cached scenarios, the others measure the rendering
+        with override_settings(ACTIONS_FRAGMENT_CACHE=cached):
+            response = view.as_view()(self.request('get', data), **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+
+    def refresh_artifacts(self):
+        Block.refresh_artifacts_bulk(list(Block.objects.filter(where=self.fixtures.locations[0])
+                                          .only('id', 'what').order_by('pk')[:1000]))
+
+
+def _in_savepoint(func):
+    sid = transaction.savepoint()
+    try:
+        func()
+    finally:
+        transaction.savepoint_rollback(sid)
+
+
+def measure(func, repeat=3):
+    """ Benchmark a scenario
+    :return: dict with the number of queries, the median wall time (seconds) and the peak traced memory (bytes)
+    """
+    timings = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.time()
+        _in_savepoint(func)
+        timings.append(time.time() - start)
+    with CaptureQueriesContext(connection) as queries:
+        _in_savepoint(func)
+    memory = None
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            _in_savepoint(func)
+            memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    timings.sort()
+    return {'queries': len(queries), 'time': timings[len(timings) // 2], 'memory': memory}
+
+
+def run(fixtures, names=None, repeat=3, report=None):
+    """ Create the fixtures and run the scenarios whose names start with one of `names` (all by default)
+    Nothing is left in the database.
+    :param report: called with (name, result) after each scenario
+    :return: list of (name, result)
+    """
+    results = []
+    with transaction.atomic():
+        fixtures.create()
+        for name, func in Scenarios(fixtures).all():
+            if names and not any(name.startswith(prefix) for prefix in names):
+                continue
+            result = measure(func, repeat)
+            results.append((name, result))
+            if report is not None:
+                report(name, result)
+        transaction.set_rollback(True)
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """ Compare results with a baseline
+    A scenario regresses when it runs more queries, or takes `tolerance` (relative) more time or memory
+    :return: list of (name, metric, baseline value, value)
+    """
+    regressions = []
+    for name, result in results:
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        if result['queries'] > reference['queries']:
+            regressions.append((name, 'queries', reference['queries'], result['queries']))
+        for metric in ('time', 'memory'):
+            if result.get(metric) is not None and reference.get(metric) and \
+                    result[metric] > reference[metric] * (1 + tolerance):
+                regressions.append((name, metric, reference[metric], result[metric]))
+    return regressions
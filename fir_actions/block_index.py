@@ -0,0 +1,300 @@
+""" In-memory index of the blocks of a location, answering containment queries
+
+IP addresses and networks are kept in a binary prefix tree per IP version, domains in a trie of their reversed
+labels. A lookup returns the blocks with the same value, the blocks covering it (enclosing networks, parent domains,
+the host of an URL) and the blocks it covers.
+
+Indexes are built from the typed columns of Block on first use and kept per process. When a transaction changing
+the blocks of a location commits, the process updates its own index with the changed blocks and bumps a version
+stored in the Django cache, which makes the other processes rebuild theirs. The Django cache has to be shared by the
+processes (memcached, redis, database) for them to see the version: indexes are rebuilt anyway once they are
+ACTIONS_LOCAL_CACHE_TIMEOUT seconds old (default: 300).
+"""
+import threading
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.six.moves.urllib.parse import urlsplit
+
+from fir_actions import indicators
+from fir_actions.utils import batches, on_commit_once
+
+# Refused and deleted blocks never overlap
+INDEXED_EXCLUDED_STATES = ('refused', 'deleted')
+
+INDEXED_FIELDS = ('id', 'how_id', 'state', 'what', 'normalized_what', 'indicator_type', 'ip_version', 'range_start',
+                  'range_end')
+
+# location id -> (version, build time, LocationIndex)
+_indexes = {}
+_lock = threading.Lock()
+# Blocks changed by the current transaction of the thread, location id -> set of block ids
+_changes = threading.local()
+
+
+class IPTree(object):
+    """ Binary prefix tree of the networks of an IP version, a node is a list [child 0, child 1, entries]
+    """
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = [None, None, []]
+
+    def _walk(self, start, length, create=False):
+        """ Yield the nodes on the path of a prefix, from the root (depth 0) to the prefix itself (depth `length`)
+        """
+        node = self.root
+        yield 0, node
+        for depth in range(1, length + 1):
+            bit = (start >> (self.bits - depth)) & 1
+            child = node[bit]
+            if child is None:
+                if not create:
+                    return
+                child = node[bit] = [None, None, []]
+            node = child
+            yield depth, node
+
+    def insert(self, start, length, entry):
+        """ :return: list of the entries of the prefix
+        """
+        for depth, node in self._walk(start, length, create=True):
+            pass
+        node[2].append(entry)
+        return node[2]
+
+    def lookup(self, start, length):
+        """ :return: tuple (exact, covering, covered) lists of entries
+        """
+        exact, covering, covered = [], [], []
+        node = None
+        for depth, node in self._walk(start, length):
+            if depth < length:
+                covering.extend(node[2])
+            else:
+                exact.extend(node[2])
+        if node is not None and depth == length:
+            nodes = [child for child in node[:2] if child is not None]
+            while nodes:
+                child = nodes.pop()
+                covered.extend(child[2])
+                nodes.extend(grandchild for grandchild in child[:2] if grandchild is not None)
+        return exact, covering, covered
+
+
+class DomainTrie(object):
+    """ Trie of reversed domain labels, a node is a dict label -> node, its entries are under the None key and the
+    entries of its wildcard (`*.domain`, which covers the subdomains only) under the WILDCARD key
+    """
+    WILDCARD = '*'
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, domain, entry, wildcard=False):
+        """ :return: list of the entries of the domain
+        """
+        node = self.root
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        entries = node.setdefault(self.WILDCARD if wildcard else None, [])
+        entries.append(entry)
+        return entries
+
+    def lookup(self, domain, wildcard=False):
+        """ :return: tuple (exact, covering, covered) lists of entries
+        """
+        exact, covering, covered = [], [], []
+        labels = list(reversed(domain.split('.')))
+        node = self.root
+        for i, label in enumerate(labels):
+            node = node.get(label)
+            if node is None:
+                return exact, covering, covered
+            if i < len(labels) - 1:
+                covering.extend(node.get(None, []))
+                covering.extend(node.get(self.WILDCARD, []))
+        if wildcard:
+            exact.extend(node.get(self.WILDCARD, []))
+            covering.extend(node.get(None, []))
+        else:
+            exact.extend(node.get(None, []))
+            covered.extend(node.get(self.WILDCARD, []))
+        nodes = [child for label, child in node.items() if label not in (None, self.WILDCARD)]
+        while nodes:
+            child = nodes.pop()
+            covered.extend(child.get(None, []))
+            covered.extend(child.get(self.WILDCARD, []))
+            nodes.extend(grandchild for label, grandchild in child.items() if label not in (None, self.WILDCARD))
+        return exact, covering, covered
+
+
+class LocationIndex(object):
+    """ Index of the blocks of a location
+    Entries are dicts with the id, how_id, state and what of a block.
+    """
+
+    def __init__(self, blocks=()):
+        self.ip = {4: IPTree(32), 6: IPTree(128)}
+        self.domains = DomainTrie()
+        self.values = {}
+        # block id -> (list holding its entry, entry)
+        self.entries = {}
+        self._lock = threading.RLock()
+        for block in blocks:
+            self.add(*block)
+
+    @property
+    def size(self):
+        return len(self.entries)
+
+    def add(self, pk, how_id, state, what, normalized_what, indicator_type, ip_version, range_start, range_end):
+        entry = {'id': pk, 'how_id': how_id, 'state': state, 'what': what}
+        with self._lock:
+            self.remove(pk)
+            if ip_version in self.ip and range_start is not None:
+                start, end = int(range_start, 16), int(range_end, 16)
+                tree = self.ip[ip_version]
+                bucket = tree.insert(start, tree.bits - (end - start).bit_length(), entry)
+            elif indicator_type == indicators.DOMAIN:
+                normalized_what = normalized_what or indicators.normalize(what)
+                bucket = self.domains.insert(indicators.parse(what).value, entry,
+                                             wildcard=normalized_what.startswith('*.'))
+            else:
+                bucket = self.values.setdefault(normalized_what or indicators.normalize(what), [])
+                bucket.append(entry)
+            self.entries[pk] = (bucket, entry)
+
+    def remove(self, pk):
+        with self._lock:
+            bucket, entry = self.entries.pop(pk, (None, None))
+            if bucket is not None:
+                bucket.remove(entry)
+
+    def lookup(self, value):
+        """ Find the blocks overlapping a value
+        :return: tuple (indicator, exact, covering, covered)
+        """
+        indicator = indicators.parse(value)
+        with self._lock:
+            if indicator.version is not None:
+                exact, covering, covered = self.ip[indicator.version].lookup(indicator.start,
+                                                                             indicators.prefix_length(indicator))
+            elif indicator.type == indicators.DOMAIN:
+                exact, covering, covered = self.domains.lookup(indicator.value,
+                                                               wildcard=indicators.normalize(value).startswith('*.'))
+            else:
+                exact, covering, covered = list(self.values.get(indicator.value, [])), [], []
+                if indicator.type == indicators.URL:
+                    host = urlsplit(indicator.value).hostname
+                    if host:
+                        covering.extend(entry for entries in self.lookup(host)[1:3] for entry in entries)
+        return indicator, exact, covering, covered
+
+
+def _version_key(location_id):
+    return 'fir_actions:block_index:{}'.format(location_id)
+
+
+def _version(location_id):
+    key = _version_key(location_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, 0)
+        version = cache.get(key, 0)
+    return version
+
+
+def _indexed_blocks(location_id):
+    Block = apps.get_model('fir_actions', 'Block')
+    return Block.objects.filter(where_id=location_id).exclude(state__in=INDEXED_EXCLUDED_STATES)
+
+
+def build(location_id):
+    """ Build the index of a location from the database
+    :return: LocationIndex
+    """
+    return LocationIndex(_indexed_blocks(location_id).values_list(*INDEXED_FIELDS).iterator())
+
+
+def _timeout():
+    return getattr(settings, 'ACTIONS_LOCAL_CACHE_TIMEOUT', 300)
+
+
+def get_index(location_id):
+    """ Get the index of a location, rebuilt if another process changed the blocks of the location since it was built
+    or if it is older than ACTIONS_LOCAL_CACHE_TIMEOUT
+    :return: LocationIndex
+    """
+    version = _version(location_id)
+    with _lock:
+        cached = _indexes.get(location_id)
+    if cached is not None and cached[0] == version and time.time() - cached[1] < _timeout():
+        return cached[2]
+    built_at = time.time()
+    index = build(location_id)
+    with _lock:
+        _indexes[location_id] = (version, built_at, index)
+    return index
+
+
+def lookup(location_id, value, states=None, how=None):
+    """ Find the blocks of a location overlapping a value
+    :param states: only report blocks in these states
+    :param how: only report blocks of this block type id
+    :return: dict with the indicator type and the exact, covering and covered blocks
+    """
+    indicator, exact, covering, covered = get_index(location_id).lookup(value)
+
+    def keep(entries):
+        return [entry for entry in entries
+                if (states is None or entry['state'] in states) and (how is None or entry['how_id'] == how)]
+
+    return {'value': indicator.value, 'indicator': indicator.type, 'exact': keep(exact),
+            'covering': keep(covering), 'covered': keep(covered)}
+
+
+def _update(location_id, pks):
+    """ Bump the version of a location and apply the changed blocks to the index of this process, dropped when another
+    process bumped the version since the index was built or updated
+    """
+    try:
+        version = cache.incr(_version_key(location_id))
+    except ValueError:
+        cache.add(_version_key(location_id), 0)
+        version = None
+    with _lock:
+        cached = _indexes.pop(location_id, None)
+    if cached is None or version is None or cached[0] != version - 1:
+        return
+    index = cached[2]
+    for batch in batches(pks):
+        rows = list(_indexed_blocks(location_id).filter(pk__in=batch).values_list(*INDEXED_FIELDS))
+        for pk in batch:
+            index.remove(pk)
+        for row in rows:
+            index.add(*row)
+    with _lock:
+        _indexes.setdefault(location_id, (version, cached[1], index))
+
+
+def _apply_changes():
+    locations = getattr(_changes, 'locations', {})
+    _changes.locations = {}
+    for location_id, pks in locations.items():
+        _update(location_id, sorted(pks))
+
+
+def changed(location_id, pks):
+    """ Update the index of a location with changed (saved, transitioned, moved or deleted) blocks, once the current
+    transaction commits
+    :return: None
+    """
+    if location_id is None:
+        return
+    if not hasattr(_changes, 'locations'):
+        _changes.locations = {}
+    _changes.locations.setdefault(location_id, set()).update(pks)
+    on_commit_once(_apply_changes)
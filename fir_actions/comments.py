@@ -0,0 +1,92 @@
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.decorators import ContextDecorator
+
+_buffers = threading.local()
+
+
+class CommentFrame(object):
+    """ Comments collected by one level of ActionCommentBuffer
+    """
+
+    def __init__(self, coalesce):
+        self.coalesce = coalesce
+        self.comments = []
+
+    def add(self, comment):
+        self.comments.append(comment)
+
+    def flush(self):
+        comments = self.comments
+        self.comments = []
+        if self.coalesce:
+            comments = coalesce_comments(comments)
+        if comments:
+            type(comments[0]).objects.bulk_create(comments)
+
+
+def coalesce_comments(comments):
+    """ Merge the successive comments of the same author on the same automated (auto_state) action
+    The merged comment keeps the date and position of the first one
+    """
+    merged = []
+    last = {}
+    for comment in comments:
+        previous = last.get(comment.action_id)
+        if previous is not None and previous.opened_by_id == comment.opened_by_id and comment.action.auto_state:
+            previous.comment = "%s\n\n%s" % (previous.comment, comment.comment)
+            continue
+        last[comment.action_id] = comment
+        merged.append(comment)
+    return merged
+
+
+def current_comment_buffer():
+    """ Get the innermost active comment buffer frame of the current thread, if any
+    """
+    stack = getattr(_buffers, 'stack', None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+class ActionCommentBuffer(ContextDecorator):
+    """ Collect the comments written by action transitions and insert them with one bulk_create
+
+    The outermost buffer registers its flush with transaction.on_commit when its block exits without error: the
+    comments are inserted once the enclosing transaction commits (at once outside of a transaction) and dropped with
+    it on rollback. A nested buffer behaves like a savepoint: its comments are handed to the outer buffer on
+    success and dropped on error. With coalesce (default: ACTIONS_COALESCE_COMMENTS setting), successive comments
+    of the same author on the same automated action are merged into one.
+    """
+
+    def __init__(self, coalesce=None):
+        self.coalesce = coalesce
+
+    def __enter__(self):
+        if not hasattr(_buffers, 'stack'):
+            _buffers.stack = []
+        outer = current_comment_buffer()
+        if outer is not None:
+            coalesce = outer.coalesce
+        elif self.coalesce is None:
+            coalesce = getattr(settings, 'ACTIONS_COALESCE_COMMENTS', False)
+        else:
+            coalesce = self.coalesce
+        _buffers.stack.append(CommentFrame(coalesce))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        frame = _buffers.stack.pop()
+        if exc_type is not None:
+            return
+        outer = current_comment_buffer()
+        if outer is not None:
+            outer.comments.extend(frame.comments)
+        elif frame.comments:
+            transaction.on_commit(frame.flush)
+
+
+def collect_action_comments(coalesce=None):
+    return ActionCommentBuffer(coalesce=coalesce)
@@ -0,0 +1,158 @@
+""" Redundancy analysis of the active blocks of a location
+
+A block is redundant when an enforced block of the same location and type makes it useless: same normalized value
+(lowest id kept), enclosing IP network, parent domain or wildcard domain (`*.example.com` covers the subdomains of
+example.com, not example.com itself). Redundant enforced blocks can be proposed for deletion, the compacted export
+further aggregates adjacent IP networks into the smallest list of networks.
+"""
+import ipaddress
+from collections import OrderedDict
+
+from fir_actions import indicators
+from fir_actions.models import Block, BLOCK_ACTIVE_STATES
+
+# Blocks which may make others redundant: not on their way out
+COVERING_STATES = ('enforced', )
+
+DUPLICATE = 'duplicate'
+COVERED = 'covered'
+
+COMPACTION_FIELDS = ('id', 'how_id', 'how__name', 'state', 'what', 'normalized_what', 'indicator_type', 'ip_version',
+                     'range_start', 'range_end')
+
+
+class Entry(object):
+    __slots__ = ('id', 'how_id', 'how', 'state', 'what', 'key', 'type', 'version', 'start', 'end')
+
+    def __init__(self, pk, how_id, how, state, what, normalized_what, indicator_type, ip_version, range_start,
+                 range_end):
+        self.id, self.how_id, self.how, self.state, self.what = pk, how_id, how, state, what
+        self.key = normalized_what or indicators.normalize(what)
+        self.type = indicator_type
+        self.version = ip_version
+        self.start = int(range_start, 16) if range_start is not None else None
+        self.end = int(range_end, 16) if range_end is not None else None
+
+    @property
+    def covering(self):
+        return self.state in COVERING_STATES
+
+
+class Compaction(object):
+    """ Redundant blocks of a set of active blocks
+    `redundant` maps the id of a redundant block to (reason, covering block)
+    """
+
+    def __init__(self, rows):
+        groups = OrderedDict()
+        for row in rows:
+            entry = Entry(*row)
+            groups.setdefault(entry.how_id, []).append(entry)
+        self.entries = groups
+        self.redundant = {}
+        for entries in groups.values():
+            self._networks([entry for entry in entries if entry.version is not None])
+            self._domains([entry for entry in entries if entry.type == indicators.DOMAIN])
+            self._duplicates([entry for entry in entries if entry.version is None and entry.type != indicators.DOMAIN])
+
+    def _mark(self, entry, cover):
+        reason = DUPLICATE if cover.key == entry.key else COVERED
+        self.redundant[entry.id] = (reason, cover)
+
+    def _networks(self, entries):
+        # Networks are either nested or disjoint: sorted by start then by decreasing size, the enclosing enforced
+        # networks of an entry are on the stack
+        for version in (4, 6):
+            stack = []
+            for entry in sorted((e for e in entries if e.version == version), key=lambda e: (e.start, -e.end, e.id)):
+                while stack and stack[-1].end < entry.start:
+                    stack.pop()
+                if stack:
+                    self._mark(entry, stack[0])
+                elif entry.covering:
+                    stack.append(entry)
+
+    def _domains(self, entries):
+        # Wildcards are keyed by their parent domain, they only cover strict subdomains of it
+        covering, wildcards = {}, {}
+        for entry in sorted(entries, key=lambda e: e.id):
+            if entry.covering:
+                covering.setdefault(entry.key, entry)
+                if entry.key.startswith('*.'):
+                    wildcards.setdefault(entry.key[2:], entry)
+        for entry in entries:
+            labels = entry.key.split('.')
+            for i in range(len(labels) - 1, -1, -1):
+                suffix = '.'.join(labels[i:])
+                cover = covering.get(suffix)
+                if (cover is None or cover is entry) and i > 0:
+                    cover = wildcards.get(suffix)
+                if cover is not None and cover is not entry:
+                    self._mark(entry, cover)
+                    break
+
+    def _duplicates(self, entries):
+        covering = {}
+        for entry in sorted(entries, key=lambda e: e.id):
+            if entry.covering:
+                covering.setdefault(entry.key, entry)
+        for entry in entries:
+            cover = covering.get(entry.key)
+            if cover is not None and cover is not entry:
+                self._mark(entry, cover)
+
+    def proposals(self):
+        """ Redundant blocks which can be proposed for deletion
+        :return: list of (Entry, reason, covering Entry)
+        """
+        return [(entry, self.redundant[entry.id][0], self.redundant[entry.id][1])
+                for entries in self.entries.values() for entry in entries
+                if entry.id in self.redundant and entry.state == 'enforced']
+
+    def compacted(self):
+        """ Smallest list of rules equivalent to the active blocks: redundant blocks are dropped and adjacent
+        networks are aggregated. Kept blocks are exported with their value as entered, aggregates in compressed form.
+        :return: list of (value, block type name, ids of the blocks the value replaces)
+        """
+        rows = []
+        for entries in self.entries.values():
+            how = entries[0].how
+            kept = [entry for entry in entries if entry.id not in self.redundant]
+            members = {}
+            for entry in entries:
+                cover = self.redundant[entry.id][1] if entry.id in self.redundant else entry
+                members.setdefault(cover.id, []).append(entry.id)
+            networks = {4: [], 6: []}
+            for entry in kept:
+                if entry.version is not None:
+                    networks[entry.version].append((ipaddress.ip_network(entry.key, strict=False), entry))
+                else:
+                    rows.append((entry.what, how, sorted(members[entry.id])))
+            for version in (4, 6):
+                # Both lists are sorted by address: each kept network belongs to the aggregate following the previous
+                kept_networks = sorted(networks[version], key=lambda item: (item[0].network_address, item[1].id))
+                i = 0
+                for network in ipaddress.collapse_addresses([item[0] for item in kept_networks]):
+                    ids, items = [], []
+                    while i < len(kept_networks) and kept_networks[i][0].network_address <= network.broadcast_address:
+                        ids.extend(members[kept_networks[i][1].id])
+                        items.append(kept_networks[i])
+                        i += 1
+                    if len(items) == 1 and items[0][0] == network:
+                        value = items[0][1].what
+                    elif network.num_addresses > 1:
+                        value = network.compressed
+                    else:
+                        value = network.network_address.compressed
+                    rows.append((value, how, sorted(ids)))
+        return rows
+
+
+def compact(location, how=None):
+    """ Analyse the active blocks of a location, optionally restricted to a block type
+    :return: Compaction
+    """
+    blocks = Block.objects.filter(where=location, state__in=BLOCK_ACTIVE_STATES)
+    if how is not None:
+        blocks = blocks.filter(how=how)
+    return Compaction(blocks.order_by('id').values_list(*COMPACTION_FIELDS).iterator())
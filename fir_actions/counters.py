@@ -0,0 +1,176 @@
+import threading
+from collections import defaultdict
+
+from django.apps import apps
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from django.utils.decorators import ContextDecorator
+
+from fir_actions.utils import batches
+
+ACTION = 'action'
+BLOCK = 'block'
+
+# Counter model of each counted column
+COUNTER_MODELS = {
+    'incident_id': 'IncidentActivityCounter',
+    'business_line_id': 'BusinessLineActivityCounter',
+}
+
+_batches = threading.local()
+
+
+def _counter_model(column, app_registry=apps):
+    return app_registry.get_model('fir_actions', COUNTER_MODELS[column])
+
+
+def _new_deltas():
+    return defaultdict(lambda: [0, 0])
+
+
+def record(kind, active, incidents=(), business_lines=(), delta=1):
+    """ Count `delta` actions or blocks entering (delta > 0) or leaving (delta < 0) the active or inactive set
+    of incidents and business lines. Deltas are applied at once, or when the current batch_counters block exits.
+    """
+    deltas = _new_deltas()
+    column = 0 if active else 1
+    for pk in incidents:
+        if pk is not None:
+            deltas[(kind, pk, None)][column] += delta
+    for pk in business_lines:
+        if pk is not None:
+            deltas[(kind, None, pk)][column] += delta
+    stack = getattr(_batches, 'stack', None)
+    if stack:
+        merge(stack[-1], deltas)
+    else:
+        apply(deltas)
+
+
+def merge(target, deltas):
+    for key, (active, inactive) in deltas.items():
+        target[key][0] += active
+        target[key][1] += inactive
+
+
+def apply(deltas):
+    """ Write counter deltas
+    Counters receiving the same delta are updated together, with one UPDATE per backend batch
+    :return: None
+    """
+    groups = defaultdict(list)
+    for (kind, incident_id, business_line_id), (active, inactive) in deltas.items():
+        if active or inactive:
+            if incident_id is not None:
+                groups[(kind, 'incident_id', active, inactive)].append(incident_id)
+            else:
+                groups[(kind, 'business_line_id', active, inactive)].append(business_line_id)
+
+    with transaction.atomic():
+        for (kind, column, active, inactive), ids in groups.items():
+            counter_model = _counter_model(column)
+            changes = {'active': F('active') + active, 'inactive': F('inactive') + inactive}
+            for batch in batches(ids):
+                counters = counter_model.objects.filter(**{'kind': kind, column + '__in': batch})
+                existing = set(counters.values_list(column, flat=True))
+                if existing:
+                    counters.filter(**{column + '__in': existing}).update(**changes)
+                # A missing counter counts nothing: decrements only reach it from cascade deletions
+                if active <= 0 and inactive <= 0:
+                    continue
+                missing = [counter_model(**{'kind': kind, column: pk, 'active': max(active, 0),
+                                            'inactive': max(inactive, 0)})
+                           for pk in batch if pk not in existing]
+                try:
+                    with transaction.atomic():
+                        counter_model.objects.bulk_create(missing)
+                except IntegrityError:
+                    # Some were created concurrently: retry one by one
+                    for counter in missing:
+                        try:
+                            with transaction.atomic():
+                                counter.save()
+                        except IntegrityError:
+                            counter_model.objects.filter(**{'kind': kind, column: getattr(counter, column)})\
+                                .update(**changes)
+
+
+class BatchCounters(ContextDecorator):
+    """ Aggregate the counter deltas recorded in a block and write them when it exits without error
+    Nested blocks hand their deltas to the outer one.
+    """
+
+    def __enter__(self):
+        if not hasattr(_batches, 'stack'):
+            _batches.stack = []
+        _batches.stack.append(_new_deltas())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        deltas = _batches.stack.pop()
+        if exc_type is not None:
+            return
+        if _batches.stack:
+            merge(_batches.stack[-1], deltas)
+        else:
+            apply(deltas)
+
+
+def batch_counters():
+    return BatchCounters()
+
+
+def get_counters(incident=None, business_line=None):
+    """ Get the active and inactive actions and blocks of an incident or a business line
+    :return: dict {'actions': {'active': int, 'inactive': int, 'total': int}, 'blocks': {...}}
+    """
+    result = {
+        'actions': {'active': 0, 'inactive': 0, 'total': 0},
+        'blocks': {'active': 0, 'inactive': 0, 'total': 0},
+    }
+    if incident is not None:
+        counters = _counter_model('incident_id').objects.filter(incident=incident)
+    else:
+        counters = _counter_model('business_line_id').objects.filter(business_line=business_line)
+    for kind, active, inactive in counters.values_list('kind', 'active', 'inactive'):
+        result['{}s'.format(kind)] = {'active': active, 'inactive': inactive, 'total': active + inactive}
+    return result
+
+
+def rebuild(app_registry=apps):
+    """ Recompute every counter from the actions and blocks tables
+    `app_registry` lets data migrations run it against their historical models
+    :return: number of counters written
+    """
+    from fir_actions.models import BLOCK_ACTIVE_STATES
+    Action = app_registry.get_model('fir_actions', 'Action')
+    Block = app_registry.get_model('fir_actions', 'Block')
+
+    deltas = _new_deltas()
+    for incident_id, business_line_id, state, count in Action.objects.values_list(
+            'incident_id', 'business_line_id', 'state').annotate(count=Count('id')).order_by():
+        column = 1 if state == 'closed' else 0
+        if incident_id is not None:
+            deltas[(ACTION, incident_id, None)][column] += count
+        if business_line_id is not None:
+            deltas[(ACTION, None, business_line_id)][column] += count
+    for incident_id, state, count in Block.objects.filter(incidents__isnull=False).values_list(
+            'incidents', 'state').annotate(count=Count('id')).order_by():
+        deltas[(BLOCK, incident_id, None)][0 if state in BLOCK_ACTIVE_STATES else 1] += count
+    for business_line_id, state, count in Block.objects.values_list(
+            'where__business_line', 'state').annotate(count=Count('id')).order_by():
+        deltas[(BLOCK, None, business_line_id)][0 if state in BLOCK_ACTIVE_STATES else 1] += count
+
+    incident_model = _counter_model('incident_id', app_registry)
+    business_line_model = _counter_model('business_line_id', app_registry)
+    with transaction.atomic():
+        incident_model.objects.all().delete()
+        business_line_model.objects.all().delete()
+        incident_model.objects.bulk_create([
+            incident_model(kind=kind, incident_id=incident_id, active=active, inactive=inactive)
+            for (kind, incident_id, business_line_id), (active, inactive) in deltas.items()
+            if incident_id is not None])
+        business_line_model.objects.bulk_create([
+            business_line_model(kind=kind, business_line_id=business_line_id, active=active, inactive=inactive)
+            for (kind, incident_id, business_line_id), (active, inactive) in deltas.items()
+            if business_line_id is not None])
+    return len(deltas)
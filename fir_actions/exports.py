@@ -0,0 +1,76 @@
+import csv
+import json
+
+from django.utils.encoding import force_str
+
+EXPORT_FIELDS = ('id', 'what', 'how__name', 'state', 'updated_on')
+
+
+def iter_blocks(queryset, chunk_size=2000):
+    """ Iterate over the export fields of a block queryset, fetching chunk_size rows per query by id
+    """
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).order_by('id').values_list(*EXPORT_FIELDS)[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1][0]
+
+
+class Echo(object):
+    """ File-like object returning what is written, to stream a csv.writer output
+    """
+
+    def write(self, value):
+        return value
+
+
+def export_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(['id', 'what', 'how', 'state', 'updated_on'])
+    for block_id, what, how, state, updated_on in rows:
+        yield writer.writerow([block_id, force_str(what), force_str(how), state, updated_on.isoformat()])
+
+
+def export_jsonl(rows):
+    for block_id, what, how, state, updated_on in rows:
+        yield json.dumps({'id': block_id, 'what': what, 'how': how, 'state': state,
+                          'updated_on': updated_on.isoformat()}) + '\n'
+
+
+def export_txt(rows):
+    for row in rows:
+        yield row[1] + '\n'
+
+
+EXPORTERS = {
+    'csv': ('text/csv', export_csv),
+    'jsonl': ('application/x-ndjson', export_jsonl),
+    'txt': ('text/plain', export_txt),
+}
+
+
+def export_compacted_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(['what', 'how', 'blocks'])
+    for what, how, ids in rows:
+        yield writer.writerow([force_str(what), force_str(how), ' '.join(str(pk) for pk in ids)])
+
+
+def export_compacted_jsonl(rows):
+    for what, how, ids in rows:
+        yield json.dumps({'what': what, 'how': how, 'blocks': ids}) + '\n'
+
+
+def export_compacted_txt(rows):
+    for row in rows:
+        yield row[0] + '\n'
+
+
+COMPACTED_EXPORTERS = {
+    'csv': ('text/csv', export_compacted_csv),
+    'jsonl': ('application/x-ndjson', export_compacted_jsonl),
+    'txt': ('text/plain', export_compacted_txt),
+}
@@ -4,6 +4,7 @@ from incidents.models import BusinessLine
 
 from dal import autocomplete
 
+from fir_actions import block_index
 from fir_actions.models import BlockLocation, Action, BlockType
 
 
@@ -27,6 +28,7 @@ class MultipleBlockForm(forms.Form):
     )
     what = forms.CharField(required=True, widget=forms.Textarea())
     comment = forms.CharField(required=False, widget=forms.Textarea(), help_text=_('Enter one item per line'))
+    confirm = forms.BooleanField(required=False, label=_('Add overlapping blocks'))
 
     def __init__(self, *args, **kwargs):
         user = kwargs.pop('user')
@@ -45,8 +47,35 @@ class MultipleBlockForm(forms.Form):
                 'type': how,
                 'location': where
             })
+        if not cleaned_data.get('confirm'):
+            overlaps = self.find_overlaps(where, how, cleaned_data['what'])
+            if overlaps:
+                self.add_error('what', _("Overlapping blocks on %(location)s: %(overlaps)s") % {
+                    'location': where, 'overlaps': '; '.join(overlaps)})
         return cleaned_data
 
+    @staticmethod
+    def find_overlaps(where, how, values):
+        """ Describe the existing blocks of a location and type covering or covered by the new values
+        Blocks with the same value are not overlaps: they are reused.
+        :return: list of text
+        """
+        index = block_index.get_index(where.pk)
+        overlaps = []
+        for value in values:
+            if not value.strip():
+                continue
+            indicator, exact, covering, covered = index.lookup(value)
+            covering = [b for b in covering if b['how_id'] == how.pk]
+            covered = [b for b in covered if b['how_id'] == how.pk]
+            if covering:
+                overlaps.append(_('%(value)s is covered by %(blocks)s') % {
+                    'value': indicator.value, 'blocks': ', '.join('B#{id} {what}'.format(**b) for b in covering)})
+            if covered:
+                overlaps.append(_('%(value)s covers %(blocks)s') % {
+                    'value': indicator.value, 'blocks': ', '.join('B#{id} {what}'.format(**b) for b in covered)})
+        return overlaps
+
 
 class ActionForm(forms.ModelForm):
 
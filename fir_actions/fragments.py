@@ -0,0 +1,112 @@
+""" Cache of the action and block list fragments of incidents
+
+The rendered fragment is cached under a key made of the view, the incident, a version of the incident actions and
+blocks, the business lines on which the user holds the permissions the fragment depends on, the language and the
+query string. The incident version is bumped once the transactions changing its actions or blocks commit. Versions and
+fragments live in the Django cache: when it is not shared by the processes, the others serve their fragments until
+they expire (ACTIONS_FRAGMENT_CACHE_TIMEOUT).
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.translation import get_language
+
+from fir_actions import transitions
+from fir_actions.authorization import get_business_line_ids
+from fir_actions.utils import on_commit_once
+
+GLOBAL_VERSION_KEY = 'fir_actions:fragments:version'
+
+# Permission filtering the rows of the lists
+VIEW_PERMISSION = 'incidents.view_incidents'
+
+
+def cache_enabled():
+    return getattr(settings, 'ACTIONS_FRAGMENT_CACHE', True)
+
+
+def _version_key(incident_id):
+    return 'fir_actions:fragments:{}'.format(incident_id)
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, 0)
+        version = cache.get(key, 0)
+    return version
+
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0)
+
+
+def invalidate_incident(incident_id):
+    """ Drop the cached fragments of an incident once the current transaction commits
+    """
+    if incident_id is not None:
+        on_commit_once(_bump, _version_key(incident_id))
+
+
+def invalidate_all():
+    """ Drop every cached fragment (business lines, locations and block types are displayed in all of them)
+    """
+    on_commit_once(_bump, GLOBAL_VERSION_KEY)
+
+
+def permission_fingerprint(user, model):
+    """ Digest of the business lines on which a user holds the permissions filtering the rows and the transitions of a
+    model. Transitions with a permission bound to no business line make the fingerprint specific to the user.
+    :return: text
+    """
+    permissions = {VIEW_PERMISSION}
+    user_specific = False
+    for transition in transitions.tables[model].all():
+        permission = transition.permission
+        if not permission:
+            continue
+        if getattr(permission, 'permission', None) is None:
+            user_specific = True
+        else:
+            permissions.add(permission.permission)
+    parts = ['{}:{}'.format(permission, ','.join(str(pk) for pk in sorted(get_business_line_ids(user, permission))))
+             for permission in sorted(permissions)]
+    if user_specific:
+        parts.append('user:{}'.format(user.pk))
+    return hashlib.sha1(';'.join(parts).encode('utf-8')).hexdigest()
+
+
+class FragmentCacheMixin(object):
+    """ Serve the GET requests of the incident list views from the fragment cache
+    """
+    fragment_model = None
+
+    def fragment_key(self, request, incident_id):
+        versions = cache.get_many([GLOBAL_VERSION_KEY, _version_key(incident_id)])
+        if len(versions) < 2:
+            versions = {GLOBAL_VERSION_KEY: _get_version(GLOBAL_VERSION_KEY),
+                        _version_key(incident_id): _get_version(_version_key(incident_id))}
+        query = hashlib.sha1(request.GET.urlencode().encode('utf-8')).hexdigest()
+        return 'fir_actions:fragment:{}:{}:{}.{}:{}:{}:{}'.format(
+            type(self).__name__, incident_id, versions[GLOBAL_VERSION_KEY], versions[_version_key(incident_id)],
+            permission_fingerprint(request.user, self.fragment_model), get_language(), query)
+
+    def get(self, request, *args, **kwargs):
+        incident_id = kwargs.get('event_id')
+        if not cache_enabled() or request.method != 'GET' or not incident_id:
+            return super(FragmentCacheMixin, self).get(request, *args, **kwargs)
+        key = self.fragment_key(request, incident_id)
+        content = cache.get(key)
+        if content is not None:
+            return HttpResponse(content)
+        response = super(FragmentCacheMixin, self).get(request, *args, **kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        if response.status_code == 200:
+            cache.set(key, response.content, getattr(settings, 'ACTIONS_FRAGMENT_CACHE_TIMEOUT', 300))
+        return response
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import ipaddress
+import re
+from collections import namedtuple
+
+from django.utils.encoding import force_text
+
+
+# IPv4-mapped IPv6 addresses (RFC 4291)
+IPV4_MAPPED = ipaddress.ip_network(u'::ffff:0:0/96')
+
+
+def _normalize_ip(value):
+    """ :raise ValueError: when the value is not an IP address or network
+    """
+    if '/' in value:
+        network = ipaddress.ip_network(value, strict=False)
+        if network.version == 6 and network.prefixlen >= 96 and network.network_address in IPV4_MAPPED:
+            address = ipaddress.IPv4Address(int(network.network_address) & 0xffffffff)
+            network = ipaddress.ip_network(u'{}/{}'.format(address, network.prefixlen - 96))
+        return network.compressed
+    address = ipaddress.ip_address(value)
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return address.compressed
+
+
+def _normalize_url(value):
+    """ Case fold the scheme and the host of an URL, its path, query and fragment are case sensitive
+    """
+    scheme, rest = value.split('://', 1)
+    authority = re.match(r'[^/?#]*', rest).group(0)
+    userinfo, at, host = authority.rpartition('@')
+    return u'{}://{}{}{}{}'.format(scheme.lower(), userinfo, at, host.lower(), rest[len(authority):])
+
+
+def normalize(value):
+    """ Canonical form of a block value, used as its deduplication key
+    IP addresses and networks are compressed (IPv6) and stripped of leading zeros, IPv4-mapped IPv6 addresses are
+    written as IPv4. The scheme and host of URLs are case folded. Domain names and other values are case folded and
+    trimmed (including a trailing dot).
+    :return: normalized text value
+    """
+    value = force_text(value).strip()
+    try:
+        return _normalize_ip(value)
+    except ValueError:
+        pass
+    if '://' in value:
+        return _normalize_url(value)
+    value = value.lower()
+    if value.endswith('.') and '.' in value[:-1]:
+        value = value.rstrip('.')
+    return value
+
+
+IP = 'ip'
+NETWORK = 'network'
+DOMAIN = 'domain'
+URL = 'url'
+HASH = 'hash'
+OTHER = 'other'
+
+INDICATOR_TYPES = (
+    (IP, 'IP address'),
+    (NETWORK, 'IP network'),
+    (DOMAIN, 'Domain'),
+    (URL, 'URL'),
+    (HASH, 'Hash'),
+    (OTHER, 'Other'),
+)
+
+HASH_LENGTHS = (32, 40, 64, 128)
+DOMAIN_RE = re.compile(r'^(?:\*\.)?(?:[a-z0-9_](?:[a-z0-9_-]{0,61}[a-z0-9])?\.)+[a-z][a-z0-9-]{0,61}[a-z0-9]$')
+HEX_RE = re.compile(r'^[0-9a-f]+$')
+
+Indicator = namedtuple('Indicator', ['type', 'value', 'version', 'start', 'end'])
+
+
+def parse(value):
+    """ Type a block value. IP addresses and networks carry their version and address range (as integers)
+    :return: Indicator
+    """
+    value = normalize(value)
+    try:
+        if '/' in value:
+            network = ipaddress.ip_network(value, strict=False)
+            return Indicator(NETWORK, value, network.version, int(network.network_address),
+                             int(network.broadcast_address))
+        address = ipaddress.ip_address(value)
+        return Indicator(IP, value, address.version, int(address), int(address))
+    except ValueError:
+        pass
+    if '://' in value:
+        return Indicator(URL, value, None, None, None)
+    if len(value) in HASH_LENGTHS and HEX_RE.match(value):
+        return Indicator(HASH, value, None, None, None)
+    if len(value) <= 253 and DOMAIN_RE.match(value):
+        if value.startswith('*.'):
+            value = value[2:]
+        return Indicator(DOMAIN, value, None, None, None)
+    return Indicator(OTHER, value, None, None, None)
+
+
+def address_bits(version):
+    return 32 if version == 4 else 128
+
+
+def prefix_length(indicator):
+    """ Prefix length of an IP or network indicator
+    """
+    return address_bits(indicator.version) - (indicator.end - indicator.start + 1).bit_length() + 1
+
+
+def encode_address(version, address):
+    """ Fixed width hexadecimal form of an address, ordered like the address itself
+    """
+    return '{:0{width}x}'.format(address, width=address_bits(version) // 4)
+
+
+def index_fields(value):
+    """ Values of the Block typed index columns for a block value
+    :return: dict
+    """
+    indicator = parse(value)
+    fields = {'indicator_type': indicator.type, 'ip_version': indicator.version, 'range_start': None,
+              'range_end': None}
+    if indicator.version is not None:
+        fields['range_start'] = encode_address(indicator.version, indicator.start)
+        fields['range_end'] = encode_address(indicator.version, indicator.end)
+    return fields
@@ -0,0 +1,247 @@
+""" Timers and query counters of the plugin views, signal receivers and hot operations
+
+Enabled with the ACTIONS_METRICS setting. Each instrumented call is reported to the metrics backends listed in
+ACTIONS_METRICS_BACKENDS (default: ['prometheus']):
+
+* 'prometheus': in-process counters and histograms, served in the Prometheus text format by the `metrics` view
+* 'log': one JSON record per call on the `fir_actions.metrics` logger
+* dotted path to a class taking no argument and implementing `observe(kind, name, duration, queries)`
+
+Calls slower than ACTIONS_SLOW_OPERATION_THRESHOLD milliseconds are logged with their SQL queries on the
+`fir_actions.slow` logger, whether ACTIONS_METRICS is enabled or not.
+"""
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+metrics_logger = logging.getLogger('fir_actions.metrics')
+slow_logger = logging.getLogger('fir_actions.slow')
+
+# Histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+SLOW_QUERIES_LOGGED = 20
+
+_config = None
+
+
+class PrometheusBackend(object):
+    """ Per process counters and histograms of the instrumented calls
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, kind, name, duration, queries):
+        with self._lock:
+            serie = self.series.get((kind, name))
+            if serie is None:
+                serie = self.series[(kind, name)] = {'count': 0, 'seconds': 0.0, 'queries': 0,
+                                                     'buckets': [0] * len(BUCKETS)}
+            serie['count'] += 1
+            serie['seconds'] += duration
+            serie['queries'] += queries
+            bucket = bisect_left(BUCKETS, duration)
+            if bucket < len(BUCKETS):
+                serie['buckets'][bucket] += 1
+
+    def clear(self):
+        with self._lock:
+            self.series = {}
+
+    def render(self, gauges=None):
+        """ Text exposition format of the collected metrics, followed by gauges {name: (help, value)}
+        :return: text
+        """
+        with self._lock:
+            series = sorted((key, dict(value, buckets=list(value['buckets']))) for key, value in self.series.items())
+        lines = ['# HELP fir_actions_operation_seconds Duration of the instrumented calls',
+                 '# TYPE fir_actions_operation_seconds histogram']
+        for (kind, name), serie in series:
+            labels = 'kind="{}",name="{}"'.format(kind, name)
+            cumulated = 0
+            for bound, count in zip(BUCKETS, serie['buckets']):
+                cumulated += count
+                lines.append('fir_actions_operation_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, cumulated))
+            lines.append('fir_actions_operation_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, serie['count']))
+            lines.append('fir_actions_operation_seconds_sum{{{}}} {}'.format(labels, serie['seconds']))
+            lines.append('fir_actions_operation_seconds_count{{{}}} {}'.format(labels, serie['count']))
+        lines.extend(['# HELP fir_actions_operation_queries_total SQL queries run by the instrumented calls',
+                      '# TYPE fir_actions_operation_queries_total counter'])
+        for (kind, name), serie in series:
+            lines.append('fir_actions_operation_queries_total{{kind="{}",name="{}"}} {}'.format(kind, name,
+                                                                                           serie['queries']))
+        for name, (help_text, value) in sorted((gauges or {}).items()):
+            lines.extend(['# HELP fir_actions_{} {}'.format(name, help_text),
+                          '# TYPE fir_actions_{} gauge'.format(name),
+                          'fir_actions_{} {}'.format(name, value)])
+        return '\n'.join(lines) + '\n'
+
+
+class LogBackend(object):
+    """ Log every instrumented call as a JSON record
+    """
+
+    def observe(self, kind, name, duration, queries):
+        metrics_logger.info(json.dumps({'kind': kind, 'name': name, 'duration_ms': round(duration * 1000, 3),
+                                        'queries': queries}))
+
+
+BACKENDS = {
+    'prometheus': PrometheusBackend,
+    'log': LogBackend,
+}
+
+
+class Config(object):
+
+    def __init__(self):
+        self.enabled = getattr(settings, 'ACTIONS_METRICS', False)
+        self.slow_threshold = getattr(settings, 'ACTIONS_SLOW_OPERATION_THRESHOLD', None)
+        if self.slow_threshold is not None:
+            self.slow_threshold /= 1000.0
+        self.backends = []
+        if self.enabled:
+            for name in getattr(settings, 'ACTIONS_METRICS_BACKENDS', ['prometheus']):
+                self.backends.append(BACKENDS[name]() if name in BACKENDS else import_string(name)())
+
+    @property
+    def active(self):
+        return self.enabled or self.slow_threshold is not None
+
+
+def get_config():
+    global _config
+    if _config is None:
+        _config = Config()
+    return _config
+
+
+@receiver(setting_changed, dispatch_uid='fir_actions_instrumentation_settings')
+def reset_config(setting=None, **kwargs):
+    global _config
+    if setting is None or setting.startswith('ACTIONS_METRICS') or setting == 'ACTIONS_SLOW_OPERATION_THRESHOLD':
+        _config = None
+
+
+def get_backend(cls):
+    """ Get the configured backend of a class
+    :return: backend instance or None
+    """
+    for backend in get_config().backends:
+        if isinstance(backend, cls):
+            return backend
+    return None
+
+
+class QueryRecorder(object):
+    """ Database execute wrapper counting the queries of the connection, and keeping their SQL and duration
+    """
+
+    def __init__(self, keep):
+        self.keep = keep
+        self.count = 0
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            if self.keep:
+                self.queries.append({'sql': sql, 'time': time.time() - start})
+
+
+class operation(object):
+    """ Time a block and count its queries, reporting them to the metrics backends
+    SQL queries are recorded while the block runs only when the instrumentation is active, with an execute wrapper
+    (Django >= 2.0) or else from the debug cursor log.
+    """
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+
+    def __enter__(self):
+        self.config = get_config()
+        if not self.config.active:
+            return self
+        if hasattr(connection, 'execute_wrapper'):
+            self.recorder = QueryRecorder(keep=self.config.slow_threshold is not None)
+            self.wrapper = connection.execute_wrapper(self.recorder)
+            self.wrapper.__enter__()
+        else:
+            self.recorder = None
+            self.debug_cursor = connection.force_debug_cursor
+            connection.force_debug_cursor = True
+            self.first_query = len(connection.queries_log)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.config.active:
+            return
+        duration = time.time() - self.start
+        if self.recorder is not None:
+            self.wrapper.__exit__(exc_type, exc_value, traceback)
+            queries, logged = self.recorder.count, self.recorder.queries
+        else:
+            connection.force_debug_cursor = self.debug_cursor
+            logged = list(connection.queries_log)[self.first_query:]
+            queries = len(logged)
+        for backend in self.config.backends:
+            try:
+                backend.observe(self.kind, self.name, duration, queries)
+            except Exception:
+                metrics_logger.exception('Metrics backend %s failed', backend)
+        if self.config.slow_threshold is not None and duration >= self.config.slow_threshold:
+            self.log_slow(duration, logged)
+
+    def log_slow(self, duration, queries):
+        slowest = sorted(queries, key=lambda query: float(query.get('time') or 0), reverse=True)
+        slow_logger.warning('Slow %s %s: %.1f ms, %d queries\n%s', self.kind, self.name, duration * 1000, len(queries),
+                            '\n'.join('{} ms: {}'.format(float(query.get('time') or 0) * 1000, query['sql'])
+                                      for query in slowest[:SLOW_QUERIES_LOGGED]))
+
+
+def instrumented(kind, name=None):
+    """ Decorator timing a function and counting its queries
+    """
+    def decorator(func):
+        label = name or func.__name__
+
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            if not get_config().active:
+                return func(*args, **kwargs)
+            with operation(kind, label):
+                return func(*args, **kwargs)
+
+        return wrapped
+
+    return decorator
+
+
+class InstrumentedViewMixin(object):
+    """ Time class based views, named after their class, including the rendering of their template response
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if not get_config().active:
+            return super(InstrumentedViewMixin, self).dispatch(request, *args, **kwargs)
+        with operation('view', type(self).__name__):
+            response = super(InstrumentedViewMixin, self).dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+        return response
@@ -0,0 +1,59 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from fir_actions import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the fir_actions hot paths on synthetic fixtures (rolled back at the end of the run)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', action='append', default=[], metavar='PREFIX',
+                            help='Only run the scenarios whose name starts with PREFIX (repeatable)')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs per scenario (median reported)')
+        parser.add_argument('--seed', type=int, default=0)
+        for name, default in (('business-lines', 50), ('templates', 200), ('lists', 20), ('incidents', 200),
+                              ('actions', 10000), ('locations', 5), ('blocks', 100000), ('incident-blocks', 500)):
+            parser.add_argument('--' + name, type=int, default=default, help='Fixture size (default: {})'.format(default))
+        parser.add_argument('--save', metavar='FILE', help='Write the results to FILE, to use as a baseline')
+        parser.add_argument('--compare', metavar='FILE', help='Compare the results with the baseline in FILE')
+        parser.add_argument('--tolerance', type=float, default=20,
+                            help='Time and memory increase (percent) reported as a regression (default: 20)')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            if baseline.get('vendor') != connection.vendor:
+                self.stderr.write('The baseline was measured on {}'.format(baseline.get('vendor')))
+
+        fixtures = benchmark.Fixtures(business_lines=options['business_lines'], templates=options['templates'],
+                                      lists=options['lists'], incidents=options['incidents'],
+                                      actions=options['actions'], locations=options['locations'],
+                                      blocks=options['blocks'], incident_blocks=options['incident_blocks'],
+                                      seed=options['seed'])
+        self.stdout.write('{:<32} {:>8} {:>10} {:>10}'.format('scenario', 'queries', 'time (ms)', 'memory (kB)'))
+
+        def report(name, result):
+            memory = '{:.0f}'.format(result['memory'] / 1024.0) if result['memory'] is not None else '-'
+            self.stdout.write('{:<32} {:>8} {:>10.1f} {:>10}'.format(name, result['queries'], result['time'] * 1000,
+                                                                    memory))
+
+        results = benchmark.run(fixtures, names=options['only'], repeat=options['repeat'], report=report)
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump({'vendor': connection.vendor, 'fixtures': fixtures.sizes, 'results': dict(results)}, f,
+                          indent=2, sort_keys=True)
+        if baseline is not None:
+            if baseline.get('fixtures') != fixtures.sizes:
+                self.stderr.write('The baseline was measured with other fixture sizes: {}'.format(
+                    baseline.get('fixtures')))
+            regressions = benchmark.compare(results, baseline.get('results', {}), options['tolerance'] / 100.0)
+            for name, metric, reference, value in regressions:
+                self.stdout.write('REGRESSION {} {}: {} -> {}'.format(name, metric, reference, value))
+            if regressions:
+                raise CommandError('{} regressions against {}'.format(len(regressions), options['compare']))
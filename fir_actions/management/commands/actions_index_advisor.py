@@ -0,0 +1,164 @@
+import abc
+import json
+import re
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from django.utils import six
+
+from incidents.models import Incident, BusinessLine
+from fir_actions.models import Action, Block, BlockChange, BlockLocation, BusinessLineActivityCounter, \
+    IncidentActivityCounter, BLOCK_ACTIVE_STATES
+
+ACTIVE_ACTION_STATES = ('created', 'assigned', 'blocked')
+
+
+def canonical_queries():
+    """ The hot queries of the plugin, with parameters taken from the database when possible
+    :return: list of (description, queryset)
+    """
+    incident_id = Incident.objects.values_list('pk', flat=True).first() or 0
+    business_line_ids = list(BusinessLine.objects.values_list('pk', flat=True)[:10]) or [0]
+    location = BlockLocation.objects.first()
+    location_id = location.pk if location else 0
+    block = Block.objects.only('id', 'where', 'how').first()
+    how_id = block.how_id if block else 0
+    block_id = block.pk if block else 0
+    return [
+        ('active actions of an incident',
+         Action.objects.filter(incident_id=incident_id, state__in=ACTIVE_ACTION_STATES).order_by('-opened_on')),
+        ('active actions of business lines',
+         Action.objects.filter(Q(business_line_id__in=business_line_ids) | Q(business_line__isnull=True))
+         .filter(state__in=ACTIVE_ACTION_STATES).order_by('-opened_on')),
+        ('actions keyset page', Action.objects.order_by('-opened_on', '-id')[:50]),
+        ('open actions of a block', Action.objects.filter(blocks=block_id, state__in=['assigned', 'blocked'])),
+        ('active blocks of a location', Block.objects.filter(where_id=location_id, state__in=BLOCK_ACTIVE_STATES)),
+        ('block deduplication',
+         Block.objects.filter(where_id=location_id, how_id=how_id, normalized_what__in=['example.com'])),
+        ('blocks of an incident', Block.objects.filter(incidents=incident_id)),
+        ('block change feed', BlockChange.objects.filter(location_id=location_id, sequence__gt=0)
+         .order_by('sequence')[:1000]),
+        ('incident counters', IncidentActivityCounter.objects.filter(incident_id=incident_id)),
+        ('business line counters', BusinessLineActivityCounter.objects.filter(business_line_id=business_line_ids[0])),
+    ]
+
+
+@six.add_metaclass(abc.ABCMeta)
+class Explainer(object):
+    """ Run EXPLAIN on a query, implemented per database vendor
+    """
+
+    @abc.abstractmethod
+    def explain(self, cursor, sql, params):
+        """ :return: tuple (names of the plugin tables read without index, names of the used indexes)
+        """
+
+
+class SQLiteExplainer(Explainer):
+    scan = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+    index = re.compile(r'USING (?:COVERING )?INDEX (\w+)')
+
+    def explain(self, cursor, sql, params):
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        scans, indexes = set(), set()
+        for row in cursor.fetchall():
+            detail = row[-1]
+            match = self.index.search(detail)
+            if match:
+                indexes.add(match.group(1))
+                continue
+            match = self.scan.match(detail)
+            if match and ' USING ' not in detail:
+                scans.add(match.group(1))
+        return scans, indexes
+
+
+class PostgreSQLExplainer(Explainer):
+
+    def explain(self, cursor, sql, params):
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        scans, indexes = set(), set()
+        nodes = [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node.get('Node Type') == 'Seq Scan':
+                scans.add(node.get('Relation Name'))
+            if 'Index Name' in node:
+                indexes.add(node['Index Name'])
+            nodes.extend(node.get('Plans', []))
+        return scans, indexes
+
+
+class MySQLExplainer(Explainer):
+
+    def explain(self, cursor, sql, params):
+        cursor.execute('EXPLAIN ' + sql, params)
+        columns = [column[0] for column in cursor.description]
+        scans, indexes = set(), set()
+        for row in cursor.fetchall():
+            row = dict(zip(columns, row))
+            if row.get('type') == 'ALL':
+                scans.add(row.get('table'))
+            if row.get('key'):
+                indexes.add(row['key'])
+        return scans, indexes
+
+
+EXPLAINERS = {
+    'sqlite': SQLiteExplainer,
+    'postgresql': PostgreSQLExplainer,
+    'mysql': MySQLExplainer,
+}
+
+
+class Command(BaseCommand):
+    help = 'Run EXPLAIN on the fir_actions hot queries and report full table scans and unused indexes'
+
+    def handle(self, *args, **options):
+        explainer = EXPLAINERS.get(connection.vendor)
+        if explainer is None:
+            self.stderr.write('EXPLAIN is not supported on {}'.format(connection.vendor))
+            return
+        explainer = explainer()
+        # Foreign key and unique indexes are left out of the unused report: they back joins, deletions and constraints
+        tables = {}
+        for model in (Action, IncidentActivityCounter, BusinessLineActivityCounter, Block, BlockChange):
+            tables[model._meta.db_table] = set(field.column for field in model._meta.concrete_fields
+                                               if field.is_relation)
+        used = set()
+        warnings = 0
+        with connection.cursor() as cursor:
+            for description, queryset in canonical_queries():
+                sql, params = queryset.query.sql_with_params()
+                scans, indexes = explainer.explain(cursor, sql, params)
+                used.update(indexes)
+                scans = sorted(table for table in scans if table and table.startswith('fir_actions_'))
+                if scans:
+                    warnings += 1
+                    self.stdout.write('MISSING  {}: full scan of {}'.format(description, ', '.join(scans)))
+                else:
+                    self.stdout.write('OK       {}: {}'.format(description, ', '.join(sorted(indexes)) or '-'))
+
+            for table, foreign_keys in sorted(tables.items()):
+                constraints = connection.introspection.get_constraints(cursor, table)
+                for name, constraint in sorted(constraints.items()):
+                    if not constraint['index'] or constraint['unique'] or name in used:
+                        continue
+                    if len(constraint['columns']) == 1 and constraint['columns'][0] in foreign_keys:
+                        continue
+                    self.stdout.write('UNUSED   {}.{} ({}) is not used by the hot queries'.format(
+                        table, name, ', '.join(constraint['columns'])))
+
+            if connection.vendor == 'postgresql':
+                cursor.execute('SELECT relname, indexrelname FROM pg_stat_user_indexes '
+                               'WHERE idx_scan = 0 AND relname IN %s', [tuple(tables)])
+                for table, name in cursor.fetchall():
+                    self.stdout.write('UNUSED   {}.{} was never scanned since the statistics reset'.format(table, name))
+
+        if warnings:
+            self.stdout.write('Plans depend on table statistics: run ANALYZE on a populated database before '
+                              'adding indexes for the reported scans.')
@@ -0,0 +1,24 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from fir_actions.models import prune_action_digests, prune_block_changes
+
+
+class Command(BaseCommand):
+    help = 'Delete the block changes and action digests older than their retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'ACTIONS_BLOCK_CHANGES_RETENTION', 90),
+                            help='Block changes retention, in days (default: ACTIONS_BLOCK_CHANGES_RETENTION or 90)')
+        parser.add_argument('--digest-days', type=int,
+                            default=getattr(settings, 'ACTIONS_DIGESTS_RETENTION', 30),
+                            help='Action digests retention, in days (default: ACTIONS_DIGESTS_RETENTION or 30)')
+
+    def handle(self, *args, **options):
+        now = datetime.datetime.now()
+        before = now - datetime.timedelta(days=options['days'])
+        self.stdout.write('{} block changes deleted'.format(prune_block_changes(before)))
+        before = now - datetime.timedelta(days=options['digest_days'])
+        self.stdout.write('{} action digests deleted'.format(prune_action_digests(before)))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from fir_actions import counters
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the active and inactive actions and blocks counters of incidents and business lines'
+
+    def handle(self, *args, **options):
+        written = counters.rebuild()
+        self.stdout.write('{} counters rebuilt'.format(written))
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_actions', '0009_auto_20170113_1652'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='action',
+            index_together=set([('business_line', 'state', 'opened_on')]),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_actions', '0010_auto_20261018_0642'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='block',
+            name='updated_on',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='last update'),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_actions', '0011_block_updated_on'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlockChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.PositiveIntegerField(editable=False, null=True, verbose_name='sequence')),
+                ('date', models.DateTimeField(db_index=True, default=datetime.datetime.now, verbose_name='date')),
+                ('what', models.CharField(max_length=100, verbose_name='what')),
+                ('state', models.CharField(choices=[('proposed', 'Proposed'), ('approved', 'Approved'), ('refused', 'Refused'), ('enforced', 'Enforced'), ('blocked', 'Blocked'), ('deletion_proposed', 'Deletion proposed'), ('deletion_approved', 'Deletion approved'), ('deleted', 'Deleted')], max_length=50, verbose_name='state')),
+                ('active', models.BooleanField(verbose_name='active')),
+                ('block', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='changes', to='fir_actions.Block', verbose_name='block')),
+                ('how', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='fir_actions.BlockType', verbose_name='how')),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='fir_actions.BlockLocation', verbose_name='where')),
+            ],
+            options={
+                'verbose_name': 'block change',
+                'verbose_name_plural': 'block changes',
+            },
+        ),
+        migrations.AddField(
+            model_name='blocklocation',
+            name='change_sequence',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='last change'),
+        ),
+    ]
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+BLOCK_ACTIVE_STATES = ('enforced', 'deletion_proposed', 'deletion_approved')
+
+
+def build_counters(apps, schema_editor):
+    """ Count the actions and blocks of every incident and business line
+    """
+    Action = apps.get_model('fir_actions', 'Action')
+    Block = apps.get_model('fir_actions', 'Block')
+    IncidentActivityCounter = apps.get_model('fir_actions', 'IncidentActivityCounter')
+    BusinessLineActivityCounter = apps.get_model('fir_actions', 'BusinessLineActivityCounter')
+
+    counts = defaultdict(lambda: [0, 0])
+    for incident_id, business_line_id, state, count in Action.objects.values_list(
+            'incident_id', 'business_line_id', 'state').annotate(count=Count('id')).order_by():
+        column = 1 if state == 'closed' else 0
+        if incident_id is not None:
+            counts[('action', incident_id, None)][column] += count
+        if business_line_id is not None:
+            counts[('action', None, business_line_id)][column] += count
+    for incident_id, state, count in Block.objects.filter(incidents__isnull=False).values_list(
+            'incidents', 'state').annotate(count=Count('id')).order_by():
+        counts[('block', incident_id, None)][0 if state in BLOCK_ACTIVE_STATES else 1] += count
+    for business_line_id, state, count in Block.objects.values_list(
+            'where__business_line', 'state').annotate(count=Count('id')).order_by():
+        counts[('block', None, business_line_id)][0 if state in BLOCK_ACTIVE_STATES else 1] += count
+
+    IncidentActivityCounter.objects.bulk_create([
+        IncidentActivityCounter(kind=kind, incident_id=incident_id, active=active, inactive=inactive)
+        for (kind, incident_id, business_line_id), (active, inactive) in counts.items() if incident_id is not None],
+        batch_size=1000)
+    BusinessLineActivityCounter.objects.bulk_create([
+        BusinessLineActivityCounter(kind=kind, business_line_id=business_line_id, active=active, inactive=inactive)
+        for (kind, incident_id, business_line_id), (active, inactive) in counts.items() if incident_id is None],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('incidents', '0009_add_incicent_permissions'),
+        ('fir_actions', '0012_blockchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BusinessLineActivityCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('action', 'Actions'), ('block', 'Blocks')], max_length=10, verbose_name='kind')),
+                ('active', models.IntegerField(default=0, verbose_name='active')),
+                ('inactive', models.IntegerField(default=0, verbose_name='inactive')),
+                ('business_line', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='incidents.BusinessLine', verbose_name='business line')),
+            ],
+            options={
+                'verbose_name': 'business line activity counter',
+                'verbose_name_plural': 'business line activity counters',
+            },
+        ),
+        migrations.CreateModel(
+            name='IncidentActivityCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('action', 'Actions'), ('block', 'Blocks')], max_length=10, verbose_name='kind')),
+                ('active', models.IntegerField(default=0, verbose_name='active')),
+                ('inactive', models.IntegerField(default=0, verbose_name='inactive')),
+                ('incident', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='incidents.Incident', verbose_name='incident')),
+            ],
+            options={
+                'verbose_name': 'incident activity counter',
+                'verbose_name_plural': 'incident activity counters',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='incidentactivitycounter',
+            unique_together=set([('kind', 'incident')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='businesslineactivitycounter',
+            unique_together=set([('kind', 'business_line')]),
+        ),
+        migrations.RunPython(build_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import ipaddress
+import re
+
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+IPV4_MAPPED = ipaddress.ip_network('::ffff:0:0/96')
+
+
+def normalize(value):
+    """ Deduplication key of a block value, as computed when this migration was written
+    """
+    value = value.strip()
+    try:
+        if '/' in value:
+            network = ipaddress.ip_network(value, strict=False)
+            if network.version == 6 and network.prefixlen >= 96 and network.network_address in IPV4_MAPPED:
+                address = ipaddress.IPv4Address(int(network.network_address) & 0xffffffff)
+                network = ipaddress.ip_network('{}/{}'.format(address, network.prefixlen - 96))
+            return network.compressed
+        address = ipaddress.ip_address(value)
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        return address.compressed
+    except ValueError:
+        pass
+    if '://' in value:
+        # Only the scheme and the host of an URL are case insensitive
+        scheme, rest = value.split('://', 1)
+        authority = re.match(r'[^/?#]*', rest).group(0)
+        userinfo, at, host = authority.rpartition('@')
+        return '{}://{}{}{}{}'.format(scheme.lower(), userinfo, at, host.lower(), rest[len(authority):])
+    value = value.lower()
+    if value.endswith('.') and '.' in value[:-1]:
+        value = value.rstrip('.')
+    return value
+
+
+def backfill_normalized_what(apps, schema_editor):
+    """ Set the normalized value of every block, the lowest id of a group of duplicates keeps the key and the others
+    are left NULL
+    """
+    Block = apps.get_model('fir_actions', 'Block')
+
+    def flush(keys):
+        Block.objects.filter(pk__in=list(keys)).update(normalized_what=models.Case(
+            *[models.When(pk=pk, then=models.Value(key)) for pk, key in keys.items()],
+            output_field=models.CharField()))
+        keys.clear()
+
+    seen = set()
+    keys = {}
+    blocks = Block.objects.order_by('pk').values_list('pk', 'where_id', 'how_id', 'what')
+    for pk, where_id, how_id, what in blocks.iterator():
+        key = normalize(what)
+        if (where_id, how_id, key) in seen:
+            continue
+        seen.add((where_id, how_id, key))
+        keys[pk] = key
+        if len(keys) >= BATCH_SIZE:
+            flush(keys)
+    if keys:
+        flush(keys)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_actions', '0013_activitycounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='block',
+            name='normalized_what',
+            field=models.CharField(editable=False, max_length=100, null=True, verbose_name='normalized value'),
+        ),
+        migrations.RunPython(backfill_normalized_what, migrations.RunPython.noop),
+    ]
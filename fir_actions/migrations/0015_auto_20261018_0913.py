@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_actions', '0014_block_normalized_what'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='block',
+            unique_together=set([('where', 'how', 'normalized_what')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('incidents', '0009_add_incicent_permissions'),
+        ('fir_actions', '0015_auto_20261018_0913'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActionDigest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField(default=datetime.datetime.now, verbose_name='date')),
+                ('event', models.CharField(max_length=60, verbose_name='event')),
+                ('actions', models.ManyToManyField(related_name='_actiondigest_actions_+', to='fir_actions.Action', verbose_name='actions')),
+                ('business_line', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='incidents.BusinessLine', verbose_name='business line')),
+            ],
+            options={
+                'verbose_name': 'action digest',
+                'verbose_name_plural': 'action digests',
+            },
+        ),
+    ]
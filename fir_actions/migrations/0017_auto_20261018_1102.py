@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Partial indexes on the active actions and blocks (same states as the list views), for the backends supporting them
+ACTIVE_ACTIONS = "state IN ('created', 'assigned', 'blocked')"
+ACTIVE_BLOCKS = "state IN ('enforced', 'deletion_proposed', 'deletion_approved')"
+PARTIAL_INDEXES = (
+    ('fir_actions_action_active', 'fir_actions_action', ('incident_id', 'opened_on'), ACTIVE_ACTIONS),
+    ('fir_actions_action_active_bl', 'fir_actions_action', ('business_line_id', 'opened_on'), ACTIVE_ACTIONS),
+    ('fir_actions_block_active', 'fir_actions_block', ('where_id', 'how_id'), ACTIVE_BLOCKS),
+)
+
+
+def create_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    quote = schema_editor.quote_name
+    for name, table, columns, condition in PARTIAL_INDEXES:
+        schema_editor.execute('CREATE INDEX {} ON {} ({}) WHERE {}'.format(
+            quote(name), quote(table), ', '.join(quote(column) for column in columns), condition))
+
+
+def drop_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    for name, table, columns, condition in PARTIAL_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(schema_editor.quote_name(name)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_actions', '0016_actiondigest'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='action',
+            index_together=set([('business_line', 'state', 'opened_on'), ('incident', 'state', 'opened_on'), ('opened_on', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='block',
+            index_together=set([('where', 'state')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='blockchange',
+            index_together=set([('location', 'sequence')]),
+        ),
+        migrations.RunPython(create_partial_indexes, drop_partial_indexes),
+    ]
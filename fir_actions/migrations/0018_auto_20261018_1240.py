@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import ipaddress
+import re
+
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+HASH_LENGTHS = (32, 40, 64, 128)
+DOMAIN_RE = re.compile(r'^(?:\*\.)?(?:[a-z0-9_](?:[a-z0-9_-]{0,61}[a-z0-9])?\.)+[a-z][a-z0-9-]{0,61}[a-z0-9]$')
+HEX_RE = re.compile(r'^[0-9a-f]+$')
+IPV4_MAPPED = ipaddress.ip_network('::ffff:0:0/96')
+
+
+def index_fields(what):
+    """ Type and range columns of a block value, as computed when this migration was written
+    """
+    fields = {'indicator_type': 'other', 'ip_version': None, 'range_start': None, 'range_end': None}
+    value = what.strip()
+    try:
+        if '/' in value:
+            network = ipaddress.ip_network(value, strict=False)
+            fields['indicator_type'] = 'network'
+        else:
+            network = ipaddress.ip_network(value)
+            fields['indicator_type'] = 'ip'
+        if network.version == 6 and network.prefixlen >= 96 and network.network_address in IPV4_MAPPED:
+            # IPv4-mapped IPv6 addresses and networks are typed as IPv4
+            address = ipaddress.IPv4Address(int(network.network_address) & 0xffffffff)
+            network = ipaddress.ip_network('{}/{}'.format(address, network.prefixlen - 96))
+        width = 8 if network.version == 4 else 32
+        fields.update(ip_version=network.version,
+                      range_start='{:0{width}x}'.format(int(network.network_address), width=width),
+                      range_end='{:0{width}x}'.format(int(network.broadcast_address), width=width))
+        return fields
+    except ValueError:
+        pass
+    value = value.lower()
+    if value.endswith('.') and '.' in value[:-1]:
+        value = value.rstrip('.')
+    if '://' in value:
+        fields['indicator_type'] = 'url'
+    elif len(value) in HASH_LENGTHS and HEX_RE.match(value):
+        fields['indicator_type'] = 'hash'
+    elif len(value) <= 253 and DOMAIN_RE.match(value):
+        fields['indicator_type'] = 'domain'
+    return fields
+
+
+def backfill_indicators(apps, schema_editor):
+    """ Type and range of every block value
+    """
+    Block = apps.get_model('fir_actions', 'Block')
+
+    def flush(rows):
+        for field in ('indicator_type', 'ip_version', 'range_start', 'range_end'):
+            Block.objects.filter(pk__in=list(rows)).update(**{field: models.Case(
+                *[models.When(pk=pk, then=models.Value(fields[field])) for pk, fields in rows.items()],
+                output_field=Block._meta.get_field(field))})
+        rows.clear()
+
+    rows = {}
+    blocks = Block.objects.order_by('pk').values_list('pk', 'what')
+    for pk, what in blocks.iterator():
+        rows[pk] = index_fields(what)
+        if len(rows) >= BATCH_SIZE:
+            flush(rows)
+    if rows:
+        flush(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_actions', '0017_auto_20261018_1102'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='block',
+            name='indicator_type',
+            field=models.CharField(choices=[('ip', 'IP address'), ('network', 'IP network'), ('domain', 'Domain'), ('url', 'URL'), ('hash', 'Hash'), ('other', 'Other')], default='other', editable=False, max_length=10, verbose_name='indicator type'),
+        ),
+        migrations.AddField(
+            model_name='block',
+            name='ip_version',
+            field=models.PositiveSmallIntegerField(editable=False, null=True, verbose_name='IP version'),
+        ),
+        migrations.AddField(
+            model_name='block',
+            name='range_end',
+            field=models.CharField(editable=False, max_length=32, null=True, verbose_name='range end'),
+        ),
+        migrations.AddField(
+            model_name='block',
+            name='range_start',
+            field=models.CharField(editable=False, max_length=32, null=True, verbose_name='range start'),
+        ),
+        migrations.RunPython(backfill_indicators, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.template import Context, Template
+
+BATCH_SIZE = 500
+
+
+def render_subjects(apps, schema_editor):
+    """ Markdown rendering of every action subject
+    """
+    Action = apps.get_model('fir_actions', 'Action')
+    template = Template('{% load markdown %}{{ subject|markdown }}')
+
+    def flush(rendered):
+        Action.objects.filter(pk__in=list(rendered)).update(subject_html=models.Case(
+            *[models.When(pk=pk, then=models.Value(html)) for pk, html in rendered.items()],
+            output_field=models.TextField()))
+        rendered.clear()
+
+    rendered = {}
+    actions = Action.objects.order_by('pk').values_list('pk', 'subject')
+    for pk, subject in actions.iterator():
+        rendered[pk] = template.render(Context({'subject': subject}))
+        if len(rendered) >= BATCH_SIZE:
+            flush(rendered)
+    if rendered:
+        flush(rendered)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_actions', '0018_auto_20261018_1240'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='action',
+            name='subject_html',
+            field=models.TextField(editable=False, null=True, verbose_name='rendered subject'),
+        ),
+        migrations.RunPython(render_subjects, migrations.RunPython.noop),
+    ]
@@ -1,16 +1,21 @@
 from __future__ import unicode_literals
 
-from django.db.models import Q
-from django.db.models.signals import post_save
+from django.db.models.signals import post_init, post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
-from django.template import Context
-from django.template import Template
+from django.template import Context, Template
+from django.utils.decorators import ContextDecorator
 from django.utils.encoding import python_2_unicode_compatible
 
 import datetime
-
-from django.db import models
-from django.contrib.auth.models import User
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection, models, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.contrib.auth.models import User, Group
 from django.utils.translation import ugettext_lazy as _
 from django_fsm import FSMField, transition
 from django_fsm.signals import post_transition
@@ -19,7 +24,15 @@ from fir_artifacts.models import Artifact
 from fir_plugins.models import link_to
 from incidents.authorization import tree_authorization
 
-from incidents.models import Incident, FIRModel, model_created, model_updated
+from incidents.models import Incident, BusinessLine, AccessControlEntry, FIRModel, model_created, model_updated
+
+from fir_actions import authorization, block_index, counters, fragments, notifications, tasks, transitions
+from fir_actions.action_templates import ActionTemplateIndex
+from fir_actions.comments import collect_action_comments, current_comment_buffer
+from fir_actions.indicators import INDICATOR_TYPES, index_fields, normalize
+from fir_actions.instrumentation import instrumented
+from fir_actions.signals import actions_created, action_notification, blocks_added
+from fir_actions.utils import batches, on_commit_once
 
 ACTION_TYPES = (
     ('investigation', _('Investigation')),
@@ -66,12 +79,29 @@ def fsm_actions(func):
 def action_permission(permission, obj_field='business_line'):
     def check_permission(instance, user):
         obj = getattr(instance, obj_field)
-        return user.has_perm(permission, obj=obj)
+        return authorization.has_perm(user, permission, obj=obj)
 
+    # Lets PermissionMatrix share the result between objects of the same business line
+    check_permission.permission = permission
+    check_permission.obj_field = obj_field
     return check_permission
 
 
+_subject_template = None
+
+
+def render_subject(subject):
+    """ Markdown rendering of an action subject, as displayed in the action lists
+    :return: html
+    """
+    global _subject_template
+    if _subject_template is None:
+        _subject_template = Template('{% load markdown %}{{ subject|markdown }}')
+    return _subject_template.render(Context({'subject': subject}))
+
+
 @python_2_unicode_compatible
+@transitions.register
 @tree_authorization('business_line')
 class Action(FIRModel, models.Model):
     opened_on = models.DateTimeField(default=datetime.datetime.now, blank=True, verbose_name=_('creation date'))
@@ -80,18 +110,29 @@ class Action(FIRModel, models.Model):
                                  verbose_name=_('incident'))
     type = models.CharField(max_length=20, choices=ACTION_TYPES, verbose_name=_('type'))
     subject = models.CharField(max_length=256, verbose_name=_('subject'))
+    subject_html = models.TextField(null=True, editable=False, verbose_name=_('rendered subject'))
     description = models.TextField(verbose_name=_('description'))
     business_line = models.ForeignKey('incidents.BusinessLine', null=True, blank=True, related_name='actions',
                                       verbose_name=_('business line'))
     state = FSMField(default='created', choices=ACTION_STATES, protected=True, verbose_name=_('state'))
     auto_state = models.BooleanField(default=False, verbose_name=_('auto state'))
 
-    class Meta:
-        verbose_name = _('action')
-
     def __str__(self):
         return self.subject
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Action, cls).from_db(db, field_names, values)
+        instance._rendered_subject = instance.__dict__.get('subject')
+        return instance
+
+    def save(self, *args, **kwargs):
+        subject = self.__dict__.get('subject')
+        if subject is not None and subject != getattr(self, '_rendered_subject', None):
+            self.subject_html = render_subject(subject)
+            self._rendered_subject = subject
+        super(Action, self).save(*args, **kwargs)
+
     @property
     def status_id(self):
         if not self.state == 'closed':
@@ -110,6 +151,11 @@ class Action(FIRModel, models.Model):
 
     class Meta:
         verbose_name = _('action')
+        index_together = [
+            ('business_line', 'state', 'opened_on'),
+            ('incident', 'state', 'opened_on'),
+            ('opened_on', 'id'),
+        ]
 
     @fsm_actions
     @transition('state', source=['created', ], target='assigned', custom={'verbose': _('Assign')})
@@ -168,6 +214,7 @@ class ActionComment(models.Model):
 
 
 @receiver(post_transition, sender=Action, dispatch_uid="action_post_transition_comment")
+@instrumented('receiver')
 def action_post_transition(sender, instance, name=None, source=None, target=None, **kwargs):
     if isinstance(instance, sender):
         comment = _('%(user)s changed state to %(state)s' % {
@@ -181,8 +228,12 @@ def action_post_transition(sender, instance, name=None, source=None, target=None
         if reason and len(reason):
             comment = "%s\n\n%s" % (comment, reason)
 
-        ActionComment.objects.create(action=instance, opened_by=instance.by,
-                                     comment=comment)
+        action_comment = ActionComment(action=instance, opened_by=instance.by, comment=comment)
+        buffer = current_comment_buffer()
+        if buffer is None:
+            action_comment.save()
+        else:
+            buffer.add(action_comment)
 
 
 @python_2_unicode_compatible
@@ -236,6 +287,8 @@ STATE_CHOICES = (
     ('deleted', _('Deleted'))
 )
 
+BLOCK_ACTIVE_STATES = ('enforced', 'deletion_proposed', 'deletion_approved')
+
 
 @python_2_unicode_compatible
 class BlockType(models.Model):
@@ -255,10 +308,18 @@ class BlockLocation(models.Model):
     name = models.CharField(max_length=69, verbose_name=_("name"))
     types = models.ManyToManyField(BlockType, related_name='locations', verbose_name=_('types'))
     business_line = models.ForeignKey('incidents.BusinessLine', verbose_name=_('business line'))
+    change_sequence = models.PositiveIntegerField(default=0, editable=False, verbose_name=_('last change'))
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # change_sequence is only written by publish_block_changes, a stale instance must not bring it back
+        if self.pk is not None and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name != 'change_sequence']
+        super(BlockLocation, self).save(*args, **kwargs)
+
     class Meta:
         verbose_name = _('block location')
         verbose_name_plural = _('block locations')
@@ -266,19 +327,29 @@ class BlockLocation(models.Model):
 
 def block_permission(permission):
     def check_permission(instance, user):
-        return user.has_perm(permission, obj=instance.where)
+        return authorization.has_perm(user, permission, obj=instance.where)
 
+    check_permission.permission = permission
+    check_permission.obj_field = 'where'
     return check_permission
 
 
 @python_2_unicode_compatible
+@transitions.register
 @link_to(Artifact)
 class Block(FIRModel, models.Model):
     where = models.ForeignKey(BlockLocation, related_name='blocks', verbose_name=_('where'))
     how = models.ForeignKey(BlockType, related_name='blocks', verbose_name=_('how'))
     what = models.CharField(max_length=100, verbose_name=_('what'))
+    normalized_what = models.CharField(max_length=100, null=True, editable=False, verbose_name=_('normalized value'))
+    indicator_type = models.CharField(max_length=10, choices=INDICATOR_TYPES, default='other', editable=False,
+                                      verbose_name=_('indicator type'))
+    ip_version = models.PositiveSmallIntegerField(null=True, editable=False, verbose_name=_('IP version'))
+    range_start = models.CharField(max_length=32, null=True, editable=False, verbose_name=_('range start'))
+    range_end = models.CharField(max_length=32, null=True, editable=False, verbose_name=_('range end'))
     state = FSMField(default='proposed', choices=STATE_CHOICES, protected=True, verbose_name=_('state'))
     comment = models.TextField(verbose_name=_('comment'), blank=True, null=True)
+    updated_on = models.DateTimeField(auto_now=True, verbose_name=_('last update'))
 
     incidents = models.ManyToManyField('incidents.Incident', blank=True, verbose_name=_('incidents'),
                                        related_name='blocks')
@@ -288,9 +359,39 @@ class Block(FIRModel, models.Model):
     def __str__(self):
         return "{} on {}: {}".format(self.how, self.where, self.what)
 
+    def _normalized_key(self):
+        # Duplicates left over from before normalization keep a NULL key
+        if self.pk is None or self.normalized_what is not None:
+            return normalize(self.what)
+        return None
+
+    def validate_unique(self, exclude=None):
+        """ Also check the (where, how, normalized value) uniqueness: normalized_what is not editable, so model forms
+        leave it out of the unique checks
+        :return: None
+        """
+        super(Block, self).validate_unique(exclude=exclude)
+        exclude = exclude or []
+        if 'what' in exclude or 'where' in exclude or 'how' in exclude or self.where_id is None or \
+                self.how_id is None or not self.what:
+            return
+        key = self._normalized_key()
+        if key is not None and Block.objects.filter(where_id=self.where_id, how_id=self.how_id, normalized_what=key)\
+                .exclude(pk=self.pk).exists():
+            raise ValidationError({'what': _('A block with the same value already exists on this location with this '
+                                             'type.')}, code='unique')
+
+    def save(self, *args, **kwargs):
+        self.normalized_what = self._normalized_key()
+        for name, value in index_fields(self.what).items():
+            setattr(self, name, value)
+        with transaction.atomic():
+            super(Block, self).save(*args, **kwargs)
+            record_block_change(self)
+
     @property
     def status_id(self):
-        if self.state in ['enforced', 'deletion_proposed', 'deletion_approved']:
+        if self.state in BLOCK_ACTIVE_STATES:
             return 1
         return 0
 
@@ -307,15 +408,8 @@ class Block(FIRModel, models.Model):
         """ Approve this block
         :return: None
         """
-        for incident in self.incidents.all():
-            action = Action.objects.create(incident=incident, type='countermeasure',
-                                           subject=_('Enforce block B#%(block_id)s on %(block_location)s' % {
-                                               'block_id': self.id, 'block_location': self.where}, ),
-                                           description=self.comment, auto_state=True,
-                                           business_line=self.where.business_line, opened_by=by)
-            action.assign(by=by)
-            action.save()
-            self.actions.add(action)
+        self._open_actions(_('Enforce block B#%(block_id)s on %(block_location)s' % {
+            'block_id': self.id, 'block_location': self.where}), by=by)
 
     @transition('state', source=['proposed', 'approved'], target='refused',
                 permission=block_permission('fir_actions.can_approve_block'), custom={'verbose': _('Refuse')})
@@ -323,9 +417,8 @@ class Block(FIRModel, models.Model):
         """ Refuse the block
         :return:
         """
-        for action in self.actions.exclude(state='closed'):
-            action.close(_('Block B#%(block_id)s refused.' % {'block_id': self.id}), by=by)
-            action.save()
+        self._cascade('close', ['assigned', 'blocked'], _('Block B#%(block_id)s refused.' % {'block_id': self.id}),
+                      by=by)
 
     @transition('state', source=['approved', 'blocked'], target='enforced',
                 permission=block_permission('fir_actions.can_enforce_block'),
@@ -334,9 +427,8 @@ class Block(FIRModel, models.Model):
         """ Enforce this block on the target device
         :return:
         """
-        for action in self.actions.filter(state__in=['assigned', 'blocked']):
-            action.close(_('Block B#%(block_id)s enforced.' % {'block_id': self.id}), by=by)
-            action.save()
+        self._cascade('close', ['assigned', 'blocked'], _('Block B#%(block_id)s enforced.' % {'block_id': self.id}),
+                      by=by)
 
     @transition('state', source='approved', target='blocked',
                 permission=block_permission('fir_actions.can_enforce_block'), custom={'verbose': _('Report block')})
@@ -344,9 +436,7 @@ class Block(FIRModel, models.Model):
         """ Report a problem
         :return:
         """
-        for action in self.actions.filter(state='assigned'):
-            action.block(comment, by=by)
-            action.save()
+        self._cascade('block', ['assigned'], comment, by=by)
 
     @transition('state', source=['blocked', ], target='approved',
                 permission=block_permission('fir_actions.can_approve_block'), custom={'verbose': _('Unblock')})
@@ -354,9 +444,7 @@ class Block(FIRModel, models.Model):
         """ Remove problem
         :return: None
         """
-        for action in self.actions.filter(state='blocked'):
-            action.unblock(comment, by=by)
-            action.save()
+        self._cascade('unblock', ['blocked'], comment, by=by)
 
     @transition('state', source='enforced', target='deletion_proposed',
                 permission=block_permission('incidents.handle_incidents'), custom={'verbose': _('Propose deletion')})
@@ -371,15 +459,8 @@ class Block(FIRModel, models.Model):
         """ Approve the deletion of the block
         :return:
         """
-        for incident in self.incidents.all():
-            action = Action.objects.create(incident=incident, type='countermeasure',
-                                           subject=_('Remove block B#%(block_id)s on %(block_location)s' % {
-                                               'block_id': self.id, 'block_location': self.where}, ),
-                                           description=self.comment, auto_state=True,
-                                           business_line=self.where.business_line, opened_by=by)
-            action.assign(by=by)
-            action.save()
-            self.actions.add(action)
+        self._open_actions(_('Remove block B#%(block_id)s on %(block_location)s' % {
+            'block_id': self.id, 'block_location': self.where}), by=by)
 
     @transition('state', source='deletion_proposed', target='enforced',
                 permission=block_permission('fir_actions.can_approve_block'), custom={'verbose': _('Refuse deletion')})
@@ -394,9 +475,8 @@ class Block(FIRModel, models.Model):
         """ Remove block from device
         :return:
         """
-        for action in self.actions.exclude(state='closed'):
-            action.close(_('Block B#%(block_id)s removed.' % {'block_id': self.id}), by=by)
-            action.save()
+        self._cascade('close', ['assigned', 'blocked'], _('Block B#%(block_id)s removed.' % {'block_id': self.id}),
+                      by=by)
 
     @transition('state', source='deleted', target='proposed',
                 permission=block_permission('incidents.view_incidents'), custom={'verbose': _('Propose')})
@@ -405,93 +485,811 @@ class Block(FIRModel, models.Model):
         :return:
         """
 
+    @instrumented('operation', 'Block._open_actions')
+    def _open_actions(self, subject, by=None):
+        """ Create an assigned countermeasure action in each incident of the block
+        Concerned business lines, actions, their comments and links to the block are written with one query each
+        :return: None
+        """
+        incident_ids = [incident.pk for incident in self.incidents.all()]
+        if not incident_ids:
+            return
+        business_line = self.where.business_line
+
+        field = Incident._meta.get_field('concerned_business_lines')
+        incident_column = '{}_id'.format(field.m2m_field_name())
+        business_line_column = '{}_id'.format(field.m2m_reverse_field_name())
+        through = Incident.concerned_business_lines.through
+        concerned = set(through.objects.filter(**{business_line_column: business_line.pk,
+                                                  incident_column + '__in': incident_ids})
+                        .values_list(incident_column, flat=True))
+        missing = [pk for pk in incident_ids if pk not in concerned]
+        through.objects.bulk_create([through(**{incident_column: pk, business_line_column: business_line.pk})
+                                     for pk in missing])
+
+        # The incident rows themselves are left untouched: only their concerned business lines changed
+        incidents = dict((incident.pk, incident) for incident in
+                         Incident.objects.filter(pk__in=incident_ids).prefetch_related('concerned_business_lines'))
+
+        actions = bulk_create_actions([Action(incident=incidents[pk], type='countermeasure', subject=subject,
+                                              description=self.comment or '', auto_state=True,
+                                              business_line=business_line, opened_by=by)
+                                       for pk in incident_ids])
+        with collect_action_comments(), counters.batch_counters():
+            for action in actions:
+                action.incident = incidents[action.incident_id]
+                action.business_line = business_line
+                action.assign(by=by)
+        Action.objects.filter(pk__in=[action.pk for action in actions]).update(state='assigned')
+        self.actions.add(*actions)
+        actions_created.send(sender=Action, instances=actions, incident=None)
+
+    def _cascade(self, transition_name, states, comment=None, by=None):
+        """ Apply a transition to the actions of the block in the given states, at once or when the current
+        collect_block_cascades block exits
+        :return: None
+        """
+        stack = getattr(_cascades, 'stack', None)
+        if stack:
+            stack[-1].append((self, transition_name, tuple(states), comment, by))
+        else:
+            cascade_actions([(self, transition_name, tuple(states), comment, by)])
+
     def refresh_artifacts(self):
-        data = self.what
-        found_artifacts = artifacts.find(data)
+        self.refresh_artifacts_bulk([self])
+
+    @classmethod
+    @instrumented('operation', 'Block.refresh_artifacts_bulk')
+    def refresh_artifacts_bulk(cls, blocks):
+        """ Extract the artifacts of a list of blocks and link them
+        :return: None
+        """
+        found = OrderedDict()
+        for block in blocks:
+            found_artifacts = artifacts.find(block.what)
+            for key in found_artifacts:
+                for value in found_artifacts[key]:
+                    linked = found.setdefault((key, value), [])
+                    if block not in linked:
+                        linked.append(block)
+        if not found:
+            return
+
+        def fetch(pairs):
+            db_artifacts = {}
+            for batch in batches(set(value for key, value in pairs), 'value'):
+                for a in Artifact.objects.filter(value__in=batch).order_by('-pk'):
+                    if (a.type, a.value) in pairs:
+                        db_artifacts[(a.type, a.value)] = a
+            return db_artifacts
+
+        db_artifacts = fetch(found)
+        new_artifacts = [a for a in found if a not in db_artifacts]
+        if new_artifacts:
+            Artifact.objects.bulk_create([Artifact(type=a[0], value=a[1]) for a in new_artifacts])
+            db_artifacts.update(fetch(new_artifacts))
+
+        through = cls.artifacts.through
+        links = set()
+        for a in found:
+            for block in found[a]:
+                links.add((block.pk, db_artifacts[a].pk))
+        for batch in batches(set(block.pk for block in blocks)):
+            existing = through.objects.filter(block_id__in=batch).values_list('block_id', 'artifact_id')
+            links.difference_update(existing)
+        through.objects.bulk_create([through(block_id=block_id, artifact_id=artifact_id)
+                                     for block_id, artifact_id in links])
+
+        for a in found:
+            artifacts.after_save(a[0], a[1], found[a][0])
 
-        artifact_list = []
-        for key in found_artifacts:
-            for a in found_artifacts[key]:
-                artifact_list.append((key, a))
+    class Meta:
+        verbose_name = _('block')
+        unique_together = (('where', 'how', 'normalized_what'), )
+        index_together = (('where', 'state'), )
+        permissions = (
+            ('can_approve_block', 'Can approve block'),
+            ('can_enforce_block', 'Can enforce block')
+        )
 
-        db_artifacts = Artifact.objects.filter(value__in=[a[1] for a in artifact_list])
 
-        exist = []
+@instrumented('operation', 'Block._cascade')
+def cascade_actions(cascades):
+    """ Apply the transitions requested by blocks on their actions, a list of (block, transition name, states,
+    comment, by). The actions of all the blocks are loaded with one query, and their states and comments are written
+    with one query each. An action shared by several blocks follows the first one.
+    :return: None
+    """
+    requests = OrderedDict()
+    for block, transition_name, states, comment, by in cascades:
+        requests.setdefault((transition_name, states), OrderedDict()).setdefault(block.pk, (comment, by))
+    through = Block.actions.through
+    for (transition_name, states), blocks in requests.items():
+        block_of = {}
+        for batch in batches(list(blocks)):
+            for action_id, block_id in through.objects.filter(block_id__in=batch, action__state__in=states)\
+                    .order_by('pk').values_list('action_id', 'block_id'):
+                block_of.setdefault(action_id, block_id)
+        actions = []
+        for batch in batches(list(block_of)):
+            actions.extend(Action.objects.filter(pk__in=batch).select_related('business_line'))
+        if not actions:
+            continue
+        with collect_action_comments(), counters.batch_counters():
+            for action in actions:
+                comment, by = blocks[block_of[action.pk]]
+                getattr(action, transition_name)(comment, by=by)
+            for batch in batches(actions):
+                Action.objects.filter(pk__in=[action.pk for action in batch]).update(state=actions[0].state)
+            count_actions(actions)
+
+
+_cascades = threading.local()
+
+
+class BlockCascades(ContextDecorator):
+    """ Collect the action cascades of block transitions and apply them together when the outermost block exits
+    without error. A nested block behaves like a savepoint: its cascades are handed to the outer block on success and
+    dropped on error.
+    """
+
+    def __enter__(self):
+        if not hasattr(_cascades, 'stack'):
+            _cascades.stack = []
+        _cascades.stack.append([])
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        cascades = _cascades.stack.pop()
+        if exc_type is not None:
+            return
+        if _cascades.stack:
+            _cascades.stack[-1].extend(cascades)
+        elif cascades:
+            cascade_actions(cascades)
+
+
+def collect_block_cascades():
+    return BlockCascades()
+
+
+class BlockChange(models.Model):
+    """ Append-only log of the blocks entering or leaving the active set of a location
+    `sequence` numbers the changes of a location in the order their transactions committed, it is NULL until then
+    """
+    sequence = models.PositiveIntegerField(null=True, editable=False, verbose_name=_('sequence'))
+    date = models.DateTimeField(default=datetime.datetime.now, db_index=True, verbose_name=_('date'))
+    location = models.ForeignKey(BlockLocation, related_name='changes', verbose_name=_('where'))
+    block = models.ForeignKey(Block, null=True, on_delete=models.SET_NULL, related_name='changes',
+                              verbose_name=_('block'))
+    how = models.ForeignKey(BlockType, related_name='+', verbose_name=_('how'))
+    what = models.CharField(max_length=100, verbose_name=_('what'))
+    state = models.CharField(max_length=50, choices=STATE_CHOICES, verbose_name=_('state'))
+    active = models.BooleanField(verbose_name=_('active'))
 
-        for a in db_artifacts:
-            exist.append((a.type, a.value))
-            if self not in a.incidents.all():
-                a.blocks.add(self)
+    class Meta:
+        verbose_name = _('block change')
+        verbose_name_plural = _('block changes')
+        index_together = (('location', 'sequence'), )
+
+
+@receiver(post_transition, sender=Block, dispatch_uid="block_post_transition_change")
+@instrumented('receiver')
+def block_post_transition(sender, instance, name=None, source=None, target=None, **kwargs):
+    # The change is written when the block is saved, against the state it had when last saved
+    if isinstance(instance, sender) and not hasattr(instance, '_change_source_active'):
+        instance._change_source_active = source in BLOCK_ACTIVE_STATES
+
+
+@receiver(post_init, sender=Block, dispatch_uid="block_change_init")
+def block_change_init(sender, instance, **kwargs):
+    if instance.pk is not None and all(name in instance.__dict__ for name in ('where_id', 'how_id', 'what')):
+        instance._change_entry = (instance.where_id, instance.how_id, instance.what)
+
+
+def _log_block_change(entry, block, state, active):
+    location_id, how_id, what = entry
+    BlockChange.objects.create(location_id=location_id, block=block, how_id=how_id, what=what, state=state,
+                               active=active)
+    on_commit_once(publish_block_changes, location_id)
+
+
+def record_block_change(block):
+    """ Log the block in the changes of its location, in the transaction saving it, if it entered or left the
+    active set since it was last saved. An active block moved to another location, type or value leaves the active
+    set of its previous entry.
+    :return: None
+    """
+    active = block.state in BLOCK_ACTIVE_STATES
+    source_active = block.__dict__.pop('_change_source_active', active)
+    entry = (block.where_id, block.how_id, block.what)
+    previous = block.__dict__.get('_change_entry', entry)
+    if source_active and previous != entry:
+        _log_block_change(previous, block, block.state, False)
+        if active:
+            _log_block_change(entry, block, block.state, True)
+    elif active != source_active:
+        _log_block_change(entry, block, block.state, active)
+    block._change_entry = entry
+
+
+@receiver(pre_delete, sender=Block, dispatch_uid="block_change_delete")
+@instrumented('receiver')
+def record_block_deletion(sender, instance, **kwargs):
+    # The block link of the change would outlive the row, it is left empty
+    active = instance.__dict__.get('_change_source_active', instance.state in BLOCK_ACTIVE_STATES)
+    if active:
+        entry = instance.__dict__.get('_change_entry', (instance.where_id, instance.how_id, instance.what))
+        _log_block_change(entry, None, instance.state, False)
+
+
+def publish_block_changes(location_id):
+    """ Number the committed changes of a location which have no sequence yet
+    The location row is locked while numbering, so the sequences follow the commit order of the numbering
+    transactions and a reader never sees a sequence before a lower one.
+    :return: number of changes published
+    """
+    with transaction.atomic():
+        last = BlockLocation.objects.select_for_update().filter(pk=location_id)\
+            .values_list('change_sequence', flat=True).first()
+        if last is None:
+            return 0
+        ids = list(BlockChange.objects.filter(location_id=location_id, sequence__isnull=True).order_by('id')
+                   .values_list('id', flat=True))
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            BlockChange.objects.filter(pk__in=batch).update(sequence=Case(
+                *[When(pk=pk, then=Value(last + start + i + 1)) for i, pk in enumerate(batch)],
+                output_field=IntegerField()))
+        if ids:
+            BlockLocation.objects.filter(pk=location_id).update(change_sequence=F('change_sequence') + len(ids))
+    return len(ids)
+
+
+def prune_block_changes(before):
+    """ Delete the block changes older than a date
+    :return: number of changes deleted
+    """
+    deleted = 0
+    while True:
+        ids = list(BlockChange.objects.filter(date__lt=before).values_list('id', flat=True)[:5000])
+        if not ids:
+            return deleted
+        deleted += BlockChange.objects.filter(pk__in=ids).delete()[0]
+
+
+class ActivityCounter(models.Model):
+    """ Number of active and inactive actions or blocks
+    Maintained by signal receivers, rebuilt with the rebuild_activity_counters command
+    """
+    kind = models.CharField(max_length=10, choices=((counters.ACTION, _('Actions')), (counters.BLOCK, _('Blocks'))),
+                            verbose_name=_('kind'))
+    active = models.IntegerField(default=0, verbose_name=_('active'))
+    inactive = models.IntegerField(default=0, verbose_name=_('inactive'))
 
-        new_artifacts = list(set(artifact_list) - set(exist))
-        all_artifacts = list(set(artifact_list))
+    class Meta:
+        abstract = True
 
-        for a in new_artifacts:
-            new = Artifact(type=a[0], value=a[1])
-            new.save()
-            new.blocks.add(self)
 
-        for a in all_artifacts:
-            artifacts.after_save(a[0], a[1], self)
+class IncidentActivityCounter(ActivityCounter):
+    """ Number of active and inactive actions or blocks of an incident
+    """
+    incident = models.ForeignKey('incidents.Incident', related_name='+', verbose_name=_('incident'))
 
     class Meta:
-        verbose_name = _('block')
-        permissions = (
-            ('can_approve_block', 'Can approve block'),
-            ('can_enforce_block', 'Can enforce block')
-        )
+        verbose_name = _('incident activity counter')
+        verbose_name_plural = _('incident activity counters')
+        unique_together = (('kind', 'incident'), )
 
 
-def get_action_templates(category, detection, plan, bl):
-    results = []
+class BusinessLineActivityCounter(ActivityCounter):
+    """ Number of active and inactive actions or blocks of a business line
+    """
+    business_line = models.ForeignKey('incidents.BusinessLine', related_name='+', verbose_name=_('business line'))
 
-    q = Q(category=category) | Q(category__isnull=True)
-    q &= Q(detection=detection) | Q(detection__isnull=True)
-    q &= Q(plan=plan) | Q(plan__isnull=True)
-    q &= Q(business_lines=bl) | Q(business_lines__isnull=True)
-    results += ActionList.objects.filter(q)
-    if not bl.is_root():
-        results += get_action_templates(category, detection, plan, bl.get_parent())
+    class Meta:
+        verbose_name = _('business line activity counter')
+        verbose_name_plural = _('business line activity counters')
+        unique_together = (('kind', 'business_line'), )
 
-    return results
+
+def _action_scope(action):
+    return action.__dict__.get('incident_id'), action.__dict__.get('business_line_id'), action.state != 'closed'
+
+
+def _count_action(scope, delta):
+    incident_id, business_line_id, active = scope
+    counters.record(counters.ACTION, active, [incident_id], [business_line_id], delta)
+
+
+def _move_action(action, scope):
+    counted = getattr(action, '_counted_scope', None)
+    if counted != scope:
+        if counted is not None:
+            _count_action(counted, -1)
+        _count_action(scope, 1)
+    action._counted_scope = scope
+
+
+@receiver(post_init, sender=Action, dispatch_uid="action_counters_init")
+def action_counters_init(sender, instance, **kwargs):
+    if instance.pk is not None and 'state' in instance.__dict__:
+        instance._counted_scope = _action_scope(instance)
+
+
+def count_actions(actions):
+    """ Count the changes of actions saved with a queryset update, which sends no post_save
+    :return: None
+    """
+    with counters.batch_counters():
+        for action in actions:
+            if hasattr(action, '_counted_scope'):
+                _move_action(action, _action_scope(action))
+
+
+@receiver(post_save, sender=Action, dispatch_uid="action_counters_save")
+@instrumented('receiver')
+def action_counters_save(sender, instance, created=False, **kwargs):
+    if created or hasattr(instance, '_counted_scope'):
+        _move_action(instance, _action_scope(instance))
+
+
+@receiver(actions_created, sender=Action, dispatch_uid="action_counters_created")
+@instrumented('receiver')
+def action_counters_created(sender, instances=(), **kwargs):
+    with counters.batch_counters():
+        for action in instances:
+            action._counted_scope = None
+            _move_action(action, _action_scope(action))
+
+
+@receiver(post_delete, sender=Action, dispatch_uid="action_counters_delete")
+@instrumented('receiver')
+def action_counters_delete(sender, instance, **kwargs):
+    _count_action(getattr(instance, '_counted_scope', None) or _action_scope(instance), -1)
+
+
+def _block_business_line(location_id):
+    return BlockLocation.objects.filter(pk=location_id).values_list('business_line_id', flat=True).first()
+
+
+def _count_blocks(blocks, delta, incidents=None, business_line=True):
+    """ Count blocks in or out of their incidents (all of them when `incidents` is None) and, unless
+    `business_line` is False, of the business line of their location
+    """
+    business_lines = {}
+    with counters.batch_counters():
+        for block in blocks:
+            if business_line and block.where_id not in business_lines:
+                business_lines[block.where_id] = _block_business_line(block.where_id)
+            incident_ids = incidents
+            if incident_ids is None:
+                incident_ids = block.incidents.values_list('pk', flat=True)
+            counters.record(counters.BLOCK, block.status_id == 1, incident_ids,
+                            [business_lines.get(block.where_id)], delta)
+
+
+@receiver(post_init, sender=Block, dispatch_uid="block_counters_init")
+def block_counters_init(sender, instance, **kwargs):
+    if instance.pk is not None and 'where_id' in instance.__dict__ and 'state' in instance.__dict__:
+        instance._counted_where = instance.where_id
+        instance._counted_active = instance.state in BLOCK_ACTIVE_STATES
+
+
+@receiver(post_transition, sender=Block, dispatch_uid="block_counters_transition")
+@instrumented('receiver')
+def block_counters_transition(sender, instance, source=None, **kwargs):
+    # The counters follow the block when it is saved, from the state it had when last saved
+    if isinstance(instance, sender) and instance.pk is not None and not hasattr(instance, '_counted_active'):
+        instance._counted_active = source in BLOCK_ACTIVE_STATES
+
+
+@receiver(post_save, sender=Block, dispatch_uid="block_counters_save")
+@instrumented('receiver')
+def block_counters_save(sender, instance, created=False, **kwargs):
+    active = instance.state in BLOCK_ACTIVE_STATES
+    if created:
+        _count_blocks([instance], 1, incidents=())
+    else:
+        counted_where = getattr(instance, '_counted_where', None) or instance.where_id
+        counted_active = getattr(instance, '_counted_active', active)
+        with counters.batch_counters():
+            if counted_active != active:
+                incident_ids = list(instance.incidents.values_list('pk', flat=True))
+                counters.record(counters.BLOCK, counted_active, incident_ids, delta=-1)
+                counters.record(counters.BLOCK, active, incident_ids)
+            if (counted_where, counted_active) != (instance.where_id, active):
+                counters.record(counters.BLOCK, counted_active, business_lines=[_block_business_line(counted_where)],
+                                delta=-1)
+                counters.record(counters.BLOCK, active, business_lines=[_block_business_line(instance.where_id)])
+    instance._counted_where = instance.where_id
+    instance._counted_active = active
+
+
+@receiver(blocks_added, sender=Block, dispatch_uid="block_counters_added")
+@instrumented('receiver')
+def block_counters_added(sender, incident=None, created=(), attached=(), **kwargs):
+    with counters.batch_counters():
+        _count_blocks(created, 1, incidents=())
+        _count_blocks(attached, 1, incidents=[incident.pk], business_line=False)
+
+
+@receiver(pre_delete, sender=Block, dispatch_uid="block_counters_delete")
+@instrumented('receiver')
+def block_counters_delete(sender, instance, **kwargs):
+    _count_blocks([instance], -1)
+
+
+@receiver(m2m_changed, sender=Block.incidents.through, dispatch_uid="block_counters_incidents")
+@instrumented('receiver')
+def block_counters_incidents(sender, instance, action=None, reverse=False, pk_set=None, **kwargs):
+    if action == 'pre_clear':
+        if reverse:
+            instance._cleared_blocks = list(instance.blocks.only('id', 'where', 'state'))
+        else:
+            instance._cleared_incidents = list(instance.incidents.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        if reverse:
+            _count_blocks(instance.__dict__.pop('_cleared_blocks', []), -1, incidents=[instance.pk],
+                          business_line=False)
+        else:
+            counters.record(counters.BLOCK, instance.status_id == 1, instance.__dict__.pop('_cleared_incidents', []),
+                            delta=-1)
+    elif action in ('post_add', 'post_remove') and pk_set:
+        delta = 1 if action == 'post_add' else -1
+        if reverse:
+            _count_blocks(Block.objects.filter(pk__in=pk_set).only('id', 'where', 'state'), delta,
+                          incidents=[instance.pk], business_line=False)
+        else:
+            counters.record(counters.BLOCK, instance.status_id == 1, pk_set, delta=delta)
+
+
+action_template_index = ActionTemplateIndex(ActionList)
+
+
+@instrumented('operation')
+def get_action_templates(category, detection, plan, bl):
+    return action_template_index.get_lists(getattr(category, 'pk', None), getattr(detection, 'pk', None),
+                                           getattr(plan, 'pk', None), bl)
+
+
+@receiver(post_save, sender=ActionList, dispatch_uid="action_templates_invalidate_list")
+@receiver(post_delete, sender=ActionList, dispatch_uid="action_templates_invalidate_list_delete")
+@receiver(m2m_changed, sender=ActionList.actions.through, dispatch_uid="action_templates_invalidate_actions")
+@receiver(m2m_changed, sender=ActionList.business_lines.through,
+          dispatch_uid="action_templates_invalidate_business_lines")
+@receiver(post_save, sender=ActionTemplate, dispatch_uid="action_templates_invalidate_template")
+@receiver(post_delete, sender=ActionTemplate, dispatch_uid="action_templates_invalidate_template_delete")
+@receiver(post_save, sender=BusinessLine, dispatch_uid="action_templates_invalidate_business_line")
+@receiver(post_delete, sender=BusinessLine, dispatch_uid="action_templates_invalidate_business_line_delete")
+@instrumented('receiver')
+def invalidate_action_templates(sender, **kwargs):
+    action_template_index.invalidate()
+
+
+@receiver(post_save, sender=AccessControlEntry, dispatch_uid="authorization_invalidate_acl")
+@receiver(post_delete, sender=AccessControlEntry, dispatch_uid="authorization_invalidate_acl_delete")
+@receiver(m2m_changed, sender=Group.permissions.through, dispatch_uid="authorization_invalidate_role")
+@receiver(m2m_changed, sender=User.groups.through, dispatch_uid="authorization_invalidate_user_groups")
+@receiver(m2m_changed, sender=User.user_permissions.through, dispatch_uid="authorization_invalidate_user_permissions")
+@receiver(post_save, sender=BusinessLine, dispatch_uid="authorization_invalidate_business_line")
+@receiver(post_delete, sender=BusinessLine, dispatch_uid="authorization_invalidate_business_line_delete")
+@instrumented('receiver')
+def invalidate_authorizations(sender, **kwargs):
+    authorization.invalidate()
+
+
+@receiver(post_save, sender=ActionTemplate, dispatch_uid="action_templates_evict_compiled")
+@receiver(post_delete, sender=ActionTemplate, dispatch_uid="action_templates_evict_compiled_delete")
+@instrumented('receiver')
+def evict_compiled_action_template(sender, instance, **kwargs):
+    action_template_index.templates.evict(instance.pk)
+
+
+def bulk_create_actions(actions):
+    """ Insert a list of unsaved actions with one query per backend batch
+    :return: list of the saved actions, with their primary keys
+    """
+    if not actions:
+        return []
+    opened_on = datetime.datetime.now()
+    rendered = {}
+    for action in actions:
+        action.opened_on = opened_on
+        if action.subject not in rendered:
+            rendered[action.subject] = render_subject(action.subject)
+        action.subject_html = rendered[action.subject]
+    features = connection.features
+    if getattr(features, 'can_return_rows_from_bulk_insert', getattr(features, 'can_return_ids_from_bulk_insert',
+                                                                     False)):
+        return Action.objects.bulk_create(actions)
+
+    # The backend does not return the pks: the rows are inserted with a random token as rendered subject, which tells
+    # them apart from the ones inserted concurrently, then refetched and given their rendered subject
+    token = uuid.uuid4().hex
+    for action in actions:
+        action.subject_html = token
+    Action.objects.bulk_create(actions)
+    created = list(Action.objects.filter(incident_id__in=set(a.incident_id for a in actions), subject_html=token)
+                   .order_by('pk'))
+    for action in created:
+        action.subject_html = rendered[action.subject]
+    for start in range(0, len(created), 500):
+        batch = created[start:start + 500]
+        Action.objects.filter(pk__in=[action.pk for action in batch]).update(subject_html=Case(
+            *[When(pk=action.pk, then=Value(action.subject_html)) for action in batch],
+            output_field=models.TextField()))
+    return created
 
 
 @receiver(model_created, sender=Incident)
+@instrumented('receiver')
 def new_event(sender, instance, **kwargs):
     context = Context({'instance': instance})
+    actions = OrderedDict()
     for bl in instance.concerned_business_lines.all():
-        for template in get_action_templates(instance.category, instance.detection, instance.plan, bl):
+        for template in action_template_index.get_lists(instance.category_id, instance.detection_id,
+                                                        instance.plan_id, bl):
             for action in template.actions.all():
-                subject = Template(action.subject).render(context)
-                description = Template(action.description).render(context)
-                Action.objects.create(subject=subject, description=description, type=action.type,
-                                      incident=instance,
-                                      business_line=bl, opened_by=instance.opened_by)
+                if (action.pk, bl.pk) in actions:
+                    continue
+                subject, description = action_template_index.compile(action)
+                actions[(action.pk, bl.pk)] = Action(subject=subject.render(context),
+                                                     description=description.render(context),
+                                                     type=action.type, incident=instance,
+                                                     business_line=bl, opened_by=instance.opened_by)
+    if actions:
+        with transaction.atomic():
+            created = bulk_create_actions(list(actions.values()))
+            actions_created.send(sender=Action, instances=created, incident=instance)
+
+
+@tasks.task('fir_actions.refresh_artifacts')
+def refresh_artifacts_task(block_ids):
+    blocks = []
+    for batch in batches(block_ids):
+        blocks.extend(Block.objects.filter(pk__in=batch).only('id', 'what'))
+    Block.refresh_artifacts_bulk(blocks)
 
 
 @receiver(model_created, sender=Block)
+@instrumented('receiver')
 def refresh_block(sender, instance, **kwargs):
-    instance.refresh_artifacts()
+    tasks.defer('fir_actions.refresh_artifacts', [[instance.pk]], key=('fir_actions.refresh_artifacts', instance.pk))
+
+
+@receiver(post_save, sender=Block, dispatch_uid="block_index_save")
+@receiver(post_delete, sender=Block, dispatch_uid="block_index_delete")
+@instrumented('receiver')
+def update_block_index(sender, instance, **kwargs):
+    block_index.changed(instance.where_id, [instance.pk])
+    indexed = getattr(instance, '_indexed_where', None)
+    if indexed is not None and indexed != instance.where_id:
+        block_index.changed(indexed, [instance.pk])
+    instance._indexed_where = instance.where_id
+
+
+@receiver(post_init, sender=Block, dispatch_uid="block_index_init")
+def block_index_init(sender, instance, **kwargs):
+    if instance.pk is not None and 'where_id' in instance.__dict__:
+        instance._indexed_where = instance.where_id
+
+
+@receiver(blocks_added, sender=Block, dispatch_uid="block_index_added")
+@instrumented('receiver')
+def update_added_block_index(sender, created=(), **kwargs):
+    locations = {}
+    for block in created:
+        locations.setdefault(block.where_id, []).append(block.pk)
+    for location_id, pks in locations.items():
+        block_index.changed(location_id, pks)
+
+
+@receiver(blocks_added, sender=Block, dispatch_uid="block_refresh_added")
+@instrumented('receiver')
+def refresh_added_blocks(sender, created=None, **kwargs):
+    if created:
+        tasks.defer('fir_actions.refresh_artifacts', [[block.pk for block in created]])
+
+
+def _block_incident_ids(blocks):
+    """ Ids of the incidents of blocks, taken from their prefetched incidents when available
+    :return: set of incident ids
+    """
+    incident_ids = set()
+    missing = []
+    for block in blocks:
+        prefetched = getattr(block, '_prefetched_objects_cache', {}).get('incidents')
+        if prefetched is None:
+            missing.append(block.pk)
+        else:
+            incident_ids.update(incident.pk for incident in prefetched)
+    through = Block.incidents.through
+    for batch in batches(missing):
+        incident_ids.update(through.objects.filter(block_id__in=batch).values_list('incident_id', flat=True))
+    return incident_ids
+
+
+@receiver(post_save, sender=Action, dispatch_uid="fragments_action_save")
+@receiver(post_delete, sender=Action, dispatch_uid="fragments_action_delete")
+@receiver(post_transition, sender=Action, dispatch_uid="fragments_action_transition")
+@instrumented('receiver')
+def invalidate_action_fragments(sender, instance, **kwargs):
+    if fragments.cache_enabled() and isinstance(instance, sender):
+        fragments.invalidate_incident(instance.incident_id)
+
+
+@receiver(actions_created, sender=Action, dispatch_uid="fragments_actions_created")
+@instrumented('receiver')
+def invalidate_created_action_fragments(sender, instances=(), **kwargs):
+    if fragments.cache_enabled():
+        for incident_id in set(action.incident_id for action in instances):
+            fragments.invalidate_incident(incident_id)
+
+
+@receiver(post_save, sender=Block, dispatch_uid="fragments_block_save")
+@receiver(pre_delete, sender=Block, dispatch_uid="fragments_block_delete")
+@instrumented('receiver')
+def invalidate_block_fragments(sender, instance, created=False, **kwargs):
+    if fragments.cache_enabled() and not created:
+        for incident_id in _block_incident_ids([instance]):
+            fragments.invalidate_incident(incident_id)
+
+
+@receiver(m2m_changed, sender=Block.incidents.through, dispatch_uid="fragments_block_incidents")
+@instrumented('receiver')
+def invalidate_block_incidents_fragments(sender, instance, action=None, reverse=False, pk_set=None, **kwargs):
+    # The incidents of a block are listed in the fragments of all of them
+    if not fragments.cache_enabled() or action not in ('pre_clear', 'post_add', 'post_remove'):
+        return
+    if reverse:
+        blocks = Block.objects.filter(pk__in=pk_set) if pk_set else instance.blocks.all()
+        incident_ids = _block_incident_ids(blocks.only('id'))
+        incident_ids.add(instance.pk)
+    else:
+        incident_ids = _block_incident_ids([instance]) | set(pk_set or ())
+    for incident_id in incident_ids:
+        fragments.invalidate_incident(incident_id)
+
+
+@receiver(blocks_added, sender=Block, dispatch_uid="fragments_blocks_added")
+@instrumented('receiver')
+def invalidate_added_block_fragments(sender, incident=None, attached=(), **kwargs):
+    if fragments.cache_enabled():
+        for incident_id in _block_incident_ids(attached) | {incident.pk}:
+            fragments.invalidate_incident(incident_id)
+
+
+@receiver(post_save, sender=BusinessLine, dispatch_uid="fragments_business_line_save")
+@receiver(post_delete, sender=BusinessLine, dispatch_uid="fragments_business_line_delete")
+@receiver(post_save, sender=BlockLocation, dispatch_uid="fragments_location_save")
+@receiver(post_delete, sender=BlockLocation, dispatch_uid="fragments_location_delete")
+@receiver(post_save, sender=BlockType, dispatch_uid="fragments_type_save")
+@receiver(post_delete, sender=BlockType, dispatch_uid="fragments_type_delete")
+@instrumented('receiver')
+def invalidate_all_fragments(sender, **kwargs):
+    if fragments.cache_enabled():
+        fragments.invalidate_all()
+
+
+@python_2_unicode_compatible
+class ActionDigest(models.Model):
+    """ Group of actions notified at once to a business line, `event` holds the comma separated notified events
+    """
+    date = models.DateTimeField(default=datetime.datetime.now, verbose_name=_('date'))
+    event = models.CharField(max_length=60, verbose_name=_('event'))
+    business_line = models.ForeignKey('incidents.BusinessLine', related_name='+', verbose_name=_('business line'))
+    actions = models.ManyToManyField(Action, related_name='+', verbose_name=_('actions'))
+
+    def __str__(self):
+        return _('%(count)d actions') % {'count': self.actions.count()}
+
+    class Meta:
+        verbose_name = _('action digest')
+        verbose_name_plural = _('action digests')
+
+
+@receiver(post_transition, sender=Action, dispatch_uid="action_post_transition_notification")
+@instrumented('receiver')
+def action_post_transition_notification(sender, instance, target=None, **kwargs):
+    if notifications_enabled and isinstance(instance, sender) and instance.pk is not None and target != 'created':
+        notifications.notify('action:assigned' if target == 'assigned' else 'action:updated', instance)
+
+
+@tasks.task('fir_actions.notify_actions')
+def notify_actions(entries):
+    """ Send the notifications of a batch of (event, action id)
+    Recipients are resolved with one query. The actions notified together to a business line are grouped in one
+    ActionDigest (unless ACTIONS_NOTIFICATION_DIGEST is False), a single action is notified on its own: each of its
+    events is sent to all its business lines at once.
+    """
+    actions = {}
+    for batch in batches(set(action_id for event, action_id in entries)):
+        for action in Action.objects.filter(pk__in=batch).select_related('incident', 'business_line'):
+            actions[action.pk] = action
+
+    through = Incident.concerned_business_lines.through
+    field = Incident._meta.get_field('concerned_business_lines')
+    incident_column = '{}_id'.format(field.m2m_field_name())
+    business_line_column = '{}_id'.format(field.m2m_reverse_field_name())
+    concerned = {}
+    incident_ids = set(action.incident_id for action in actions.values() if action.incident_id)
+    for batch in batches(incident_ids):
+        for incident_id, business_line_id in through.objects.filter(**{incident_column + '__in': batch})\
+                .values_list(incident_column, business_line_column):
+            concerned.setdefault(incident_id, []).append(business_line_id)
+
+    recipients = OrderedDict()
+    for event, action_id in entries:
+        action = actions.get(action_id)
+        if action is None:
+            continue
+        if event == 'action:assigned':
+            business_lines = [action.business_line_id] if action.business_line_id else []
+        else:
+            business_lines = concerned.get(action.incident_id, [])
+        for business_line_id in business_lines:
+            notified = recipients.setdefault(business_line_id, OrderedDict())
+            notified.setdefault(action, set()).add(event)
+
+    digests = getattr(settings, 'ACTIONS_NOTIFICATION_DIGEST', True)
+    single = OrderedDict()
+    for business_line_id, notified in recipients.items():
+        if digests and len(notified) > 1:
+            events = set()
+            for action_events in notified.values():
+                events.update(action_events)
+            digest = ActionDigest.objects.create(event=','.join(sorted(events)), business_line_id=business_line_id)
+            digest.actions.add(*notified)
+            action_notification.send(sender=ActionDigest, instance=digest, event='action:digest',
+                                     business_lines=BusinessLine.objects.filter(pk=business_line_id))
+            continue
+        for action, action_events in notified.items():
+            for event in sorted(action_events):
+                single.setdefault((action, event), []).append(business_line_id)
+
+    for (action, event), business_line_ids in single.items():
+        action_notification.send(sender=Action, instance=action, event=event,
+                                 business_lines=BusinessLine.objects.filter(pk__in=business_line_ids))
+
+
+def prune_action_digests(before):
+    """ Delete the action digests older than a date
+    :return: number of digests deleted
+    """
+    deleted = 0
+    while True:
+        ids = list(ActionDigest.objects.filter(date__lt=before).values_list('id', flat=True)[:5000])
+        if not ids:
+            return deleted
+        ActionDigest.objects.filter(pk__in=ids).delete()
+        deleted += len(ids)
+
+
+notifications_enabled = False
 
 try:
     from fir_notifications.decorators import notification_event
-    from django_fsm.signals import post_transition
 
 
-    @notification_event('action:assigned', post_transition, Action, verbose_name=_('Action assigned'))
-    def action_assigned(sender, instance, **kwargs):
-        target = kwargs.get('target')
-        if target == 'assigned':
-            return instance, instance.business_line
+    @notification_event('action:assigned', action_notification, Action, verbose_name=_('Action assigned'))
+    def action_assigned(sender, instance, event=None, business_lines=None, **kwargs):
+        if event == 'action:assigned':
+            return instance, business_lines
         return None, None
 
 
-    @notification_event('action:updated', post_transition, Action, verbose_name=_('Action updated'))
-    def action_created(sender, instance, **kwargs):
-        target = kwargs.get('target')
-        if target not in ('assigned', 'created'):
-            return instance, instance.incident.concerned_business_lines.all()
+    @notification_event('action:updated', action_notification, Action, verbose_name=_('Action updated'))
+    def action_created(sender, instance, event=None, business_lines=None, **kwargs):
+        if event == 'action:updated':
+            return instance, business_lines
         return None, None
 
+
+    @notification_event('action:digest', action_notification, ActionDigest, verbose_name=_('Actions digest'))
+    def action_digest(sender, instance, business_lines=None, **kwargs):
+        return instance, business_lines
+
+    notifications_enabled = True
+
 except ImportError:
     pass
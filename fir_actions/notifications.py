@@ -0,0 +1,31 @@
+from django.db import connection
+
+from fir_actions import tasks
+from fir_actions.utils import on_commit_once, transaction_object
+
+
+class NotificationBatch(object):
+    """ Action notifications collected during a transaction, queued as one task when it commits
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, event, action_id):
+        if (event, action_id) not in self.entries:
+            self.entries.append((event, action_id))
+
+    def flush(self):
+        if self.entries:
+            tasks.defer('fir_actions.notify_actions', [self.entries])
+
+
+def notify(event, action):
+    """ Queue an action notification, sent with the others of the transaction once it commits
+    """
+    if connection.in_atomic_block:
+        batch = transaction_object('fir_actions.notifications', NotificationBatch)
+        batch.add(event, action.pk)
+        on_commit_once(batch.flush)
+    else:
+        tasks.defer('fir_actions.notify_actions', [[(event, action.pk)]])
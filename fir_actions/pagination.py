@@ -0,0 +1,64 @@
+import base64
+import binascii
+import datetime
+import json
+
+from django.db.models import Q
+
+
+def _dump(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def encode_cursor(values):
+    """ Build an opaque cursor from the key values of the last object of a page
+    """
+    return base64.urlsafe_b64encode(json.dumps([_dump(v) for v in values]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ Get back the key values stored in a cursor
+    :raises ValueError: on malformed cursors
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, UnicodeError, binascii.Error):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def keyset_page(queryset, keys, cursor=None, size=50):
+    """ Get a page of a queryset ordered on unique keys, starting after a cursor
+
+    Keys are field names, prefixed with '-' for a descending order, e.g. ('-opened_on', '-id').
+    No COUNT query is issued and the cost of a page does not depend on its depth.
+    :return: tuple (list of objects, cursor of the next page or None)
+    """
+    fields = [key.lstrip('-') for key in keys]
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != len(keys):
+            raise ValueError('Invalid cursor')
+        opts = queryset.model._meta
+        try:
+            values = [opts.get_field(field).to_python(value) for field, value in zip(fields, values)]
+        except Exception:
+            raise ValueError('Invalid cursor')
+        after = Q()
+        for i, key in enumerate(keys):
+            lookup = '{}__{}'.format(fields[i], 'lt' if key.startswith('-') else 'gt')
+            condition = Q(**{lookup: values[i]})
+            for field, value in zip(fields[:i], values[:i]):
+                condition &= Q(**{field: value})
+            after |= condition
+        queryset = queryset.filter(after)
+    objects = list(queryset.order_by(*keys)[:size + 1])
+    next_cursor = None
+    if len(objects) > size:
+        objects = objects[:size]
+        next_cursor = encode_cursor([getattr(objects[-1], field) for field in fields])
+    return objects, next_cursor
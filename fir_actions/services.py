@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import logging
+from collections import OrderedDict
+
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+from django_fsm import TransitionNotAllowed, can_proceed, has_transition_perm
+
+from fir_actions.comments import collect_action_comments
+from fir_actions.counters import batch_counters
+from fir_actions.indicators import index_fields, normalize
+from fir_actions import transitions
+from fir_actions.models import Action, Block, collect_block_cascades
+from fir_actions.signals import blocks_added
+from fir_actions.utils import batches
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_block_values(values):
+    """ Strip, drop empty lines and deduplicate (on their normalized form) a list of block values
+    :return: tuple (list of (key, value) in input order, number of skipped lines)
+    """
+    seen = set()
+    items = []
+    skipped = 0
+    for value in values:
+        value = value.strip()
+        key = normalize(value)
+        if not value or key in seen:
+            skipped += 1
+            continue
+        seen.add(key)
+        items.append((key, value))
+    return items, skipped
+
+
+def find_blocks(where, how, keys):
+    """ Fetch the blocks matching normalized keys on a location and a type
+    :return: dict key -> Block
+    """
+    found = {}
+    for batch in batches(keys, 'normalized_what'):
+        for block in Block.objects.filter(where=where, how=how, normalized_what__in=batch):
+            found[block.normalized_what] = block
+    return found
+
+
+def create_blocks(where, how, items, comment=None):
+    """ Insert the blocks of a list of (key, value), skipping those created concurrently
+    :return: dict key -> created Block
+    """
+    def build(key, value):
+        return Block(where=where, how=how, what=value, normalized_what=key, comment=comment, **index_fields(value))
+
+    inserted = [key for key, value in items]
+    try:
+        with transaction.atomic():
+            Block.objects.bulk_create([build(key, value) for key, value in items])
+    except IntegrityError:
+        inserted = []
+        for key, value in items:
+            try:
+                with transaction.atomic():
+                    Block.objects.bulk_create([build(key, value)])
+                inserted.append(key)
+            except IntegrityError:
+                pass
+    return find_blocks(where, how, inserted)
+
+
+def add_blocks(incident, where, how, values, comment=None, user=None):
+    """ Add a batch of blocks to an incident
+
+    Existing blocks (same location, type and normalized value) are reused, the missing ones are bulk
+    created and the incident is linked to all of them with a single insert. Everything runs in one transaction.
+    :return: dict summary of the batch
+    """
+    items, skipped = normalize_block_values(values)
+    summary = {'total': len(items) + skipped, 'skipped': skipped, 'created': 0, 'existing': 0,
+               'attached': 0, 'proposed': 0}
+    if not items:
+        return summary
+
+    with transaction.atomic():
+        blocks = find_blocks(where, how, [key for key, value in items])
+        summary['existing'] = len(blocks)
+
+        if blocks and comment:
+            for batch in batches(b.pk for b in blocks.values()):
+                Block.objects.filter(pk__in=batch).update(comment=comment, updated_on=timezone.now())
+
+        deleted = [b for b in blocks.values() if b.state == 'deleted']
+        if deleted and user is not None and has_transition_perm(deleted[0].propose, user):
+            for block in deleted:
+                if can_proceed(block.propose):
+                    block.propose()
+                    block.save()
+                    summary['proposed'] += 1
+
+        missing = [(key, value) for key, value in items if key not in blocks]
+        created = []
+        if missing:
+            new_blocks = create_blocks(where, how, missing, comment=comment)
+            created = list(new_blocks.values())
+            blocks.update(new_blocks)
+            summary['created'] = len(created)
+            lost = [key for key, value in missing if key not in new_blocks]
+            if lost:
+                concurrent = find_blocks(where, how, lost)
+                blocks.update(concurrent)
+                summary['existing'] += len(concurrent)
+
+        through = Block.incidents.through
+        linked = set()
+        for batch in batches(b.pk for b in blocks.values()):
+            linked.update(through.objects.filter(incident=incident, block_id__in=batch)
+                          .values_list('block_id', flat=True))
+        attached = [b for b in blocks.values() if b.pk not in linked]
+        through.objects.bulk_create([through(block_id=b.pk, incident_id=incident.pk) for b in attached])
+        summary['attached'] = len(attached)
+
+        blocks_added.send(sender=Block, incident=incident, created=created, attached=attached)
+
+    return summary
+
+
+# Per model: related objects loaded with the batch
+BULK_TRANSITIONS = {
+    Action: (('incident', 'business_line'), ()),
+    Block: (('where__business_line', ), ('incidents', )),
+}
+
+
+def bulk_transition(model, ids, transition_name, user, **kwargs):
+    """ Apply a transition to a list of actions or blocks
+
+    Objects are loaded with one query, the transitions are looked up in the model transition table, permissions
+    are checked once per business line or location and transitions are applied in one transaction, each in its own
+    savepoint. The actions cascaded by block transitions are updated together once every block is saved.
+    :return: OrderedDict id -> {'status': 'success'|'error', 'data': error message}
+    """
+    select_related, prefetch_related = BULK_TRANSITIONS[model]
+    table = transitions.tables[model]
+    matrix = transitions.PermissionMatrix(user)
+    results = OrderedDict()
+    objects = {}
+    for batch in batches(set(ids)):
+        for obj in model.objects.filter(pk__in=batch).select_related(*select_related)\
+                .prefetch_related(*prefetch_related):
+            objects[obj.pk] = obj
+
+    done = []
+    with transaction.atomic(), collect_action_comments(), batch_counters(), collect_block_cascades():
+        for pk in ids:
+            if pk in results:
+                continue
+            obj = objects.get(pk)
+            method = getattr(obj, transition_name, None) if not transition_name.startswith('_') else None
+            if obj is None:
+                results[pk] = {'status': 'error', 'data': _('Not found')}
+                continue
+            elif method is None or not hasattr(method, '_django_fsm'):
+                results[pk] = {'status': 'error', 'data': _('Unknown transition')}
+                continue
+            transition = table.get(obj.state, transition_name)
+            if transition is None or transition not in table.available(obj):
+                results[pk] = {'status': 'error', 'data': _('Transition not allowed')}
+            elif not matrix.has_perm(transition, obj):
+                results[pk] = {'status': 'error', 'data': _('Permission denied')}
+            else:
+                try:
+                    with transaction.atomic(), collect_action_comments(), batch_counters(), collect_block_cascades():
+                        method(by=user, **kwargs)
+                        obj.save()
+                except TransitionNotAllowed:
+                    results[pk] = {'status': 'error', 'data': _('Transition not allowed')}
+                except PermissionDenied:
+                    results[pk] = {'status': 'error', 'data': _('Permission denied')}
+                except ValidationError as e:
+                    results[pk] = {'status': 'error', 'data': ' '.join(e.messages)}
+                except Exception:
+                    logger.exception('Transition %s failed on %s %s', transition_name, model.__name__, pk)
+                    results[pk] = {'status': 'error', 'data': _('Transition failed')}
+                else:
+                    results[pk] = {'status': 'success'}
+                    done.append(obj)
+
+    for obj in done:
+        obj.done_updating()
+    return results
@@ -0,0 +1,12 @@
+from django.dispatch import Signal
+
+# Sent once per batch by the bulk block ingestion instead of one model_created per block.
+# `created` holds the new blocks, `attached` every block newly linked to `incident`.
+blocks_added = Signal(providing_args=['incident', 'created', 'attached'])
+
+# Sent once when a batch of actions has been bulk created, in place of per-row save signals.
+# `incident` is None when the actions belong to several incidents.
+actions_created = Signal(providing_args=['instances', 'incident'])
+
+# Sent from the notification task with the recipients already resolved, once per action or per digest of actions.
+action_notification = Signal(providing_args=['instance', 'event', 'business_lines'])
@@ -18,6 +18,7 @@ function update_async_actions(elt) {
 $(function() {
 	update_async_actions();
 	execute_load_async();
+	execute_load_keyset();
 });
 
 function ajax_action(elt, callback) {
@@ -43,6 +44,44 @@ function execute_load_async () {
   });
 }
 
+function execute_load_keyset () {
+  $('.load-keyset').each( function() {
+    load_keyset_page($(this), null);
+  });
+}
+
+function load_keyset_page (el, cursor) {
+	var params = {'html': 1};
+	if (cursor) {
+		params['cursor'] = cursor;
+	}
+	$.get(el.data('fetch-url'), params).done(function (data) {
+		var rows = $($.parseHTML($.trim(data.data)));
+		el.find('tbody').first().append(rows);
+		update_async_actions(rows);
+		el.find('.keyset-more').remove();
+		if (data.results.length) {
+			var widget = el.data('widget');
+			el.removeClass('hidden');
+			if (widget) {
+				$("#"+widget).removeClass('hidden');
+			}
+		}
+		if (data.next) {
+			if (el.data('stream')) {
+				load_keyset_page(el, data.next);
+			} else {
+				var more = $('<a href="#" class="keyset-more"></a>').text(el.data('more-label'));
+				more.on('click', function (e) {
+					e.preventDefault();
+					load_keyset_page(el, data.next);
+				});
+				el.append(more);
+			}
+		}
+	});
+}
+
 function modal_action(data) {
 	$("#action_modals").empty();
 	$("#action_modals").html(data);
@@ -0,0 +1,238 @@
+""" Deferred execution of slow post-save work (artifact extraction, enrichment hooks)
+
+Tasks are registered by name with the `task` decorator and queued with `defer`, once the current transaction commits.
+The backend is chosen with the ACTIONS_TASK_BACKEND setting:
+
+* 'thread' (default): in-process pool of ACTIONS_TASK_WORKERS threads (default: 2). Tasks are only kept in memory:
+  those still queued when the process exits are lost, and counted in a warning of the `fir_actions.tasks` logger.
+* 'sync': run tasks as soon as they are queued, for tests and debugging
+* dotted path to a class taking no argument and implementing `submit(name, args, key=None)`, to hand tasks to an
+  external queue. Its workers call `fir_actions.tasks.run(name, *args)`. `key` is the coalescing key of the task
+  (None when the task must not be coalesced): the queue should drop a task while another one with the same key is
+  waiting. Classes implementing `submit(name, args)` get no key.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.inspect import func_supports_parameter
+from django.utils.module_loading import import_string
+from django.utils.six.moves import queue
+
+from fir_actions.instrumentation import operation
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+
+def task(name):
+    """ Register a function as a deferrable task
+    """
+    def decorator(func):
+        registry[name] = func
+        return func
+
+    return decorator
+
+
+def run(name, *args):
+    """ Run a registered task
+    """
+    with operation('task', name):
+        return registry[name](*args)
+
+
+class Metrics(object):
+    """ Queue depth and lag (seconds between queuing and execution) of a backend
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.coalesced = 0
+        self.processed = 0
+        self.failed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.pending = {}
+
+    def enqueue(self, key):
+        """ Record a queued task, unless one with the same coalescing key is still waiting
+        :return: False if the task was coalesced
+        """
+        with self._lock:
+            if key is not None and key in self.pending:
+                self.coalesced += 1
+                return False
+            self.queued += 1
+            if key is not None:
+                self.pending[key] = time.time()
+            return True
+
+    def start(self, key, queued_at):
+        with self._lock:
+            if key is not None:
+                self.pending.pop(key, None)
+            self.last_lag = time.time() - queued_at
+            self.max_lag = max(self.max_lag, self.last_lag)
+
+    def done(self, failed=False):
+        with self._lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.processed += 1
+
+    def stats(self):
+        with self._lock:
+            return {'depth': self.queued - self.processed - self.failed, 'queued': self.queued,
+                    'coalesced': self.coalesced, 'processed': self.processed, 'failed': self.failed,
+                    'last_lag': self.last_lag, 'max_lag': self.max_lag}
+
+
+class SyncBackend(object):
+    """ Run tasks at once in the calling thread
+    """
+
+    def __init__(self):
+        self.metrics = Metrics()
+
+    def submit(self, name, args, key=None):
+        if self.metrics.enqueue(key):
+            self.execute(name, args, key, time.time())
+
+    def execute(self, name, args, key, queued_at):
+        self.metrics.start(key, queued_at)
+        try:
+            run(name, *args)
+        except Exception:
+            logger.exception('Task %s failed', name)
+            self.metrics.done(failed=True)
+        else:
+            self.metrics.done()
+
+
+class ThreadBackend(SyncBackend):
+    """ Run tasks in a pool of daemon threads, started on first use
+    """
+
+    def __init__(self, workers=None):
+        super(ThreadBackend, self).__init__()
+        self.workers = workers or getattr(settings, 'ACTIONS_TASK_WORKERS', 2)
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            atexit.register(self.warn_pending)
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name='fir_actions-tasks-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            name, args, key, queued_at = self._queue.get()
+            try:
+                self.execute(name, args, key, queued_at)
+            finally:
+                connection.close()
+                self._queue.task_done()
+
+    def submit(self, name, args, key=None):
+        if self.metrics.enqueue(key):
+            self._start()
+            self._queue.put((name, args, key, time.time()))
+
+    def join(self):
+        """ Wait for the queued tasks to be processed
+        """
+        self._queue.join()
+
+    def warn_pending(self):
+        """ Log the tasks which will never run, the queue living in the memory of the process
+        :return: number of unprocessed tasks
+        """
+        pending = self.metrics.stats()['depth']
+        if pending:
+            logger.warning('%d queued tasks dropped at exit', pending)
+        return pending
+
+
+class ExternalMetrics(Metrics):
+    """ Submitted tasks of an external queue, which runs and coalesces them out of sight of this process
+    """
+
+    def stats(self):
+        with self._lock:
+            return {'depth': None, 'queued': self.queued, 'coalesced': None, 'processed': None, 'failed': None,
+                    'last_lag': None, 'max_lag': None}
+
+
+class ExternalBackend(object):
+    """ Wrap a backend provided by the project, implementing `submit(name, args, key=None)` or `submit(name, args)`
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.metrics = ExternalMetrics()
+        self.coalescing = func_supports_parameter(backend.submit, 'key')
+
+    def submit(self, name, args, key=None):
+        self.metrics.enqueue(None)
+        if self.coalescing:
+            self.backend.submit(name, args, key=key)
+        else:
+            self.backend.submit(name, args)
+
+
+BACKENDS = {
+    'sync': SyncBackend,
+    'thread': ThreadBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            name = getattr(settings, 'ACTIONS_TASK_BACKEND', 'thread')
+            if name in BACKENDS:
+                _backend = BACKENDS[name]()
+            else:
+                _backend = ExternalBackend(import_string(name)())
+    return _backend
+
+
+def reset_backend():
+    """ Drop the current backend, so that the next task uses the ACTIONS_TASK_BACKEND setting again
+    """
+    global _backend
+    with _backend_lock:
+        _backend = None
+
+
+def defer(name, args=(), key=None):
+    """ Queue a registered task once the current transaction commits
+    Tasks sharing a coalescing `key` are only queued once while one of them is waiting.
+    """
+    transaction.on_commit(lambda: get_backend().submit(name, tuple(args), key=key))
+
+
+def stats():
+    """ Metrics of the task backend
+    :return: dict with depth, queued, coalesced, processed, failed, last_lag and max_lag, None when the backend
+    does not know them (external queues)
+    """
+    return get_backend().metrics.stats()
@@ -0,0 +1,30 @@
+from django import template
+
+from fir_actions.counters import get_counters
+from fir_actions.transitions import PermissionMatrix, get_permission_matrix
+
+register = template.Library()
+
+
+@register.simple_tag
+def activity_counters(incident=None, business_line=None):
+    """ Active and inactive actions and blocks of an incident or a business line
+    Usage: {% activity_counters event as counters %}{{ counters.actions.active }}
+    """
+    return get_counters(incident=incident, business_line=business_line)
+
+
+@register.simple_tag(takes_context=True)
+def available_transitions(context, obj):
+    """ Transitions of an action or a block the current user can apply, looked up in the per request permission matrix
+    Usage: {% available_transitions a as transitions %}{% for t in transitions %}...{% endfor %}
+    """
+    request = context.get('request')
+    if request is not None:
+        matrix = get_permission_matrix(request)
+    else:
+        matrix = context.render_context.get('fir_actions_permissions')
+        if matrix is None:
+            matrix = PermissionMatrix(context['user'])
+            context.render_context['fir_actions_permissions'] = matrix
+    return matrix.transitions(obj)
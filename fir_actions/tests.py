@@ -0,0 +1,686 @@
+import datetime
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.forms import modelform_factory
+from django.db.models.signals import post_save
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
+
+from incidents.models import BusinessLine, Incident, IncidentCategory, Label, LabelGroup
+
+from fir_actions import block_index, counters, models, services, tasks
+from fir_actions.action_templates import ActionTemplateIndex
+from fir_actions.comments import collect_action_comments
+from fir_actions.forms import MultipleBlockForm
+from fir_actions.pagination import encode_cursor
+from fir_actions.indicators import index_fields, normalize
+from fir_actions.models import Action, ActionDigest, ActionList, Block, BlockLocation, BlockType, \
+    prune_block_changes
+from fir_actions.signals import action_notification, blocks_added
+
+try:
+    from django.urls import reverse
+except ImportError:
+    from django.core.urlresolvers import reverse
+
+
+@contextmanager
+def recorded_logs(name):
+    """ Collect the messages logged on a logger
+    """
+    records = []
+    handler = logging.Handler()
+    handler.emit = lambda record: records.append(record.getMessage())
+    logger = logging.getLogger(name)
+    logger.addHandler(handler)
+    try:
+        yield records
+    finally:
+        logger.removeHandler(handler)
+
+
+class FixturesMixin(object):
+
+    def setUp(self):
+        super(FixturesMixin, self).setUp()
+        self.user = User.objects.create_superuser('admin', 'admin@localhost', 'admin')
+        self.business_line = BusinessLine.add_root(name='Root').add_child(name='Child')
+        group, created = LabelGroup.objects.get_or_create(name='detection')
+        self.incident = Incident.objects.create(subject='Incident', description='Incident',
+                                                category=IncidentCategory.objects.create(name='Category'),
+                                                detection=Label.objects.create(name='Detection', group=group),
+                                                severity=1, opened_by=self.user, confidentiality=1)
+        self.incident.concerned_business_lines.add(self.business_line)
+        self.location = BlockLocation.objects.create(name='Firewall', business_line=self.business_line)
+        self.block_type = BlockType.objects.create(name='Deny IP')
+        self.location.types.add(self.block_type)
+        self.client.force_login(self.user)
+
+    def enforce_block(self, what, where=None, incidents=()):
+        block = Block.objects.create(where=where or self.location, how=self.block_type, what=what)
+        block.incidents.add(*incidents)
+        block.approve(by=self.user)
+        block.save()
+        block.enforce(by=self.user)
+        block.save()
+        return block
+
+
+@override_settings(ACTIONS_FRAGMENT_CACHE=False)
+class ListQueryCountTest(FixturesMixin, TestCase):
+    """ The action and block lists run the same number of queries whatever the number of rows they render
+    """
+
+    def add_actions(self, count):
+        Action.objects.bulk_create([
+            Action(subject='Action %d' % i, description='Action', type='investigation', incident=self.incident,
+                   business_line=self.business_line, opened_by=self.user, state='assigned')
+            for i in range(count)])
+
+    def add_blocks(self, start, count):
+        values = ['192.0.2.%d' % i for i in range(start, start + count)]
+        Block.objects.bulk_create([Block(where=self.location, how=self.block_type, what=value,
+                                         normalized_what=normalize(value), **index_fields(value))
+                                   for value in values])
+        self.incident.blocks.add(*Block.objects.filter(what__in=values))
+
+    def count_queries(self, url, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data or {})
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertConstantQueries(self, url, add_rows, data=None):
+        add_rows(3)
+        # The first request fills the per user caches
+        self.count_queries(url, data)
+        expected = self.count_queries(url, data)
+        add_rows(30)
+        with self.assertNumQueries(expected):
+            response = self.client.get(url, data or {})
+        self.assertEqual(response.status_code, 200)
+
+    def test_action_list(self):
+        self.assertConstantQueries(reverse('actions:actions_list', args=[self.incident.pk]), self.add_actions)
+
+    def test_action_list_followup(self):
+        self.assertConstantQueries(reverse('actions:actions_list', args=[self.incident.pk]), self.add_actions,
+                                   {'followup': 1})
+
+    def test_block_list(self):
+        added = []
+
+        def add_blocks(count):
+            self.add_blocks(sum(added), count)
+            added.append(count)
+
+        self.assertConstantQueries(reverse('actions:blocks_list', args=[self.incident.pk]), add_blocks)
+
+    def test_block_list_followup(self):
+        added = []
+
+        def add_blocks(count):
+            self.add_blocks(sum(added), count)
+            added.append(count)
+
+        self.assertConstantQueries(reverse('actions:blocks_list', args=[self.incident.pk]), add_blocks,
+                                   {'followup': 1})
+
+
+class NormalizeTest(SimpleTestCase):
+
+    def test_url_path_case(self):
+        self.assertEqual(normalize('HTTP://Ex.COM/Path?Q=A'), 'http://ex.com/Path?Q=A')
+        self.assertNotEqual(normalize('http://ex.com/A'), normalize('http://ex.com/a'))
+
+    def test_ipv4_mapped(self):
+        self.assertEqual(normalize('::ffff:1.2.3.4'), '1.2.3.4')
+        self.assertEqual(normalize('::FFFF:102:304'), '1.2.3.4')
+        self.assertEqual(normalize('::ffff:1.2.3.0/120'), '1.2.3.0/24')
+
+
+@override_settings(ACTIONS_TASK_BACKEND='sync')
+class NotificationTest(FixturesMixin, TransactionTestCase):
+    """ Action notifications are sent once the transaction commits, grouped per business line
+    """
+
+    def setUp(self):
+        super(NotificationTest, self).setUp()
+        self.incidents = [Incident.objects.create(subject='Incident %d' % i, description='Incident', severity=1,
+                                                  opened_by=self.user, confidentiality=1) for i in range(3)]
+        self.sent = []
+        action_notification.connect(self.receive, dispatch_uid='notification_test')
+        self.addCleanup(action_notification.disconnect, dispatch_uid='notification_test')
+        self.addCleanup(setattr, models, 'notifications_enabled', models.notifications_enabled)
+        models.notifications_enabled = True
+        tasks.reset_backend()
+        self.addCleanup(tasks.reset_backend)
+
+    def receive(self, sender, instance, event, business_lines, **kwargs):
+        self.sent.append((event, instance, set(business_lines.values_list('pk', flat=True))))
+
+    def test_cascade_digest(self):
+        block = Block.objects.create(where=self.location, how=self.block_type, what='192.0.2.1')
+        block.incidents.add(*self.incidents)
+        with transaction.atomic():
+            block.approve(by=self.user)
+            block.save()
+        self.assertEqual([(event, business_lines) for event, instance, business_lines in self.sent],
+                         [('action:digest', {self.business_line.pk})])
+        digest = self.sent[0][1]
+        self.assertEqual(set(digest.actions.all()), set(block.actions.all()))
+        self.assertEqual(ActionDigest.objects.count(), 1)
+
+    def test_single_action(self):
+        action = Action.objects.create(subject='Action', description='Action', type='investigation',
+                                       incident=self.incidents[0], business_line=self.business_line,
+                                       opened_by=self.user)
+        with transaction.atomic():
+            action.assign(by=self.user)
+            action.save()
+        self.assertEqual(self.sent, [('action:assigned', action, {self.business_line.pk})])
+        self.assertFalse(ActionDigest.objects.exists())
+
+
+class BlockChangesTest(FixturesMixin, TestCase):
+    """ The change feed of a location lists the blocks entering or leaving its active set, in commit order
+    """
+
+    def get_changes(self, since=0, location=None, **params):
+        params['since'] = since
+        return self.client.get(reverse('actions:blocks_changes', args=[(location or self.location).pk]), params)
+
+    def test_cursor(self):
+        blocks = [self.enforce_block('192.0.2.%d' % i) for i in range(3)]
+        data = self.get_changes(limit=2).json()
+        self.assertEqual([change['what'] for change in data['changes']], ['192.0.2.0', '192.0.2.1'])
+        self.assertTrue(data['more'])
+        data = self.get_changes(data['cursor']).json()
+        self.assertEqual([change['what'] for change in data['changes']], ['192.0.2.2'])
+        self.assertFalse(data['more'])
+        cursor = data['cursor']
+        blocks[1].delete()
+        data = self.get_changes(cursor).json()
+        self.assertEqual([(change['what'], change['active']) for change in data['changes']], [('192.0.2.1', False)])
+        self.assertEqual(data['cursor'], cursor + 1)
+        self.assertEqual(self.get_changes(data['cursor']).json()['changes'], [])
+
+    def test_sequence_order(self):
+        self.enforce_block('192.0.2.1')
+        self.enforce_block('192.0.2.2')
+        changes = self.get_changes().json()['changes']
+        self.assertEqual([change['sequence'] for change in changes], [1, 2])
+
+    def test_moved_block(self):
+        block = self.enforce_block('192.0.2.1')
+        other = BlockLocation.objects.create(name='Proxy', business_line=self.business_line)
+        cursor = self.get_changes().json()['cursor']
+        block.where = other
+        block.save()
+        changes = self.get_changes(cursor).json()['changes']
+        self.assertEqual([(change['what'], change['active']) for change in changes], [('192.0.2.1', False)])
+        changes = self.get_changes(location=other).json()['changes']
+        self.assertEqual([(change['what'], change['active']) for change in changes], [('192.0.2.1', True)])
+
+    def test_expired_cursor(self):
+        self.enforce_block('192.0.2.1')
+        self.enforce_block('192.0.2.2')
+        self.assertEqual(self.get_changes().json()['cursor'], 2)
+        prune_block_changes(datetime.datetime.now() + datetime.timedelta(days=1))
+        response = self.get_changes(1)
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response.json()['cursor'], 2)
+        self.assertEqual(self.get_changes(2).status_code, 200)
+        self.assertEqual(self.get_changes(3).status_code, 410)
+
+
+class CountersTest(FixturesMixin, TestCase):
+    """ The activity counters follow the saved actions and blocks
+    """
+
+    def assertCounters(self, actions, blocks):
+        expected = {'active': actions[0], 'inactive': actions[1], 'total': sum(actions)}
+        for result in (counters.get_counters(incident=self.incident),
+                       counters.get_counters(business_line=self.business_line)):
+            self.assertEqual(result['actions'], expected)
+            self.assertEqual(result['blocks'], {'active': blocks[0], 'inactive': blocks[1], 'total': sum(blocks)})
+
+    def test_transitions(self):
+        block = Block.objects.create(where=self.location, how=self.block_type, what='192.0.2.1')
+        block.incidents.add(self.incident)
+        self.assertCounters((0, 0), (0, 1))
+        block.approve(by=self.user)
+        block.save()
+        self.assertCounters((1, 0), (0, 1))
+        block.enforce(by=self.user)
+        block.save()
+        self.assertCounters((0, 1), (1, 0))
+
+    def test_rebuild(self):
+        self.enforce_block('192.0.2.1', incidents=[self.incident])
+        self.enforce_block('192.0.2.2', incidents=[self.incident]).propose_deletion(by=self.user)
+        Block.objects.create(where=self.location, how=self.block_type, what='192.0.2.3').incidents.add(self.incident)
+        live = (counters.get_counters(incident=self.incident), counters.get_counters(business_line=self.business_line))
+        call_command('rebuild_activity_counters', stdout=StringIO())
+        self.assertEqual((counters.get_counters(incident=self.incident),
+                          counters.get_counters(business_line=self.business_line)), live)
+
+    def test_failed_save(self):
+        block = Block.objects.create(where=self.location, how=self.block_type, what='192.0.2.1')
+        block.incidents.add(self.incident)
+        block.approve(by=self.user)
+        block.save()
+        block.enforce(by=self.user)
+        block.where_id = None
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            block.save()
+        # The actions closed by the cascade were written by the transition itself
+        self.assertCounters((0, 1), (0, 1))
+
+
+class BulkTransitionTest(FixturesMixin, TestCase):
+    """ Bulk transitions report each row and roll back the failed ones alone
+    """
+
+    def setUp(self):
+        super(BulkTransitionTest, self).setUp()
+        self.blocks = []
+        for i in range(3):
+            block = Block.objects.create(where=self.location, how=self.block_type, what='192.0.2.%d' % i)
+            block.incidents.add(self.incident)
+            block.approve(by=self.user)
+            block.save()
+            self.blocks.append(block)
+
+    def test_mixed_rows(self):
+        Block.objects.filter(pk=self.blocks[1].pk).update(state='refused')
+        ids = [block.pk for block in self.blocks] + [0]
+        results = services.bulk_transition(Block, ids, 'enforce', self.user)
+        self.assertEqual(list(results), ids)
+        self.assertEqual(results[self.blocks[0].pk], {'status': 'success'})
+        self.assertEqual(results[self.blocks[1].pk], {'status': 'error', 'data': 'Transition not allowed'})
+        self.assertEqual(results[0], {'status': 'error', 'data': 'Not found'})
+        self.assertEqual(services.bulk_transition(Block, ids[:1], '_cascade', self.user)[ids[0]],
+                         {'status': 'error', 'data': 'Unknown transition'})
+        self.assertEqual(list(Block.objects.filter(pk__in=ids).order_by('pk').values_list('state', flat=True)),
+                         ['enforced', 'refused', 'enforced'])
+        self.assertEqual(Action.objects.filter(state='closed').count(), 2)
+
+    def test_rollback_isolation(self):
+        failing = self.blocks[1]
+        comments = failing.actions.get().comments.count()
+
+        def fail(sender, instance, **kwargs):
+            if instance.pk == failing.pk:
+                raise RuntimeError('database detail')
+
+        post_save.connect(fail, sender=Block, dispatch_uid='bulk_transition_test')
+        self.addCleanup(post_save.disconnect, sender=Block, dispatch_uid='bulk_transition_test')
+        with recorded_logs('fir_actions.services') as logs:
+            results = services.bulk_transition(Block, [block.pk for block in self.blocks], 'enforce', self.user)
+        self.assertEqual(logs, ['Transition enforce failed on Block {}'.format(failing.pk)])
+        self.assertEqual(results[failing.pk], {'status': 'error', 'data': 'Transition failed'})
+        failing = Block.objects.get(pk=failing.pk)
+        self.assertEqual(failing.state, 'approved')
+        self.assertEqual(list(failing.actions.values_list('state', flat=True)), ['assigned'])
+        self.assertEqual(Action.objects.filter(state='closed').count(), 2)
+        self.assertEqual(failing.actions.get().comments.count(), comments)
+
+
+@override_settings(ACTIONS_TASK_BACKEND='sync')
+class CommentBufferTest(FixturesMixin, TransactionTestCase):
+    """ Buffered transition comments are inserted when the transaction commits and dropped when it rolls back
+    """
+
+    def setUp(self):
+        super(CommentBufferTest, self).setUp()
+        tasks.reset_backend()
+        self.addCleanup(tasks.reset_backend)
+        self.action = Action.objects.create(subject='Action', description='Action', type='investigation',
+                                            incident=self.incident, business_line=self.business_line,
+                                            opened_by=self.user)
+
+    def test_commit(self):
+        with transaction.atomic():
+            with collect_action_comments():
+                self.action.assign(by=self.user)
+                self.action.save()
+            self.assertFalse(self.action.comments.exists())
+        self.assertEqual(self.action.comments.count(), 1)
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError), transaction.atomic():
+            with collect_action_comments():
+                self.action.assign(by=self.user)
+                self.action.save()
+            raise ValueError
+        self.assertFalse(self.action.comments.exists())
+
+    def test_failed_transition(self):
+        with self.assertRaises(ValueError), collect_action_comments():
+            self.action.assign(by=self.user)
+            raise ValueError
+        self.assertFalse(self.action.comments.exists())
+
+
+def build_index(*values):
+    return block_index.LocationIndex([
+        [pk, 1, 'enforced', value, normalize(value)] + [index_fields(value)[name] for name in (
+            'indicator_type', 'ip_version', 'range_start', 'range_end')]
+        for pk, value in enumerate(values, 1)])
+
+
+class LocationIndexTest(SimpleTestCase):
+
+    def lookup(self, index, value):
+        indicator, exact, covering, covered = index.lookup(value)
+        return [sorted(entry['what'] for entry in entries) for entries in (exact, covering, covered)]
+
+    def test_ipv4(self):
+        index = build_index('192.0.2.0/24', '192.0.2.1', '192.0.0.0/16', '198.51.100.1')
+        self.assertEqual(self.lookup(index, '192.0.2.1'), [['192.0.2.1'], ['192.0.0.0/16', '192.0.2.0/24'], []])
+        self.assertEqual(self.lookup(index, '192.0.2.0/25'), [[], ['192.0.0.0/16', '192.0.2.0/24'], ['192.0.2.1']])
+        self.assertEqual(self.lookup(index, '::ffff:192.0.2.1'), self.lookup(index, '192.0.2.1'))
+
+    def test_ipv6(self):
+        index = build_index('2001:db8::/32', '2001:db8::1', '192.0.2.1')
+        self.assertEqual(self.lookup(index, '2001:DB8:0::1'), [['2001:db8::1'], ['2001:db8::/32'], []])
+        self.assertEqual(self.lookup(index, '2001:db8::/16'), [[], [], ['2001:db8::/32', '2001:db8::1']])
+
+    def test_wildcard_domain(self):
+        index = build_index('*.example.com', 'www.example.com')
+        self.assertEqual(self.lookup(index, 'example.com'), [[], [], ['*.example.com', 'www.example.com']])
+        self.assertEqual(self.lookup(index, 'www.example.com'), [['www.example.com'], ['*.example.com'], []])
+        self.assertEqual(self.lookup(index, '*.example.com'), [['*.example.com'], [], ['www.example.com']])
+        self.assertEqual(self.lookup(index, 'http://example.com/path'), [[], [], []])
+
+    def test_exact_domain(self):
+        index = build_index('example.com')
+        self.assertEqual(self.lookup(index, 'EXAMPLE.com.'), [['example.com'], [], []])
+        self.assertEqual(self.lookup(index, '*.example.com'), [[], ['example.com'], []])
+        self.assertEqual(self.lookup(index, 'a.example.com'), [[], ['example.com'], []])
+        self.assertEqual(self.lookup(index, 'http://a.example.com/path'), [[], ['example.com'], []])
+
+
+class OverlapTest(FixturesMixin, TestCase):
+
+    def test_block_type(self):
+        other_type = BlockType.objects.create(name='Route IP')
+        Block.objects.create(where=self.location, how=self.block_type, what='192.0.2.0/24')
+        Block.objects.create(where=self.location, how=other_type, what='192.0.0.0/16')
+        overlaps = MultipleBlockForm.find_overlaps(self.location, self.block_type, ['192.0.2.1', ''])
+        self.assertEqual(len(overlaps), 1)
+        self.assertIn('192.0.2.0/24', overlaps[0])
+        self.assertNotIn('192.0.0.0/16', overlaps[0])
+        self.assertEqual(MultipleBlockForm.find_overlaps(self.location, other_type, ['10.0.0.1']), [])
+
+
+class BlockExportTest(FixturesMixin, TestCase):
+
+    def export(self, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(reverse('actions:blocks_export', kwargs={'location_id': self.location.pk,
+                                                                        'format': 'txt'}), **headers)
+
+    def test_etag(self):
+        self.enforce_block('192.0.2.1')
+        block = self.enforce_block('192.0.2.2')
+        response = self.export()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response)
+        self.assertEqual(b''.join(response.streaming_content).split(), [b'192.0.2.1', b'192.0.2.2'])
+        etag = response['ETag']
+        self.assertEqual(self.export(etag).status_code, 304)
+        block.delete()
+        response = self.export(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content).split(), [b'192.0.2.1'])
+        self.assertEqual(self.export(response['ETag']).status_code, 304)
+
+
+class ActionTemplateIndexTest(FixturesMixin, TestCase):
+
+    def setUp(self):
+        super(ActionTemplateIndexTest, self).setUp()
+        self.root_list = ActionList.objects.create(name='Root')
+        self.root_list.business_lines.add(self.business_line.get_parent())
+        self.child_list = ActionList.objects.create(name='Child')
+        self.child_list.business_lines.add(self.business_line)
+        self.global_list = ActionList.objects.create(name='Global')
+
+    def test_tree_order(self):
+        index = ActionTemplateIndex(ActionList)
+        self.assertEqual(index.get_lists(None, None, None, self.business_line),
+                         [self.child_list, self.global_list, self.root_list])
+        self.assertEqual(index.get_lists(None, None, None, self.business_line.get_parent()),
+                         [self.root_list, self.global_list])
+
+    def test_invalidated_while_fetching(self):
+        index = ActionTemplateIndex(ActionList)
+        fetch = index._business_lines
+
+        def invalidated_fetch(pks):
+            index.invalidate()
+            return fetch(pks)
+
+        index._business_lines = invalidated_fetch
+        self.assertEqual(len(index.get_lists(None, None, None, self.business_line)), 3)
+        self.assertEqual(index._entries, {})
+
+
+class BlockUniqueTest(FixturesMixin, TestCase):
+
+    def test_model_form(self):
+        Block.objects.create(where=self.location, how=self.block_type, what='http://Example.com/Path')
+        form_class = modelform_factory(Block, fields=('where', 'how', 'what'))
+        form = form_class({'where': self.location.pk, 'how': self.block_type.pk, 'what': ' HTTP://example.COM/Path'})
+        self.assertFalse(form.is_valid())
+        self.assertIn('what', form.errors)
+        form = form_class({'where': self.location.pk, 'how': self.block_type.pk, 'what': 'http://example.com/path'})
+        self.assertTrue(form.is_valid())
+
+    def test_edit_keeps_own_value(self):
+        block = Block.objects.create(where=self.location, how=self.block_type, what='example.com')
+        block.what = 'Example.COM'
+        block.validate_unique()
+
+
+class AddBlocksTest(FixturesMixin, TestCase):
+
+    def add(self, values, incident=None):
+        return services.add_blocks(incident or self.incident, self.location, self.block_type, values, user=self.user)
+
+    def test_normalized_duplicates(self):
+        summary = self.add(['192.0.2.1', ' 192.0.2.1 ', 'Example.com', 'example.com.', '', '::ffff:192.0.2.1'])
+        self.assertEqual(summary, {'total': 6, 'skipped': 4, 'created': 2, 'existing': 0, 'attached': 2,
+                                   'proposed': 0})
+        self.assertEqual(sorted(Block.objects.values_list('what', flat=True)), ['192.0.2.1', 'Example.com'])
+        summary = self.add(['EXAMPLE.COM', '192.0.2.2'])
+        self.assertEqual((summary['created'], summary['existing'], summary['attached']), (1, 1, 1))
+
+    def test_concurrent_insert(self):
+        Block.objects.create(where=self.location, how=self.block_type, what='192.0.2.2')
+        items = [(normalize(value), value) for value in ('192.0.2.1', '192.0.2.2', '192.0.2.3')]
+        created = services.create_blocks(self.location, self.block_type, items)
+        self.assertEqual(sorted(created), ['192.0.2.1', '192.0.2.3'])
+        self.assertEqual(Block.objects.count(), 3)
+
+    def test_single_link_insert(self):
+        self.add(['192.0.2.%d' % i for i in range(10)])
+        through = Block.incidents.through._meta.db_table
+        with CaptureQueriesContext(connection) as queries:
+            summary = self.add(['192.0.2.%d' % i for i in range(20)])
+        self.assertEqual((summary['created'], summary['existing'], summary['attached']), (10, 10, 10))
+        inserts = [query['sql'] for query in queries.captured_queries
+                   if query['sql'].startswith('INSERT INTO "{}"'.format(through))]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(self.incident.blocks.count(), 20)
+
+    def test_single_signal(self):
+        self.add(['192.0.2.1'])
+        other = Incident.objects.create(subject='Other', description='Other', severity=1, opened_by=self.user,
+                                        confidentiality=1)
+        sent = []
+
+        def receive(sender, incident, created, attached, **kwargs):
+            sent.append((incident, sorted(b.what for b in created), sorted(b.what for b in attached)))
+
+        blocks_added.connect(receive, sender=Block, dispatch_uid='add_blocks_test')
+        self.addCleanup(blocks_added.disconnect, sender=Block, dispatch_uid='add_blocks_test')
+        self.add(['192.0.2.1', '192.0.2.2', '192.0.2.3'], incident=other)
+        self.assertEqual(sent, [(other, ['192.0.2.2', '192.0.2.3'], ['192.0.2.1', '192.0.2.2', '192.0.2.3'])])
+
+
+class KeysetTest(FixturesMixin, TestCase):
+
+    def add_actions(self, count, opened_on):
+        Action.objects.bulk_create([
+            Action(subject='Action', description='Action', type='investigation', incident=self.incident,
+                   business_line=self.business_line, opened_by=self.user, state='assigned', opened_on=opened_on)
+            for i in range(count)])
+
+    def get_page(self, cursor=None, size=2):
+        params = {'size': size}
+        if cursor:
+            params['cursor'] = cursor
+        return self.client.get(reverse('actions:actions_keyset', args=[self.incident.pk]), params)
+
+    def get_all(self, size=2):
+        ids = []
+        cursor = None
+        while True:
+            data = self.get_page(cursor, size).json()
+            ids.extend(result['id'] for result in data['results'])
+            cursor = data['next']
+            if cursor is None:
+                return ids
+
+    def test_opened_on_ties(self):
+        self.add_actions(5, datetime.datetime(2026, 1, 1))
+        expected = list(Action.objects.order_by('-id').values_list('id', flat=True))
+        self.assertEqual(self.get_all(), expected)
+
+    def test_stable_across_inserts(self):
+        self.add_actions(3, datetime.datetime(2026, 1, 1))
+        self.add_actions(2, datetime.datetime(2026, 1, 2))
+        expected = list(Action.objects.order_by('-opened_on', '-id').values_list('id', flat=True))
+        data = self.get_page().json()
+        ids = [result['id'] for result in data['results']]
+        self.add_actions(3, datetime.datetime(2026, 1, 3))
+        self.add_actions(1, datetime.datetime(2026, 1, 1))
+        cursor = data['next']
+        while cursor:
+            data = self.get_page(cursor).json()
+            ids.extend(result['id'] for result in data['results'])
+            cursor = data['next']
+        new_tie = Action.objects.order_by('-id').values_list('id', flat=True)[0]
+        self.assertEqual(ids, expected[:2] + [new_tie] + expected[2:])
+
+    def test_invalid_cursor(self):
+        self.add_actions(3, datetime.datetime(2026, 1, 1))
+        for cursor in ('not a cursor', encode_cursor([1]), encode_cursor(['not a date', 1]), encode_cursor({})):
+            response = self.get_page(cursor)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['data'], 'Invalid cursor')
+
+
+class CompactedExportTest(FixturesMixin, TestCase):
+    VALUES = ['10.0.0.0/8', '10.1.2.3', '192.0.2.0/25', '192.0.2.128/25', '198.51.100.1', '2001:db8::/32',
+              '2001:db8::1', '::ffff:10.9.9.9', 'Example.com', 'a.example.com', '*.wild.example.net',
+              'a.wild.example.net', '*.b.example.net', 'b.example.net', 'http://Example.org/Path',
+              'd41d8cd98f00b204e9800998ecf8427e']
+
+    def export(self):
+        response = self.client.get(reverse('actions:blocks_compacted_export',
+                                           kwargs={'location_id': self.location.pk, 'format': 'txt'}))
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode('utf-8').splitlines()
+
+    def test_round_trip(self):
+        services.add_blocks(self.incident, self.location, self.block_type, self.VALUES)
+        Block.objects.update(state='enforced')
+        compacted = self.export()
+        self.assertEqual(sorted(compacted), sorted(['10.0.0.0/8', '192.0.2.0/24', '198.51.100.1', '2001:db8::/32',
+                                                    'Example.com', '*.wild.example.net', 'b.example.net',
+                                                    'http://Example.org/Path', 'd41d8cd98f00b204e9800998ecf8427e']))
+        index = build_index(*compacted)
+        for value in self.VALUES:
+            indicator, exact, covering, covered = index.lookup(value)
+            self.assertTrue(exact or covering, value)
+        # The wildcard does not cover the domain itself
+        self.assertEqual(index.lookup('wild.example.net')[1:3], ([], []))
+        original = build_index(*self.VALUES)
+        for value in compacted:
+            indicator, exact, covering, covered = original.lookup(value)
+            self.assertTrue(exact or covered, value)
+
+
+class RecordingQueue(object):
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, name, args, key=None):
+        self.submitted.append((name, args, key))
+
+
+class KeylessQueue(RecordingQueue):
+
+    def submit(self, name, args):
+        self.submitted.append((name, args))
+
+
+class TaskBackendTest(SimpleTestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+        tasks.task('fir_actions.tests.record')(self.calls.append)
+        tasks.task('fir_actions.tests.wait')(lambda: self.release.wait(5))
+        tasks.task('fir_actions.tests.fail')(lambda: 1 / 0)
+        for name in ('fir_actions.tests.record', 'fir_actions.tests.wait', 'fir_actions.tests.fail'):
+            self.addCleanup(tasks.registry.pop, name)
+
+    def test_sync(self):
+        backend = tasks.SyncBackend()
+        backend.submit('fir_actions.tests.record', (1, ), key='one')
+        backend.submit('fir_actions.tests.record', (1, ), key='one')
+        with recorded_logs('fir_actions.tasks') as logs:
+            backend.submit('fir_actions.tests.fail', ())
+        self.assertEqual(logs, ['Task fir_actions.tests.fail failed'])
+        self.assertEqual(self.calls, [1, 1])
+        stats = backend.metrics.stats()
+        self.assertEqual((stats['depth'], stats['processed'], stats['failed'], stats['coalesced']), (0, 2, 1, 0))
+
+    def test_thread_coalescing(self):
+        backend = tasks.ThreadBackend(workers=1)
+        self.addCleanup(self.release.set)
+        backend.submit('fir_actions.tests.wait', ())
+        for i in range(3):
+            backend.submit('fir_actions.tests.record', (i, ), key='same')
+        backend.submit('fir_actions.tests.record', (3, ))
+        with recorded_logs('fir_actions.tasks') as logs:
+            self.assertEqual(backend.warn_pending(), 3)
+        self.assertEqual(logs, ['3 queued tasks dropped at exit'])
+        self.release.set()
+        backend.join()
+        self.assertEqual(self.calls, [0, 3])
+        stats = backend.metrics.stats()
+        self.assertEqual((stats['depth'], stats['processed'], stats['coalesced']), (0, 3, 2))
+        self.assertEqual(backend.warn_pending(), 0)
+
+    def test_external(self):
+        backend = tasks.ExternalBackend(RecordingQueue())
+        backend.submit('fir_actions.tests.record', (1, ), key='one')
+        self.assertEqual(backend.backend.submitted, [('fir_actions.tests.record', (1, ), 'one')])
+        keyless = tasks.ExternalBackend(KeylessQueue())
+        keyless.submit('fir_actions.tests.record', (1, ), key='one')
+        self.assertEqual(keyless.backend.submitted, [('fir_actions.tests.record', (1, ))])
+        self.assertEqual(keyless.metrics.stats()['queued'], 1)
+        self.assertIsNone(keyless.metrics.stats()['depth'])
@@ -0,0 +1,102 @@
+class TransitionTable(object):
+    """ State -> transitions table of a model FSM field, built once per model class
+
+    Replaces the per object introspection done by get_available_FIELD_transitions.
+    """
+
+    def __init__(self, model, field_name='state'):
+        self.model = model
+        self.field_name = field_name
+        self._table = None
+
+    def _build(self):
+        field = self.model._meta.get_field(self.field_name)
+        transitions = list(field.get_all_transitions(self.model))
+        table = {}
+        for state, label in field.choices:
+            table[state] = [t for t in transitions
+                            if t.source == state or t.source == '*' or (t.source == '+' and t.target != state)]
+        return table
+
+    def for_state(self, state):
+        """ Transitions available from a state, not taking conditions or permissions into account
+        :return: list of django_fsm.Transition
+        """
+        if self._table is None:
+            self._table = self._build()
+        return self._table.get(state, [])
+
+    def all(self):
+        """ All the transitions of the field
+        :return: list of django_fsm.Transition
+        """
+        if self._table is None:
+            self._table = self._build()
+        transitions = []
+        for state_transitions in self._table.values():
+            transitions.extend(t for t in state_transitions if t not in transitions)
+        return transitions
+
+    def get(self, state, name):
+        """ Get a transition by name when it is available from a state
+        :return: django_fsm.Transition or None
+        """
+        for transition in self.for_state(state):
+            if transition.name == name:
+                return transition
+        return None
+
+    def available(self, obj):
+        """ Transitions of an object whose conditions are met
+        :return: list of django_fsm.Transition
+        """
+        return [t for t in self.for_state(getattr(obj, self.field_name))
+                if all(condition(obj) for condition in t.conditions)]
+
+
+class PermissionMatrix(object):
+    """ Transition permissions of a user, computed once per (permission, scope)
+
+    Transition permissions built by action_permission and block_permission carry the permission name and the field
+    holding the object they are checked against (business line or location), so the result of a check applies to
+    every object sharing that scope. Other permissions are checked per object.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._checked = {}
+
+    def has_perm(self, transition, obj):
+        permission = transition.permission
+        obj_field = getattr(permission, 'obj_field', None)
+        if not permission or obj_field is None:
+            return transition.has_perm(obj, self.user)
+        key = (permission.permission, obj_field, getattr(obj, '{}_id'.format(obj_field)))
+        if key not in self._checked:
+            self._checked[key] = transition.has_perm(obj, self.user)
+        return self._checked[key]
+
+    def transitions(self, obj):
+        """ Transitions of an object the user is allowed to apply
+        :return: list of django_fsm.Transition
+        """
+        return [t for t in tables[obj._meta.concrete_model].available(obj) if self.has_perm(t, obj)]
+
+
+tables = {}
+
+
+def register(model, field_name='state'):
+    tables[model] = TransitionTable(model, field_name)
+    return model
+
+
+def get_permission_matrix(request):
+    """ Get the permission matrix of the request user, built once per request
+    :return: PermissionMatrix
+    """
+    matrix = getattr(request, '_fir_actions_permissions', None)
+    if matrix is None:
+        matrix = PermissionMatrix(request.user)
+        request._fir_actions_permissions = matrix
+    return matrix
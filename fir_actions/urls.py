@@ -6,12 +6,30 @@ urlpatterns = [
     url(r'^(?P<action_id>\d+)/display$', views.actions_get, name='actions_display'),
     url(r'^(?P<event_id>\d+)$', views.ActionList.as_view(), name='actions_list'),
     url(r'^(?P<event_id>\d+)/add$', views.actions_addaction, name='actions_add'),
+    url(r'^keyset$', views.ActionKeyset.as_view(), name='actions_keyset_dashboard'),
+    url(r'^(?P<event_id>\d+)/keyset$', views.ActionKeyset.as_view(), name='actions_keyset'),
     url(r'^transition/(?P<action_id>\d+)/(?P<transition_name>[a-z_]+)$', views.actions_transition, name='actions_transition'),
+    url(r'^transition/(?P<transition_name>[a-z_]+)$', views.actions_bulk_transition, name='actions_bulk_transition'),
     url(r'^blocks$', views.BlockList.as_view(), name='blocks_index'),
     url(r'^blocks/(?P<block_id>\d+)$', views.BlockList.as_view(), name='blocks_details'),
     url(r'^blocks/(?P<block_id>\d+)/display$', views.blocks_get, name='blocks_display'),
     url(r'^blocks/(?P<event_id>\d+)/list', views.BlockList.as_view(), name='blocks_list'),
     url(r'^blocks/(?P<event_id>\d+)/add$', views.blocks_addblock, name='blocks_add'),
+    url(r'^blocks/export/(?P<location_id>\d+)(?:/(?P<type_id>\d+))?\.(?P<format>csv|jsonl|txt)$', views.blocks_export,
+        name='blocks_export'),
+    url(r'^blocks/export/(?P<location_id>\d+)(?:/(?P<type_id>\d+))?/compacted\.(?P<format>csv|jsonl|txt)$',
+        views.blocks_compacted_export, name='blocks_compacted_export'),
+    url(r'^blocks/compact/(?P<location_id>\d+)(?:/(?P<type_id>\d+))?$', views.blocks_compact, name='blocks_compact'),
+    url(r'^blocks/changes/(?P<location_id>\d+)$', views.blocks_changes, name='blocks_changes'),
+    url(r'^blocks/lookup/(?P<location_id>\d+)$', views.blocks_lookup, name='blocks_lookup'),
+    url(r'^counters/(?P<event_id>\d+)$', views.counters_incident, name='counters_incident'),
+    url(r'^counters/business_line/(?P<business_line_id>\d+)$', views.counters_business_line,
+        name='counters_business_line'),
+    url(r'^blocks/keyset$', views.BlockKeyset.as_view(), name='blocks_keyset_index'),
+    url(r'^blocks/(?P<event_id>\d+)/keyset$', views.BlockKeyset.as_view(), name='blocks_keyset'),
     url(r'^blocks/transition/(?P<block_id>\d+)/(?P<transition_name>[a-z_]+)(?:/(?P<event_id>\d+))?$', views.blocks_transition, name='blocks_transition'),
-    url(r'^blocks/autocomplete/how/', views.BlockTypeAutocomplete.as_view(), name='blocks_how_lookup')
+    url(r'^blocks/transition/(?P<transition_name>[a-z_]+)$', views.blocks_bulk_transition,
+        name='blocks_bulk_transition'),
+    url(r'^blocks/autocomplete/how/', views.BlockTypeAutocomplete.as_view(), name='blocks_how_lookup'),
+    url(r'^metrics$', views.metrics, name='metrics'),
 ]
@@ -0,0 +1,58 @@
+import threading
+
+from django.db import connection, transaction
+
+_pending = threading.local()
+
+
+def batches(items, field='pk'):
+    """ Split a list of query parameters in batches the database backend accepts in a single IN clause
+    """
+    items = list(items)
+    batch_size = max(connection.ops.bulk_batch_size([field], items), 1)
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+class PendingCalls(object):
+    """ Calls requested during a transaction, made once each when it commits, and the objects they share
+    """
+
+    def __init__(self):
+        self.calls = set()
+        self.objects = {}
+
+    def flush(self):
+        if getattr(_pending, 'current', None) is self:
+            del _pending.current
+        for func, args in self.calls:
+            func(*args)
+
+
+def _pending_calls():
+    pending = getattr(_pending, 'current', None)
+    # A rolled back transaction drops the flush callback along with it
+    if pending is None or not any(callback == pending.flush for sids, callback in connection.run_on_commit):
+        pending = _pending.current = PendingCalls()
+        transaction.on_commit(pending.flush)
+    return pending
+
+
+def on_commit_once(func, *args):
+    """ Call func(*args) once the current transaction commits (at once outside of a transaction), a single time
+    however many times it is requested during the transaction
+    """
+    if not connection.in_atomic_block:
+        func(*args)
+        return
+    _pending_calls().calls.add((func, args))
+
+
+def transaction_object(key, factory):
+    """ Object shared during the current transaction (which must be open), dropped when it commits or rolls back
+    :return: the object stored under `key`, created by calling `factory` on first use
+    """
+    objects = _pending_calls().objects
+    if key not in objects:
+        objects[key] = factory()
+    return objects[key]
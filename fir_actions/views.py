@@ -1,22 +1,41 @@
 # -*- coding: utf-8 -*-
+import hashlib
+
 from dal import autocomplete
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Q, Max, Count
 from django.shortcuts import get_object_or_404, render, redirect
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import login_required, user_passes_test
 from django.template.loader import render_to_string
-from django.http import JsonResponse, Http404
+from django.http import HttpResponse, JsonResponse, Http404, StreamingHttpResponse
 from django.utils.decorators import method_decorator
 from django_fsm import has_transition_perm, can_proceed
 from django.views.generic import ListView
+from django.views.decorators.http import condition
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy as _
 
 from incidents.authorization.decorator import authorization_required
 from incidents.models import Incident
+from fir_actions import block_index, tasks
+from fir_actions.compaction import compact
+from fir_actions.authorization import authorization_scope, get_business_line_ids, has_perm
+from fir_actions.comments import collect_action_comments
+from fir_actions.counters import get_counters
+from fir_actions.exports import COMPACTED_EXPORTERS, EXPORTERS, iter_blocks
+from fir_actions.fragments import FragmentCacheMixin
 from fir_actions.forms import MultipleBlockForm, FilterBlockForm, ActionForm, ActionTransitionForm
-from fir_actions.models import Block, Action, BlockLocation, BlockType
+from fir_actions.instrumentation import InstrumentedViewMixin, PrometheusBackend, get_backend, instrumented
+from fir_actions.models import Block, Action, BlockLocation, BlockType, BLOCK_ACTIVE_STATES, action_template_index, \
+    publish_block_changes
+from fir_actions.pagination import keyset_page
+from fir_actions.services import add_blocks, bulk_transition
 
 
+@instrumented('view')
 @login_required
 @authorization_required('incidents.handle_incidents', Incident, view_arg='event_id')
 def blocks_addblock(request, event_id, authorization_target=None):
@@ -31,27 +50,10 @@ def blocks_addblock(request, event_id, authorization_target=None):
         block_form = MultipleBlockForm(request.POST, user=request.user)
 
         if block_form.is_valid():
-            for what in block_form.cleaned_data['what']:
-                blocks = Block.objects.filter(where=block_form.cleaned_data['where'],
-                                              how=block_form.cleaned_data['how'], what__iexact=what)
-                if blocks.count():
-                    block = blocks[0]
-                    if block_form.cleaned_data['comment'] != '':
-                        block.comment = block_form.cleaned_data['comment']
-                    if block.state == 'deleted' and can_proceed(block.propose) and \
-                            has_transition_perm(block.propose, request.user):
-                        block.propose()
-                    block.save()
-                else:
-                    block = Block.objects.create(where=block_form.cleaned_data['where'],
-                                                 how=block_form.cleaned_data['how'], what=what,
-                                                 comment=block_form.cleaned_data['comment'])
-
-                if e not in block.incidents.all():
-                    block.incidents.add(e)
-                    block.save()
-                block.done_creating()
-            ret = {'status': 'success'}
+            summary = add_blocks(e, block_form.cleaned_data['where'], block_form.cleaned_data['how'],
+                                 block_form.cleaned_data['what'], comment=block_form.cleaned_data['comment'],
+                                 user=request.user)
+            ret = {'status': 'success', 'summary': summary}
             return JsonResponse(ret)
         else:
             errors = render_to_string("fir_actions/blocks_form.html",
@@ -63,7 +65,10 @@ def blocks_addblock(request, event_id, authorization_target=None):
                   {'block_form': block_form, 'event_id': event_id})
 
 
+@instrumented('view')
 @login_required
+@authorization_scope
+@collect_action_comments()
 def blocks_transition(request, block_id, transition_name, event_id=None):
     block = get_object_or_404(Block, pk=block_id)
     try:
@@ -72,8 +77,9 @@ def blocks_transition(request, block_id, transition_name, event_id=None):
         raise Http404
     try:
         if can_proceed(method) and has_transition_perm(method, request.user):
-            method(by=request.user)
-            block.save()
+            with transaction.atomic():
+                method(by=request.user)
+                block.save()
             block.done_updating()
         else:
             raise PermissionDenied
@@ -84,13 +90,34 @@ def blocks_transition(request, block_id, transition_name, event_id=None):
     return redirect('actions:blocks_index')
 
 
+def _bulk_transition(request, model, transition_name, **kwargs):
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'data': 'POST required'}, status=405)
+    try:
+        ids = [int(pk) for pk in request.POST.getlist('ids')]
+    except ValueError:
+        return JsonResponse({'status': 'error', 'data': 'Invalid id'}, status=400)
+    results = bulk_transition(model, ids, transition_name, request.user, **kwargs)
+    return JsonResponse({'status': 'success', 'results': results})
+
+
+@instrumented('view')
+@login_required
+@authorization_scope
+def blocks_bulk_transition(request, transition_name):
+    return _bulk_transition(request, Block, transition_name)
+
+
 @method_decorator(login_required, name='dispatch')
-class BlockList(ListView):
+@method_decorator(authorization_scope, name='dispatch')
+class BlockList(InstrumentedViewMixin, FragmentCacheMixin, ListView):
+    fragment_model = Block
     template_name = 'fir_actions/blocks_index.html'
     context_object_name = 'blocks'
 
     def get_queryset(self):
-        locations = BlockLocation.authorization.for_user(self.request.user, 'incidents.view_incidents')
+        locations = BlockLocation.objects.filter(
+            business_line_id__in=get_business_line_ids(self.request.user, 'incidents.view_incidents'))
         query = Q(where__in=locations)
         try:
             self.event = int(self.kwargs.get('event_id'))
@@ -106,9 +133,9 @@ class BlockList(ListView):
         if not self.followup == 0:
             self.paginate_by = None
         if self.status == 'active':
-            query &= Q(state__in=['enforced', 'deletion_proposed', 'deletion_approved'])
+            query &= Q(state__in=BLOCK_ACTIVE_STATES)
         elif self.status == 'inactive':
-            query &= Q(state__in=['proposed', 'approved', 'refused', 'blocked', 'deleted'])
+            query &= ~Q(state__in=BLOCK_ACTIVE_STATES)
         if self.request.method == 'POST':
             self.where = self.request.POST.get('where', None)
             self.how = self.request.POST.get('how', None)
@@ -116,12 +143,16 @@ class BlockList(ListView):
                 query &= Q(where_id=self.where)
             if self.how:
                 query &= Q(how_id=self.how)
-            return Block.objects.filter(query)
+            return self.get_blocks(query)
         elif self.request.method == 'GET':
             id = self.kwargs.get('block_id', None)
             if id:
-                return [get_object_or_404(Block.objects.filter(query), pk=id), ]
-        return Block.objects.filter(query)
+                return [get_object_or_404(self.get_blocks(query), pk=id), ]
+        return self.get_blocks(query)
+
+    def get_blocks(self, query):
+        return Block.objects.filter(query).select_related('where', 'how').prefetch_related('incidents')\
+            .only('id', 'what', 'state', 'where', 'how')
 
     def get_context_data(self, **kwargs):
         context = super(BlockList, self).get_context_data(**kwargs)
@@ -134,6 +165,138 @@ class BlockList(ListView):
         return self.get(request, *args, **kwargs)
 
 
+def _blocks_export_state(request, location_id, type_id=None, format='csv'):
+    """ Resolve the exported location and the version of its block set once per request
+    The last modification date alone would miss deletions: the version is only exposed as an ETag.
+    :return: tuple (location, exported blocks queryset, etag)
+    """
+    state = getattr(request, '_blocks_export_state', None)
+    if state is None:
+        locations = BlockLocation.objects.filter(
+            business_line_id__in=get_business_line_ids(request.user, 'incidents.view_incidents'))
+        location = get_object_or_404(locations, pk=location_id)
+        blocks = Block.objects.filter(where=location)
+        if type_id is not None:
+            blocks = blocks.filter(how_id=type_id)
+        stats = blocks.aggregate(last=Max('updated_on'), count=Count('id'))
+        etag = hashlib.md5('{}:{}:{}'.format(format, stats['last'], stats['count']).encode('utf-8')).hexdigest()
+        state = (location, blocks.filter(state__in=BLOCK_ACTIVE_STATES), etag)
+        request._blocks_export_state = state
+    return state
+
+
+@instrumented('view')
+@login_required
+@condition(etag_func=lambda request, *args, **kwargs: _blocks_export_state(request, *args, **kwargs)[2])
+def blocks_export(request, location_id, type_id=None, format='csv'):
+    location, blocks, etag = _blocks_export_state(request, location_id, type_id, format)
+    content_type, exporter = EXPORTERS[format]
+    response = StreamingHttpResponse(exporter(iter_blocks(blocks)), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="blocks-{}.{}"'.format(location.pk, format)
+    return response
+
+
+@instrumented('view')
+@login_required
+@condition(etag_func=lambda request, *args, **kwargs: _blocks_export_state(request, *args, **kwargs)[2])
+def blocks_compacted_export(request, location_id, type_id=None, format='txt'):
+    """ Export the smallest rule set equivalent to the active blocks of a location
+    """
+    location, blocks, etag = _blocks_export_state(request, location_id, type_id, format)
+    content_type, exporter = COMPACTED_EXPORTERS[format]
+    response = StreamingHttpResponse(exporter(compact(location, how=type_id).compacted()), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="blocks-{}-compacted.{}"'.format(location.pk, format)
+    return response
+
+
+@instrumented('view')
+@login_required
+@authorization_scope
+def blocks_compact(request, location_id, type_id=None):
+    """ List the redundant enforced blocks of a location, POST to propose their deletion
+    """
+    locations = BlockLocation.objects.filter(
+        business_line_id__in=get_business_line_ids(request.user, 'incidents.view_incidents'))
+    location = get_object_or_404(locations, pk=location_id)
+    proposals = compact(location, how=type_id).proposals()
+    if request.method == 'POST':
+        results = bulk_transition(Block, [entry.id for entry, reason, cover in proposals], 'propose_deletion',
+                                  request.user)
+        return JsonResponse({'status': 'success', 'results': results})
+    return JsonResponse({'status': 'success', 'redundant': [
+        {'id': entry.id, 'what': entry.what, 'how': entry.how, 'reason': reason,
+         'covered_by': {'id': cover.id, 'what': cover.what}} for entry, reason, cover in proposals]})
+
+
+@instrumented('view')
+@login_required
+@authorization_scope
+def blocks_lookup(request, location_id):
+    """ Find the blocks of a location overlapping the `value` parameter: same value, covering it (enclosing network,
+    parent domain, host of an URL) or covered by it. Use `state` parameters to restrict the reported states.
+    """
+    locations = BlockLocation.objects.filter(
+        business_line_id__in=get_business_line_ids(request.user, 'incidents.view_incidents'))
+    location = get_object_or_404(locations, pk=location_id)
+    value = request.GET.get('value', '').strip()
+    if not value:
+        return JsonResponse({'status': 'error', 'data': 'Missing value'}, status=400)
+    result = block_index.lookup(location.pk, value, states=request.GET.getlist('state') or None)
+    result['status'] = 'success'
+    return JsonResponse(result)
+
+
+@instrumented('view')
+@login_required
+@authorization_scope
+def blocks_changes(request, location_id):
+    """ Get the blocks which entered or left the active set of a location after the `since` cursor
+    """
+    locations = BlockLocation.objects.filter(
+        business_line_id__in=get_business_line_ids(request.user, 'incidents.view_incidents'))
+    location = get_object_or_404(locations, pk=location_id)
+    try:
+        since = int(request.GET.get('since', 0))
+        limit = min(max(int(request.GET.get('limit', 1000)), 1), 10000)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'data': 'Invalid cursor'}, status=400)
+    # Changes left unnumbered by a process which died after committing them
+    if location.changes.filter(sequence__isnull=True).exists() and publish_block_changes(location.pk):
+        location.refresh_from_db(fields=['change_sequence'])
+    changes = list(location.changes.filter(sequence__gt=since).order_by('sequence')
+                   .values('sequence', 'date', 'block_id', 'how_id', 'what', 'state', 'active')[:limit])
+    if since > location.change_sequence or (
+            since < location.change_sequence and (not changes or changes[0]['sequence'] != since + 1)):
+        return JsonResponse({'status': 'error', 'data': 'Expired cursor', 'cursor': location.change_sequence},
+                            status=410)
+    return JsonResponse({'status': 'success', 'changes': changes,
+                         'cursor': changes[-1]['sequence'] if changes else since,
+                         'more': len(changes) == limit})
+
+
+@instrumented('view')
+@login_required
+@authorization_required('incidents.view_incidents', Incident, view_arg='event_id')
+def counters_incident(request, event_id, authorization_target=None):
+    """ Get the active and inactive actions and blocks of an incident
+    """
+    if authorization_target is None:
+        authorization_target = get_object_or_404(Incident, pk=event_id)
+    return JsonResponse({'status': 'success', 'counters': get_counters(incident=authorization_target)})
+
+
+@instrumented('view')
+@login_required
+def counters_business_line(request, business_line_id):
+    """ Get the active and inactive actions and blocks of a business line
+    """
+    business_line_id = int(business_line_id)
+    if business_line_id not in get_business_line_ids(request.user, 'incidents.view_incidents'):
+        raise PermissionDenied
+    return JsonResponse({'status': 'success', 'counters': get_counters(business_line=business_line_id)})
+
+
+@instrumented('view')
 @login_required
 def blocks_get(request, block_id):
     block = get_object_or_404(Block, pk=block_id)
@@ -142,6 +305,7 @@ def blocks_get(request, block_id):
                                                                'element': 'block_list'})
 
 
+@instrumented('view')
 @login_required
 @authorization_required('incidents.handle_incidents', Incident, view_arg='event_id')
 def actions_addaction(request, event_id, authorization_target=None):
@@ -173,15 +337,20 @@ def actions_addaction(request, event_id, authorization_target=None):
                   {'action_form': form, 'event_id': '' if event_id is None else event_id})
 
 
+@instrumented('view')
 @login_required
+@authorization_scope
 def actions_get(request, action_id):
     action = get_object_or_404(Action, pk=action_id)
-    if not request.user.has_perm('incidents.view_incidents', obj=action.incident):
+    if not has_perm(request.user, 'incidents.view_incidents', obj=action.incident):
         raise PermissionDenied
     return render(request, 'fir_actions/actions_display.html', {'action': action})
 
 
+@instrumented('view')
 @login_required
+@authorization_scope
+@collect_action_comments()
 def actions_transition(request, action_id, transition_name):
     action = get_object_or_404(Action, pk=action_id)
     try:
@@ -197,8 +366,9 @@ def actions_transition(request, action_id, transition_name):
         if form.is_valid():
             try:
                 if can_proceed(method) and has_transition_perm(method, request.user):
-                    method(by=request.user, **form.cleaned_data)
-                    action.save()
+                    with transaction.atomic():
+                        method(by=request.user, **form.cleaned_data)
+                        action.save()
                     action.done_updating()
             except TypeError:
                 raise Http404
@@ -215,16 +385,28 @@ def actions_transition(request, action_id, transition_name):
                   {'transition_form': form, 'transition': transition_name, 'action': action, 'verb': verb})
 
 
+@instrumented('view')
+@login_required
+@authorization_scope
+def actions_bulk_transition(request, transition_name):
+    kwargs = {}
+    if request.POST.get('comment'):
+        kwargs['comment'] = request.POST['comment']
+    return _bulk_transition(request, Action, transition_name, **kwargs)
+
+
 @method_decorator(login_required, name='dispatch')
-class ActionList(ListView):
+@method_decorator(authorization_scope, name='dispatch')
+class ActionList(InstrumentedViewMixin, FragmentCacheMixin, ListView):
+    fragment_model = Action
     template_name = 'fir_actions/actions_list.html'
     context_object_name = 'actions'
     allow_empty = False
     paginate_by = 10
 
     def get_queryset(self):
-        queryset = Action.authorization.for_user(self.request.user, 'incidents.view_incidents').distinct() \
-                   | Action.objects.filter(business_line=None).distinct()
+        business_lines = get_business_line_ids(self.request.user, 'incidents.view_incidents')
+        queryset = Action.objects.filter(Q(business_line_id__in=business_lines) | Q(business_line__isnull=True))
         query = Q()
         try:
             self.event = int(self.kwargs.get('event_id'))
@@ -240,7 +422,10 @@ class ActionList(ListView):
             query &= Q(state__in=['created', 'assigned', 'blocked'])
         elif self.status == 'inactive':
             query &= Q(state='closed')
-        return queryset.filter(query).order_by('-opened_on')
+        return queryset.filter(query).select_related('incident', 'business_line')\
+            .only('id', 'opened_on', 'type', 'subject', 'subject_html', 'state', 'auto_state', 'incident',
+                  'business_line')\
+            .order_by('-opened_on')
 
     def get_context_data(self, **kwargs):
         context = super(ActionList, self).get_context_data(**kwargs)
@@ -253,7 +438,58 @@ class ActionList(ListView):
         return self.get(request, *args, **kwargs)
 
 
-class BlockTypeAutocomplete(autocomplete.Select2QuerySetView):
+class KeysetMixin(object):
+    """ Serve a list view as keyset paginated JSON pages (see fir_actions.pagination)
+    """
+    keyset = ('id',)
+    page_size = 50
+    max_page_size = 500
+    rows_template = None
+
+    def get(self, request, *args, **kwargs):
+        try:
+            size = min(int(request.GET.get('size', self.page_size)), self.max_page_size)
+            objects, cursor = keyset_page(self.get_queryset(), self.keyset, request.GET.get('cursor'), max(size, 1))
+        except ValueError:
+            return JsonResponse({'status': 'error', 'data': 'Invalid cursor'}, status=400)
+        ret = {'status': 'success', 'results': [self.serialize(obj) for obj in objects], 'next': cursor}
+        if request.GET.get('html'):
+            ret['data'] = render_to_string(self.rows_template, self.get_rows_context(objects), request=request)
+        return JsonResponse(ret)
+
+    def post(self, request, *args, **kwargs):
+        return self.http_method_not_allowed(request, *args, **kwargs)
+
+
+class ActionKeyset(KeysetMixin, ActionList):
+    keyset = ('-opened_on', '-id')
+    rows_template = 'fir_actions/actions_rows.html'
+
+    def serialize(self, action):
+        return {'id': action.id, 'opened_on': action.opened_on, 'type': action.type, 'subject': action.subject,
+                'state': action.state, 'status_id': action.status_id, 'incident': action.incident_id,
+                'business_line': action.business_line_id,
+                'business_line_name': force_text(action.business_line) if action.business_line_id else None}
+
+    def get_rows_context(self, actions):
+        return {'actions': actions, 'event': self.event, 'followup': not self.followup == 0}
+
+
+class BlockKeyset(KeysetMixin, BlockList):
+    keyset = ('id',)
+    rows_template = 'fir_actions/blocks_rows.html'
+
+    def serialize(self, block):
+        return {'id': block.id, 'where': block.where_id, 'where_name': force_text(block.where),
+                'how': block.how_id, 'how_name': force_text(block.how), 'what': block.what,
+                'state': block.state, 'status_id': block.status_id,
+                'incidents': [incident.id for incident in block.incidents.all()]}
+
+    def get_rows_context(self, blocks):
+        return {'blocks': blocks, 'event_id': self.event, 'followup': not self.followup == 0}
+
+
+class BlockTypeAutocomplete(InstrumentedViewMixin, autocomplete.Select2QuerySetView):
     def get_queryset(self):
         location = self.forwarded.get('where', None)
         if not location:
@@ -263,3 +499,36 @@ class BlockTypeAutocomplete(autocomplete.Select2QuerySetView):
             return location.types.filter(name__icontains= self.q)
         except (BlockLocation.DoesNotExist, BlockLocation.MultipleObjectsReturned, ValueError):
             return BlockType.objects.none()
+
+
+def metrics(request):
+    """ Metrics of the process in the Prometheus text format, for staff users and scrapers sending the
+    ACTIONS_METRICS_TOKEN bearer token
+    """
+    backend = get_backend(PrometheusBackend)
+    if backend is None:
+        raise Http404
+    token = getattr(settings, 'ACTIONS_METRICS_TOKEN', None)
+    if token and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer {}'.format(token)):
+        return render_metrics(backend)
+    return staff_metrics(request, backend)
+
+
+@user_passes_test(lambda user: user.is_active and user.is_staff)
+def staff_metrics(request, backend):
+    return render_metrics(backend)
+
+
+def render_metrics(backend):
+    """ Prometheus exposition of the collected metrics and of the task queue and template cache gauges
+    :return: HttpResponse
+    """
+    gauges = {}
+    for name, value in tasks.stats().items():
+        if value is not None:
+            gauges['tasks_' + name] = ('Task backend {}'.format(name.replace('_', ' ')), value)
+    for name, value in action_template_index.templates.stats().items():
+        if value is not None:
+            gauges['template_cache_' + name] = ('Compiled action templates cache {}'.format(name.replace('_', ' ')),
+                                                value)
+    return HttpResponse(backend.render(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
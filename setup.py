@@ -24,7 +24,8 @@ setup(
     install_requires=[
         'django>=1.9',
         'django-fsm',
-        'django-autocomplete-light'
+        'django-autocomplete-light',
+        'ipaddress; python_version < "3"'
     ],
     license="GPL v3, see LICENSE",
     zip_safe=False,